@@ -0,0 +1,200 @@
+#!/usr/bin/env python3
+"""
+    tests/images の全画像に対して guess_pageinfo と detect_qp_region を実行し、
+    スループット、レイテンシ (p50/p95/p99) および処理段階ごとの所要時間を計測する。
+
+    -o で結果を JSON に保存し、--compare で保存済みの結果 (ベースライン) と比較する。
+    比較時に --threshold (%) を超えて遅くなった項目があれば終了コード 1 を返す。
+
+    usage:
+        python benchmarks/bench_corpus.py -o baseline.json
+        python benchmarks/bench_corpus.py --compare baseline.json --threshold 10
+"""
+import argparse
+import json
+import math
+import platform
+import sys
+import time
+from pathlib import Path
+
+import cv2  # type: ignore
+import numpy as np
+
+sys.path.insert(0, str(Path(__file__).resolve().parent.parent))
+import pageinfo  # noqa: E402
+
+default_images_dir = Path(__file__).resolve().parent.parent / 'tests' / 'images'
+
+STAGES = {
+    'page': ('gray', 'margin', 'page.downsample', 'page.template_match', 'page.threshold_contours', 'page.contour_filter'),
+    'qp': ('qp.crop', 'qp.threshold_contours', 'qp.contour_filter'),
+}
+
+
+def _measure_stages(name, im, canonical_height):
+    """
+        pageinfo の計測シンクを使って、1 枚の画像の処理段階ごとの所要時間を集計する。
+    """
+    sink = pageinfo.AggregatingSink()
+    previous = pageinfo.set_instrumentation_sink(sink)
+    try:
+        _run_detector(name, im, canonical_height)
+    except pageinfo.PageInfoError:
+        pass
+    finally:
+        pageinfo.set_instrumentation_sink(previous)
+    return {stage: total for stage, (_, total, _) in sink.spans.items()}, sink.counters
+
+
+def _run_detector(name, im, canonical_height):
+    if name == 'page':
+        return pageinfo.guess_pageinfo(im, canonical_height=canonical_height)
+    return pageinfo.detect_qp_region(im, canonical_height=canonical_height)
+
+
+def percentile(values, p):
+    """
+        最近傍順位法によるパーセンタイル
+    """
+    ordered = sorted(values)
+    rank = max(1, math.ceil(p / 100 * len(ordered)))
+    return ordered[rank - 1]
+
+
+def summarize(values):
+    ms = [v * 1000 for v in values]
+    return {
+        'count': len(ms),
+        'mean': sum(ms) / len(ms),
+        'p50': percentile(ms, 50),
+        'p95': percentile(ms, 95),
+        'p99': percentile(ms, 99),
+    }
+
+
+def load_images(images_dir):
+    images = []
+    for entry in sorted(Path(images_dir).glob('**/*')):
+        if entry.suffix not in ('.png', '.jpg'):
+            continue
+        images.append((str(entry.relative_to(images_dir)), cv2.imread(str(entry))))
+    return images
+
+
+def run(args):
+    images = load_images(args.images_dir)
+    results = {}
+    for name in ('page', 'qp'):
+        latencies = []
+        stages = {stage: [] for stage in STAGES[name]}
+        errors = 0
+        started = time.perf_counter()
+        for _ in range(args.repeat):
+            for _, im in images:
+                start = time.perf_counter()
+                try:
+                    _run_detector(name, im, args.canonical_height)
+                except pageinfo.PageInfoError:
+                    errors += 1
+                latencies.append(time.perf_counter() - start)
+        elapsed = time.perf_counter() - started
+
+        for _ in range(args.repeat):
+            for _, im in images:
+                timings, _ = _measure_stages(name, im, args.canonical_height)
+                for stage in stages:
+                    stages[stage].append(timings.get(stage, 0.0))
+
+        results[name] = {
+            'throughput': len(latencies) / elapsed,
+            'errors': errors,
+            'total': summarize(latencies),
+            'stages': {stage: summarize(values) for stage, values in stages.items()},
+        }
+
+    return {
+        'meta': {
+            'timestamp': time.strftime('%Y-%m-%dT%H:%M:%S'),
+            'python': platform.python_version(),
+            'opencv': cv2.__version__,
+            'numpy': np.__version__,
+            'machine': platform.machine(),
+            'images': len(images),
+            'repeat': args.repeat,
+            'canonical_height': args.canonical_height,
+        },
+        'results': results,
+    }
+
+
+def print_report(report):
+    for name, result in report['results'].items():
+        print(f'== {name}: {result["throughput"]:.1f} images/s, errors {result["errors"]}')
+        print(f'{"":<24} {"mean":>8} {"p50":>8} {"p95":>8} {"p99":>8}  (ms)')
+        rows = [('total', result['total'])] + list(result['stages'].items())
+        for label, stats in rows:
+            print(f'{label:<24} {stats["mean"]:>8.3f} {stats["p50"]:>8.3f} {stats["p95"]:>8.3f} {stats["p99"]:>8.3f}')
+
+
+def compare(report, baseline, threshold):
+    """
+        ベースラインと比較し、threshold (%) を超えて遅くなった項目のリストを返す。
+        比較には外れ値の影響を受けにくい p50 を用いる。
+    """
+    regressions = []
+    for name, result in report['results'].items():
+        base_result = baseline['results'].get(name)
+        if base_result is None:
+            continue
+        rows = [('total', result['total'], base_result['total'])]
+        rows += [
+            (stage, stats, base_result['stages'][stage])
+            for stage, stats in result['stages'].items() if stage in base_result['stages']
+        ]
+        for label, stats, base_stats in rows:
+            if base_stats['p50'] <= 0:
+                continue
+            change = (stats['p50'] - base_stats['p50']) / base_stats['p50'] * 100
+            flag = 'REGRESSION' if change > threshold else ''
+            print(f'{name}/{label:<20} {base_stats["p50"]:>8.3f} -> {stats["p50"]:>8.3f} ms ({change:+6.1f}%) {flag}')
+            if flag:
+                regressions.append((name, label, change))
+    return regressions
+
+
+def main(args):
+    report = run(args)
+    print_report(report)
+
+    if args.output:
+        with open(args.output, 'w') as f:
+            json.dump(report, f, indent=2)
+
+    if args.compare:
+        with open(args.compare) as f:
+            baseline = json.load(f)
+        print(f'== compare with {args.compare} (threshold {args.threshold}%)')
+        if compare(report, baseline, args.threshold):
+            return 1
+    return 0
+
+
+def parse_args():
+    parser = argparse.ArgumentParser()
+    parser.add_argument('images_dir', nargs='?', default=str(default_images_dir))
+    parser.add_argument('-n', '--repeat', type=int, default=3, help='repeat count over the corpus [default: 3]')
+    parser.add_argument('-o', '--output', help='write the result as JSON')
+    parser.add_argument('--compare', metavar='BASELINE', help='compare with a JSON result written by -o')
+    parser.add_argument(
+        '--threshold',
+        type=float,
+        default=10.0,
+        help='regression threshold in percent of p50 latency [default: 10]',
+    )
+    parser.add_argument('--canonical-height', type=int, help='run the detectors with canonical_height')
+    return parser.parse_args()
+
+
+if __name__ == '__main__':
+    sys.exit(main(parse_args()))
@@ -0,0 +1,90 @@
+#!/usr/bin/env python3
+"""
+    detect_side_black_margin のマイクロベンチマーク。
+
+    列ごとに Python のリストを作って数えていた旧実装と、現行の NumPy 実装を
+    tests/images の画像で比較し、結果が一致することと所要時間を表示する。
+
+    usage: python benchmarks/bench_side_margin.py [-n REPEAT] [images_dir]
+"""
+import argparse
+import sys
+import timeit
+from pathlib import Path
+
+import cv2  # type: ignore
+
+sys.path.insert(0, str(Path(__file__).resolve().parent.parent))
+import pageinfo  # noqa: E402
+
+default_images_dir = Path(__file__).resolve().parent.parent / 'tests' / 'images'
+
+
+def legacy_detect_side_black_margin(im_gray):
+    """
+        ベクトル化前の実装 (比較用)
+    """
+    height, width = im_gray.shape[:2]
+    black_threshold = 10
+    black_ratio = 0.91
+
+    for i in range(width):
+        black_pixels = sum([pixel < black_threshold for pixel in im_gray[:, i]])
+        if black_pixels / height < black_ratio:
+            break
+
+    left_margin = i
+
+    for j in range(width):
+        black_pixels = sum([pixel < black_threshold for pixel in im_gray[:, width - j - 1]])
+        if black_pixels / height < black_ratio:
+            break
+
+    right_margin = j
+
+    if left_margin + right_margin >= width:
+        return 0, 0
+
+    return left_margin, right_margin
+
+
+def main(args):
+    images = []
+    for entry in sorted(Path(args.images_dir).glob('**/*')):
+        if entry.suffix not in ('.png', '.jpg'):
+            continue
+        im = cv2.imread(str(entry))
+        images.append((entry, cv2.cvtColor(im, cv2.COLOR_BGR2GRAY)))
+
+    legacy_total = 0.0
+    current_total = 0.0
+    mismatches = 0
+    print(f'{"image":<24} {"margin":>12} {"legacy(ms)":>11} {"numpy(ms)":>10} {"speedup":>8}')
+    for entry, im_gray in images:
+        expected = legacy_detect_side_black_margin(im_gray)
+        actual = pageinfo.detect_side_black_margin(im_gray)
+        if actual != expected:
+            mismatches += 1
+            print(f'MISMATCH {entry}: legacy={expected}, numpy={actual}')
+
+        legacy = timeit.timeit(lambda: legacy_detect_side_black_margin(im_gray), number=args.repeat) / args.repeat
+        current = timeit.timeit(lambda: pageinfo.detect_side_black_margin(im_gray), number=args.repeat) / args.repeat
+        legacy_total += legacy
+        current_total += current
+        name = str(entry.relative_to(args.images_dir))
+        print(f'{name:<24} {str(actual):>12} {legacy * 1000:>11.3f} {current * 1000:>10.3f} {legacy / current:>7.1f}x')
+
+    print(f'total: legacy {legacy_total * 1000:.1f} ms, numpy {current_total * 1000:.1f} ms, '
+          f'speedup {legacy_total / current_total:.1f}x, mismatches {mismatches}')
+    return 1 if mismatches else 0
+
+
+def parse_args():
+    parser = argparse.ArgumentParser()
+    parser.add_argument('images_dir', nargs='?', default=str(default_images_dir))
+    parser.add_argument('-n', '--repeat', type=int, default=3, help='repeat count per image [default: 3]')
+    return parser.parse_args()
+
+
+if __name__ == '__main__':
+    sys.exit(main(parse_args()))
@@ -0,0 +1,178 @@
+#!/usr/bin/env python3
+"""
+    pageinfo のコールドスタートにかかる時間を計測する。
+
+    - import pageinfo の所要時間 (python -X importtime の値)
+    - import 直後の最初の guess_pageinfo / detect_qp_region の所要時間
+      (cv2 の import とテンプレート画像の読み込みを含む) と2回目の所要時間
+    - CLI (python pageinfo.py page 画像) 1回分の実行時間
+
+    いずれも新しいインタプリタを起動して計測し、中央値を取る。
+    バイトコードは一時ディレクトリにキャッシュし、最初の1回は計測から除く。
+
+    -o で結果を JSON に保存し、--compare で保存済みの結果と比較する。
+    --threshold (%) を超えて遅くなった項目があるか、import の所要時間が
+    --budget-ms を超えた場合は終了コード 1 を返す。
+
+    usage:
+        python benchmarks/bench_startup.py -o startup.json
+        python benchmarks/bench_startup.py --compare startup.json --budget-ms 50
+"""
+import argparse
+import json
+import os
+import platform
+import statistics
+import subprocess
+import sys
+import tempfile
+import time
+from pathlib import Path
+
+basedir = Path(__file__).resolve().parent.parent
+default_image = basedir / 'tests' / 'images' / '000' / '004.png'
+
+FIRST_CALL_SCRIPT = '''
+import json, sys, time
+start = time.perf_counter()
+import pageinfo
+imported = time.perf_counter()
+with open(sys.argv[1], 'rb') as f:
+    data = f.read()
+timings = {'import': imported - start}
+for name, func in (('page', pageinfo.guess_pageinfo_from_bytes), ('qp', pageinfo.detect_qp_region_from_bytes)):
+    for label in ('first', 'second'):
+        start = time.perf_counter()
+        func(data)
+        timings[f'{name}_{label}_call'] = time.perf_counter() - start
+modules = [m for m in ('cv2', 'argparse', 'csv', 'asyncio', 'http.server', 'concurrent.futures') if m in sys.modules]
+print(json.dumps({'timings': timings, 'modules_after_calls': modules}))
+'''
+
+
+def _python(args, env):
+    return subprocess.run([sys.executable, *args], cwd=basedir, env=env, capture_output=True, text=True, check=True)
+
+
+def measure_importtime(env):
+    """
+        -X importtime の出力から pageinfo 自身と、pageinfo が import したモジュールの
+        累積時間 (秒) を得る。
+    """
+    stderr = _python(['-X', 'importtime', '-c', 'import pageinfo'], env).stderr
+    modules = {}
+    for line in stderr.splitlines():
+        if not line.startswith('import time:') or 'cumulative' in line:
+            continue
+        _, _, rest = line.partition(':')
+        _, cumulative, name = rest.split('|')
+        # 同じモジュールが2回出ることはないが、念のため大きい方を取る
+        name = name.strip()
+        modules[name] = max(modules.get(name, 0), int(cumulative) / 1e6)
+    return modules
+
+
+def run(args):
+    with tempfile.TemporaryDirectory() as pycache:
+        env = dict(os.environ)
+        env.pop('PYTHONDONTWRITEBYTECODE', None)
+        env['PYTHONPYCACHEPREFIX'] = pycache
+        # バイトコードを作っておく
+        _python(['-c', 'import pageinfo'], env)
+
+        imports = [measure_importtime(env) for _ in range(args.repeat)]
+        first_calls = [
+            json.loads(_python(['-c', FIRST_CALL_SCRIPT, str(args.image)], env).stdout) for _ in range(args.repeat)
+        ]
+        cli = []
+        for _ in range(args.repeat):
+            start = time.perf_counter()
+            _python(['pageinfo.py', 'page', str(args.image)], env)
+            cli.append(time.perf_counter() - start)
+
+    results = {'import_pageinfo': statistics.median(m['pageinfo'] for m in imports)}
+    for key in first_calls[0]['timings']:
+        results[key] = statistics.median(r['timings'][key] for r in first_calls)
+    results['cli_page'] = statistics.median(cli)
+
+    heaviest = sorted(
+        ((name, statistics.median(m.get(name, 0) for m in imports)) for name in imports[0] if name != 'pageinfo'),
+        key=lambda item: -item[1],
+    )[:args.top]
+    return {
+        'meta': {
+            'timestamp': time.strftime('%Y-%m-%dT%H:%M:%S'),
+            'python': platform.python_version(),
+            'machine': platform.machine(),
+            'repeat': args.repeat,
+            'image': os.path.relpath(args.image, basedir),
+        },
+        'results': {key: value * 1000 for key, value in results.items()},
+        'heaviest_imports': [(name, value * 1000) for name, value in heaviest],
+        'modules_after_calls': first_calls[0]['modules_after_calls'],
+    }
+
+
+def print_report(report):
+    print(f'== startup (median of {report["meta"]["repeat"]} runs, ms)')
+    for key, value in report['results'].items():
+        print(f'{key:<24} {value:>9.2f}')
+    print('== heaviest imports (cumulative, ms)')
+    for name, value in report['heaviest_imports']:
+        print(f'{name:<24} {value:>9.2f}')
+
+
+def compare(report, baseline, threshold):
+    regressions = []
+    for key, value in report['results'].items():
+        base_value = baseline['results'].get(key)
+        if not base_value:
+            continue
+        change = (value - base_value) / base_value * 100
+        flag = 'REGRESSION' if change > threshold else ''
+        print(f'{key:<24} {base_value:>9.2f} -> {value:>9.2f} ms ({change:+6.1f}%) {flag}')
+        if flag:
+            regressions.append((key, change))
+    return regressions
+
+
+def main(args):
+    report = run(args)
+    print_report(report)
+
+    if args.output:
+        with open(args.output, 'w') as f:
+            json.dump(report, f, indent=2)
+
+    failed = False
+    if args.budget_ms is not None and report['results']['import_pageinfo'] > args.budget_ms:
+        print(f'import pageinfo exceeds the budget: {report["results"]["import_pageinfo"]:.2f} > {args.budget_ms} ms')
+        failed = True
+    if args.compare:
+        with open(args.compare) as f:
+            baseline = json.load(f)
+        print(f'== compare with {args.compare} (threshold {args.threshold}%)')
+        if compare(report, baseline, args.threshold):
+            failed = True
+    return 1 if failed else 0
+
+
+def parse_args():
+    parser = argparse.ArgumentParser()
+    parser.add_argument('image', nargs='?', type=Path, default=default_image)
+    parser.add_argument('-n', '--repeat', type=int, default=5, help='number of interpreter launches [default: 5]')
+    parser.add_argument('--top', type=int, default=10, help='number of heaviest imports to show [default: 10]')
+    parser.add_argument('-o', '--output', help='write the result as JSON')
+    parser.add_argument('--compare', metavar='BASELINE', help='compare with a JSON result written by -o')
+    parser.add_argument(
+        '--threshold',
+        type=float,
+        default=20.0,
+        help='regression threshold in percent [default: 20]',
+    )
+    parser.add_argument('--budget-ms', type=float, help='fail if import pageinfo takes longer than this')
+    return parser.parse_args()
+
+
+if __name__ == '__main__':
+    sys.exit(main(parse_args()))
@@ -23,19 +23,59 @@
 # SOFTWARE OR THE USE OR OTHER DEALINGS IN THE SOFTWARE.
 #
 
-import argparse
-import csv
+# import するだけのライブラリ利用者や短命な CLI の起動を速くするため、
+# 重いモジュールと CLI でしか使わないモジュールは使う時点で import する。
+# 起動時間は benchmarks/bench_startup.py で計測できる。
+import atexit
+import collections
+import contextlib
 import enum
+import functools
+import importlib
+import itertools
+import json
 import logging
 import math
 import os
 import sys
-from pathlib import Path
+import threading
+import time
 
-import cv2  # type: ignore
+
+class _LazyModule:
+    """
+        最初に属性を参照したときに import するモジュールの代理。
+        import した時点でモジュールのグローバル変数 bind を本物のモジュールに
+        置き換えるので、以降の参照にはオーバーヘッドがない。
+    """
+    def __init__(self, name, bind):
+        self._name = name
+        self._bind = bind
+
+    def __getattr__(self, attr):
+        module = importlib.import_module(self._name)
+        globals()[self._bind] = module
+        return getattr(module, attr)
+
+
+cv2 = _LazyModule('cv2', 'cv2')
+np = _LazyModule('numpy', 'np')
 
 logger = logging.getLogger(__name__)
-pageinfo_basedir = Path(__file__).parent
+
+
+def __getattr__(name):
+    if name == 'pageinfo_basedir':
+        from pathlib import Path
+        return Path(__file__).parent
+    if name == 'PageInfoHTTPServer':
+        return _http_server_class()
+    raise AttributeError(f'module {__name__!r} has no attribute {name!r}')
+
+
+# cv2.IMREAD_COLOR, cv2.IMREAD_GRAYSCALE と同じ値。cv2 を import せずに引数の既定値に使う。
+_IMREAD_COLOR = 1
+_IMREAD_GRAYSCALE = 0
 
 NOSCROLL_PAGE_INFO = (1, 1, 0)
 
@@ -51,6 +91,30 @@ SCRB_TOO_THIN = 8   # 領域の横幅が細すぎる
 GS_TYPE_1 = 1   # 旧画面
 GS_TYPE_2 = 2   # wide screen 対応画面。戦利品ウィンドウの位置が上にシフトした
 
+# スクロールバー検出時の二値化の閾値。
+# 高めにするとスクロールバー本体の領域を検出できる。低めにするとスクロールバー可能領域を検出できる。
+SCROLLBAR_BINARY_THRESHOLD = 65
+
+# data/pageinfo/next.png は crop 後の高さが 750px の画像から切り出したもの
+NEXT_BUTTON_REFERENCE_HEIGHT = 750
+# "次へ" ボタンを探す範囲 (crop 後の画像の下から何割か)
+NEXT_BUTTON_SEARCH_BAND = 0.3
+# 下部の帯でこのスコア以上で照合できれば全域の照合を省略する
+NEXT_BUTTON_ACCEPT_SCORE = 0.8
+
+# canonical_height を指定する場合の推奨値。tests/images の全画像で結果が変わらないことを確認済み。
+DEFAULT_CANONICAL_HEIGHT = 750
+
+# ほぼ同一の画像の判定に用いる縮小画像の大きさ (幅, 高さ)
+NEAR_DUPLICATE_SCROLLBAR_SIZE = (16, 64)
+NEAR_DUPLICATE_QP_SIZE = (32, 24)
+# スクロールバー判定用の切り出し画像のうち、ステータスバーの違いを無視するために除く上端の割合
+NEAR_DUPLICATE_TOP_SKIP = 0.06
+# 縮小画像の画素値の差の最大値がこれ以下ならほぼ同一とみなす。
+# tests/images では JPEG での再エンコード、縮小、ステータスバーの書き換えで最大 20、
+# 結果の異なる画像どうしでは最小 165 だった。
+DEFAULT_NEAR_DUPLICATE_THRESHOLD = 32
+
 
 class QPDetectionMode(enum.Enum):
     JP = 'jp'
@@ -76,13 +140,196 @@ class UnsupportedGamescreenTypeError(PageInfoError):
     pass
 
 
+class ImageDecodeError(PageInfoError):
+    pass
+
+
+SCRB_REASON_NAMES = {
+    SCRB_LIKELY_SCROLLBAR: 'likely_scrollbar',
+    SCRB_TOO_SMALL: 'too_small',
+    SCRB_TOO_THICK: 'too_thick',
+    SCRB_TOO_FAR_FROM_CENTER: 'too_far_from_center',
+    SCRB_TOO_MANY_VERTICES: 'too_many_vertices',
+    SCRB_TOO_FAR_FROM_LEFT_EDGE: 'too_far_from_left_edge',
+    SCRB_TOO_CLOSE_TO_LEFT_EDGE: 'too_close_to_left_edge',
+    SCRB_TOO_THIN: 'too_thin',
+}
+
+
+class InstrumentationSink:
+    """
+        検出処理の計測値を受け取るシンクの基底クラス。何もしない。
+
+        begin は処理段階の開始時に名前を、span は終了時に名前と所要時間 (秒) を、
+        count はカウンタの名前と増分を受け取る。処理段階は入れ子になることがある。
+        set_instrumentation_sink で登録する。
+        登録されたシンクはプロセス全体で共有されるので、複数スレッドから
+        検出処理を呼ぶ場合はシンク側で排他制御すること。
+    """
+    def begin(self, name):
+        pass
+
+    def span(self, name, elapsed):
+        pass
+
+    def count(self, name, value=1):
+        pass
+
+
+class AggregatingSink(InstrumentationSink):
+    """
+        計測値を集計するだけのシンク。
+
+        spans は 名前 -> [回数, 合計時間, 最大時間]、counters は 名前 -> 合計値。
+    """
+    def __init__(self):
+        self.spans = {}
+        self.counters = {}
+
+    def span(self, name, elapsed):
+        stats = self.spans.get(name)
+        if stats is None:
+            self.spans[name] = [1, elapsed, elapsed]
+        else:
+            stats[0] += 1
+            stats[1] += elapsed
+            stats[2] = max(stats[2], elapsed)
+
+    def count(self, name, value=1):
+        self.counters[name] = self.counters.get(name, 0) + value
+
+
+class ProfilingSink(AggregatingSink):
+    """
+        AggregatingSink の集計に加えて、処理段階ごとのメモリ使用量のピーク (バイト) を
+        peaks に、全体のピークを peak に記録するシンク。
+
+        tracemalloc で計測するので、tracemalloc.start() してから使う。
+        計測できるのは Python 側の確保 (numpy 配列や OpenCV が返す配列を含む) だけで、
+        OpenCV の関数内部で一時的に確保されるバッファは含まれない。
+        ピークは直前の tracemalloc.clear_traces() 以降に確保されたメモリ量に対する値。
+        Python 3.8 では tracemalloc.reset_peak() がないため処理段階ごとのピークは記録しない。
+    """
+    def __init__(self):
+        super().__init__()
+        self.peaks = {}
+        self.peak = 0
+        self._stack = []
+
+    def _fold_peak(self):
+        import tracemalloc
+        _, peak = tracemalloc.get_traced_memory()
+        tracemalloc.reset_peak()
+        self.peak = max(self.peak, peak)
+        if self._stack:
+            self._stack[-1] = max(self._stack[-1], peak)
+
+    def begin(self, name):
+        import tracemalloc
+        if not hasattr(tracemalloc, 'reset_peak'):
+            return
+        # 外側の処理段階のピークを取りこぼさないよう、リセット前の値を畳み込んでおく
+        self._fold_peak()
+        self._stack.append(0)
+
+    def span(self, name, elapsed):
+        super().span(name, elapsed)
+        if not self._stack:
+            return
+        self._fold_peak()
+        peak = self._stack.pop()
+        if self._stack:
+            self._stack[-1] = max(self._stack[-1], peak)
+        self.peaks[name] = max(self.peaks.get(name, 0), peak)
+
+
+_instrumentation_sink = None
+
+
+def set_instrumentation_sink(sink):
+    """
+        計測値の送り先を登録し、それまで登録されていたシンクを返す。
+        None を渡すと計測を止める (既定の状態)。
+    """
+    global _instrumentation_sink
+    previous = _instrumentation_sink
+    _instrumentation_sink = sink
+    return previous
+
+
+def get_instrumentation_sink():
+    return _instrumentation_sink
+
+
+class _Span:
+    __slots__ = ('sink', 'name', 'start')
+
+    def __init__(self, sink, name):
+        self.sink = sink
+        self.name = name
+
+    def __enter__(self):
+        self.sink.begin(self.name)
+        self.start = time.perf_counter()
+        return self
+
+    def __exit__(self, *exc_info):
+        self.sink.span(self.name, time.perf_counter() - self.start)
+        return False
+
+
+_NULL_SPAN = contextlib.nullcontext()
+
+
+def _span(name):
+    """
+        with 文で囲んだ処理の所要時間をシンクに送る。
+        シンクが登録されていなければ何もしない。
+    """
+    sink = _instrumentation_sink
+    if sink is None:
+        return _NULL_SPAN
+    return _Span(sink, name)
+
+
+def _count(name, value=1):
+    sink = _instrumentation_sink
+    if sink is not None:
+        sink.count(name, value)
+
+
+def _find_first_non_black_column(im_gray, black_threshold, black_ratio):
+    """
+        左端から列を走査し、黒とみなせない最初の列のインデックスを返す。
+        すべての列が黒の場合は最後の列のインデックスを返す。
+
+        列ごとの黒ピクセル数は NumPy でまとめて集計する。余白は通常画像の端に
+        わずかしかないため、端から倍々に広げたブロック単位で調べ、見つかった
+        時点で打ち切る。
+    """
+    height, width = im_gray.shape[:2]
+    start = 0
+    block_width = 16
+    while start < width:
+        block = im_gray[:, start:start + block_width]
+        black_pixels = np.count_nonzero(block < black_threshold, axis=0)
+        # 判定式は従来の black_pixels / height < black_ratio と同一にしておく。
+        # (比較の向きや丸め方を変えると境界上の列で結果が変わりうる)
+        hits = np.flatnonzero(black_pixels / height < black_ratio)
+        if hits.size > 0:
+            return start + int(hits[0])
+        start += block_width
+        block_width *= 2
+    return width - 1
+
+
 def detect_side_black_margin(im_gray):
     """
         画像の左右にある黒領域を検出する。
         それぞれの幅サイズを (右幅, 左幅) のタプルで返す。
         余白がなければ (0, 0) を返す。
     """
-    height, width = im_gray.shape[:2]
+    width = im_gray.shape[1]
     # 黒とみなす範囲: 0 に近いほど許容範囲が小さい
     black_threshold = 10
     # タップの軌跡なノイズが混入する可能性もあるので 9 % まではイレギュラーを許容する
@@ -91,19 +338,9 @@ def detect_side_black_margin(im_gray):
     # 問題が生じた。許容範囲をより厳しくすることでこの問題に対処する。
     black_ratio = 0.91
 
-    for i in range(width):
-        black_pixels = sum([pixel < black_threshold for pixel in im_gray[:, i]])
-        if black_pixels / height < black_ratio:
-            break
-
-    left_margin = i
-
-    for j in range(width):
-        black_pixels = sum([pixel < black_threshold for pixel in im_gray[:, width - j - 1]])
-        if black_pixels / height < black_ratio:
-            break
-
-    right_margin = j
+    left_margin = _find_first_non_black_column(im_gray, black_threshold, black_ratio)
+    # 左右反転したビューを渡せば右端からの走査になる (コピーは発生しない)
+    right_margin = _find_first_non_black_column(im_gray[:, ::-1], black_threshold, black_ratio)
 
     # 真っ黒画像の場合はマージンなしとする
     if left_margin + right_margin >= width:
@@ -153,7 +390,8 @@ def filter_contour_qp(contour, im):
     return True
 
 
-def detect_qp_region(im, mode=QPDetectionMode.JP.value, debug_draw_image=False, debug_image_name=None):
+def detect_qp_region(im, mode=QPDetectionMode.JP.value, debug_draw_image=False, debug_image_name=None, canonical_height=None,
+                     debug_predicate=None, near_duplicates=None):
     """
         "所持 QP" 領域を検出し、その座標を返す。
 
@@ -161,84 +399,13 @@ def detect_qp_region(im, mode=QPDetectionMode.JP.value, debug_draw_image=False,
         つまり ((topleft_x, topleft_y), (bottomright_x, bottomright_y))
         領域が検出されなかった場合は None を返す。
         複数箇所が検出された場合は TooManyAreasDetectedError が発生する。
+
+        im はカラー (BGR) 画像とグレースケール画像のどちらでもよい。
+        im は変更されない。
+        canonical_height, debug_predicate, near_duplicates については ScreenAnalysis を参照。
     """
-    # 縦横2分割して4領域に分け、左下の領域だけ使う。
-    # QP の領域を調べたいならそれで十分。
-    im_h, im_w = im.shape[:2]
-    # まれにスクリーンショット左端に余白が入ることがある。
-    # おそらく Android の機種や状況に依存？ この状態で左右を等分すると
-    # 中心が左にずれて QP 領域の囲みが見切れてしまい検出に失敗する。
-    # これを考慮し、切る位置をやや右にずらす。
-    cropped = im[int(im_h/2):im_h, 0:int(im_w/1.93)]
-    cr_h, cr_w = cropped.shape[:2]
-    logger.debug('cropped image size (for qp): (width, height) = (%s, %s)', cr_w, cr_h)
-    im_gray = cv2.cvtColor(cropped, cv2.COLOR_BGR2GRAY)
-    binary_threshold = 50
-    _, th1 = cv2.threshold(im_gray, binary_threshold, 255, cv2.THRESH_BINARY)
-    contours, _ = cv2.findContours(th1, cv2.RETR_EXTERNAL, cv2.CHAIN_APPROX_SIMPLE)
-
-    filtered_contours = [c for c in contours if filter_contour_qp(c, im_gray)]
-    candidate = None
-
-    for contour in filtered_contours:
-        logger.debug('detected areas: %s', cv2.boundingRect(contour))
-
-    if len(filtered_contours) == 1:
-        qp_region = filtered_contours[0]
-        x, y, w, h = cv2.boundingRect(qp_region)
-
-        wh_rate = w / h
-
-        # 左右の無駄領域を除外するためのマージン。
-        #
-        # The position of the QP values in the NA version of the screenshot is
-        # slightly more to the right than in the JP version. This makes it
-        # difficult to apply the same cut position to both types of screenshots.
-        if mode == QPDetectionMode.NA.value:
-            # The values below are optimized for NA's new game screen layout.
-            # Old layout screenshots can also be applied, but may not cut well.
-            left_margin = 0.45
-            right_margin = 0.02
-        else:
-            # イベントで所持 QP 枠が狭くなる場合、カットする領域を狭める必要がある。
-            if wh_rate < 9:
-                left_margin = 0.45
-                right_margin = 0.04
-            else:
-                # 感覚的な値ではあるが 左 42%, 右 4% を除外。
-                # 落とし穴として、2019年5月末 ～ 9月の間に所持 QP の出力位置が微妙に変わっている。
-                # ここではそのどちらのケースでも対応できるよう枠を広めに取っている。
-                # 現仕様に最適化して切り詰めすぎると困ったことになるため注意。
-                left_margin = 0.42
-                right_margin = 0.04
-
-        topleft = (x + int(w*left_margin), y)
-        bottomright = (topleft[0] + w - int(w*left_margin) - int(w*right_margin), y + h)
-
-        if debug_draw_image:
-            cv2.rectangle(cropped, topleft, bottomright, (0, 0, 255), 3)
-
-        # 呼び出し側に返すのは分割前の座標でないといけない。
-        # よって、事前に切り捨てた左上領域の y 座標をここで補正する。
-        # x 座標は分割の影響を受けていないので補正不要。
-        above_height = int(im_h/2)
-        corrected_topleft = (topleft[0], topleft[1] + above_height)
-        corrected_bottomright = (bottomright[0], bottomright[1] + above_height)
-        candidate = (corrected_topleft, corrected_bottomright)
-
-    if debug_draw_image:
-        cv2.drawContours(cropped, filtered_contours, -1, (0, 255, 0), 3)
-        # 以下はどうしてもデバッグ目的で輪郭検出の状況を知りたい場合のみ有効にする。
-        # 通常はコメントアウトしておく。
-        # cv2.drawContours(cropped, contours, -1, (0, 255, 255), 3)
-        logger.debug('writing debug image: %s', debug_image_name)
-        cv2.imwrite(debug_image_name, cropped)
-
-    if len(filtered_contours) > 1:
-        n = len(filtered_contours)
-        raise TooManyAreasDetectedError(f'{n} actual qp regions detected')
-
-    return candidate
+    analysis = ScreenAnalysis(im, canonical_height=canonical_height, near_duplicates=near_duplicates)
+    return analysis.detect_qp_region(mode, debug_draw_image, debug_image_name, debug_predicate)
 
 
 def guess_pages(actual_height, entire_height, cap_height):
@@ -394,6 +561,7 @@ def _filter_contour_scrollbar(contour, im_height, im_width):
     if len(contour) > 150:
         # 背景の影響でジャギーなラインになってしまうケースがあるため、シンプルな形状に近似する
         epsilon = 0.01 * cv2.arcLength(contour, True)
+        _count('page.approx_poly_dp')
         approx = cv2.approxPolyDP(contour, epsilon, True)
         if len(approx) > 50:
             logger.debug("NG: too many vertices: %s", len(approx))
@@ -403,75 +571,574 @@ def _filter_contour_scrollbar(contour, im_height, im_width):
     return SCRB_LIKELY_SCROLLBAR
 
 
-def _detect_scrollbar_region(im, binary_threshold):
-    _, th1 = cv2.threshold(im, binary_threshold, 255, cv2.THRESH_BINARY)
-    contours, _ = cv2.findContours(th1, cv2.RETR_EXTERNAL, cv2.CHAIN_APPROX_SIMPLE)
-    im_height, im_width = im.shape[:2]
+def _downsample(im, factor):
+    """
+        画像を 1/factor (整数) に縮小する。
+
+        縮小率が整数であれば INTER_AREA の高速な経路が使われるので、
+        割り切れない端の数ピクセルは切り捨ててから縮小する。
+    """
+    h, w = im.shape[:2]
+    h2, w2 = h // factor, w // factor
+    return cv2.resize(im[:h2 * factor, :w2 * factor], (w2, h2), interpolation=cv2.INTER_AREA)
+
+
+def _downsample_binary(binary, factor, min_coverage):
+    """
+        二値画像を 1/factor に縮小する。
+        縮小後の各ピクセルは、元の領域のうち min_coverage 以上の割合が白なら白とする。
+
+        グレースケールのまま縮小してから二値化すると、境界がぼけて領域の大きさが
+        変わってしまう。元の解像度で二値化してから縮小することでこれを避ける。
+    """
+    resized = _downsample(binary, factor)
+    _, resized = cv2.threshold(resized, int(255 * min_coverage), 255, cv2.THRESH_BINARY)
+    return resized
+
+
+def _detect_scrollbar_region(im, binary_threshold, factor=1, rejected=None):
+    with _span('page.threshold_contours'):
+        _, th1 = cv2.threshold(im, binary_threshold, 255, cv2.THRESH_BINARY)
+        if factor > 1:
+            th1 = _downsample_binary(th1, factor, 0.5)
+        contours, _ = cv2.findContours(th1, cv2.RETR_EXTERNAL, cv2.CHAIN_APPROX_SIMPLE)
+    im_height, im_width = th1.shape[:2]
+    _count('page.contours', len(contours))
 
     scrollbar = []
     not_scrollbar = []
 
-    for c in contours:
-        result = _filter_contour_scrollbar(c, im_height, im_width)
-        if result == SCRB_LIKELY_SCROLLBAR:
-            scrollbar.append(c)
-        elif result == SCRB_TOO_THICK:
-            not_scrollbar.append(c)
+    with _span('page.contour_filter'):
+        for c in contours:
+            result = _filter_contour_scrollbar(c, im_height, im_width)
+            if result == SCRB_LIKELY_SCROLLBAR:
+                scrollbar.append(c)
+            else:
+                _count('page.rejected.' + SCRB_REASON_NAMES[result])
+                if rejected is not None:
+                    rejected[SCRB_REASON_NAMES[result]].append(c)
+                if result == SCRB_TOO_THICK:
+                    not_scrollbar.append(c)
+    _count('page.candidates', len(scrollbar))
     return scrollbar, not_scrollbar
 
 
-def get_gamescreen_type(im_cropped, button):
+def _read_asset(*parts):
+    """
+        pageinfo.py と同じ場所に置かれたデータファイルを bytes で読み込む。
+        zipapp などに同梱された場合でも読めるよう、可能であればモジュールの
+        loader を経由する。
+    """
+    path = os.path.join(os.path.dirname(os.path.abspath(__file__)), *parts)
+    loader = globals().get('__loader__')
+    if loader is not None and hasattr(loader, 'get_data'):
+        return loader.get_data(path)
+    with open(path, 'rb') as f:
+        return f.read()
+
+
+@functools.lru_cache(maxsize=None)
+def _load_next_button_template():
+    """
+        "次へ" ボタンのテンプレート画像 (グレースケール) を返す。
+        読み込みはプロセスあたり初回の1度だけ行う。
+    """
+    data = _read_asset("data", "pageinfo", "next.png")
+    im = cv2.imdecode(np.frombuffer(data, dtype=np.uint8), cv2.IMREAD_COLOR)
+    if im is None:
+        raise PageInfoError("cannot decode next button template")
+    im_gray = cv2.cvtColor(im, cv2.COLOR_BGR2GRAY)
+    im_gray.flags.writeable = False
+    return im_gray
+
+
+@functools.lru_cache(maxsize=16)
+def _get_next_button_template(im_height):
+    """
+        crop 後の画像の高さに合わせて拡大縮小した "次へ" ボタンのテンプレートを返す。
+        端末ごとに解像度は限られるので、高さをキーにキャッシュしておく。
+    """
+    button = _load_next_button_template()
+    scale = im_height / NEXT_BUTTON_REFERENCE_HEIGHT
+    b_h, b_w = button.shape[:2]
+    size = (max(1, round(b_w * scale)), max(1, round(b_h * scale)))
+    if size == (b_w, b_h):
+        return button
+    interpolation = cv2.INTER_AREA if scale < 1 else cv2.INTER_LINEAR
+    scaled = cv2.resize(button, size, interpolation=interpolation)
+    scaled.flags.writeable = False
+    return scaled
+
+
+def _locate_next_button(im_cropped, button):
+    """
+        "次へ" ボタンを探し、(スコア, (x, y)) を返す。
+        照合できない場合 (画像がテンプレートより小さい等) は None を返す。
+    """
     try:
         res = cv2.matchTemplate(im_cropped, button, cv2.TM_CCOEFF_NORMED)
     except cv2.error:
-        # 次へボタンが検出できない場合は新画面であると仮定する。
-        # アプリの用途から考えて、旧画面の画像が投入される可能性はきわめてまれ。
-        return GS_TYPE_2
+        return None
 
-    _, _, _, coord = cv2.minMaxLoc(res)
-    logger.debug("next button: (top, left) = %s", coord)
-    y = coord[1]
-    button_bottom_pos = y + button.shape[0]
-    im_height = im_cropped.shape[0]
+    _, score, _, coord = cv2.minMaxLoc(res)
+    logger.debug("next button: (top, left) = %s, score = %s", coord, score)
+    return score, coord
+
+
+def _gamescreen_type_from_button(im_height, button_y, button_height):
+    button_bottom_pos = button_y + button_height
     button_space_height = im_height - button_bottom_pos
 
     bottom_space_ratio = button_space_height / im_height
     logger.debug("buttom space ratio: %s", bottom_space_ratio)
 
     # "次へ" ボタンの下の空間が大きければ新画面
-    if bottom_space_ratio < 0.05:
+    # NOTE: テンプレートを等倍のまま照合していたときは 0.05 を閾値としていた。
+    # 解像度に合わせて拡大縮小するようになってから、旧画面は 0.005-0.008,
+    # 新画面は 0.05-0.065 程度に分かれるようになったため、その中間を閾値とする。
+    if bottom_space_ratio < 0.03:
         return GS_TYPE_1
     return GS_TYPE_2
 
 
+def _detect_gamescreen_type(im_cropped, button=None):
+    """
+        get_gamescreen_type と同じ判定を行い、(種類, ボタン位置, スコア) を返す。
+        ボタンが照合できなかった場合、位置とスコアは None になる。
+    """
+    if button is None:
+        button = _get_next_button_template(im_cropped.shape[0])
+
+    # ボタンは画面下部にしか現れないので、まず下部の帯だけを照合する。
+    # 十分なスコアが得られなかった場合のみ全域を照合する。
+    im_height = im_cropped.shape[0]
+    band_top = int(im_height * (1 - NEXT_BUTTON_SEARCH_BAND))
+    located = _locate_next_button(im_cropped[band_top:], button)
+    if located is not None and located[0] >= NEXT_BUTTON_ACCEPT_SCORE:
+        score, (x, y) = located
+        located = score, (x, y + band_top)
+    else:
+        logger.debug('next button not found in the bottom band, falling back to full search')
+        _count('page.template_match.full_search')
+        located = _locate_next_button(im_cropped, button)
+
+    if located is None:
+        # 次へボタンが検出できない場合は新画面であると仮定する。
+        # アプリの用途から考えて、旧画面の画像が投入される可能性はきわめてまれ。
+        return GS_TYPE_2, None, None
+
+    score, coord = located
+    gamescreen_type = _gamescreen_type_from_button(im_cropped.shape[0], coord[1], button.shape[0])
+    return gamescreen_type, coord, score
+
+
+def get_gamescreen_type(im_cropped, button=None):
+    """
+        "次へ" ボタンの位置から画面レイアウトの種類を判定する。
+
+        button を省略した場合は im_cropped の高さに合わせて拡大縮小した
+        テンプレートを用いる。
+    """
+    gamescreen_type, _, _ = _detect_gamescreen_type(im_cropped, button)
+    return gamescreen_type
+
+
+class LayoutCache:
+    """
+        端末ごとのレイアウト情報のキャッシュ。
+
+        同じ端末のスクリーンショットは解像度も左右の余白も画面レイアウトも同じなので、
+        (高さ, 幅, 左余白, 右余白) をキーとして切り出し領域と画面レイアウトの種類を
+        覚えておき、"次へ" ボタンの全域照合を省略する。左右の余白の検出は十分安いので、
+        毎回計算してキーの一部として使う。
+
+        ボタンが見つからない、または照合スコアが min_score に満たない端末は、
+        検証に使えるボタン位置を持たない "常に再照合" のレイアウト (rematch が真) として覚える。
+
+        path を指定した場合は JSON ファイルから読み込み、新しいレイアウトを
+        覚えるたびに書き戻す。内容が変わらない場合は書き戻さない。書き戻す際は
+        既存の内容とマージするため、複数のプロセスで同じファイルを共有しても
+        内容が壊れることはない。
+    """
+    # キャッシュしたレイアウトの検証時に要求する最低限の照合スコア。
+    # これを下回るようなレイアウトは毎回全域を照合する。
+    min_score = 0.7
+
+    def __init__(self, path=None, maxsize=256):
+        self.path = path
+        self.maxsize = maxsize
+        self.entries = collections.OrderedDict()
+        self.hits = 0
+        self.misses = 0
+        if path is not None and os.path.exists(path):
+            self.entries.update(self._read(path))
+
+    @staticmethod
+    def _read(path):
+        with open(path, encoding='utf-8') as f:
+            return json.load(f)
+
+    @staticmethod
+    def make_key(im_height, im_width, side_margins):
+        return f'{im_height}x{im_width}:{side_margins[0]},{side_margins[1]}'
+
+    def get(self, key):
+        layout = self.entries.get(key)
+        if layout is not None:
+            self.entries.move_to_end(key)
+        return layout
+
+    def put(self, key, layout):
+        changed = self.entries.get(key) != layout
+        self.entries[key] = layout
+        self.entries.move_to_end(key)
+        while len(self.entries) > self.maxsize:
+            self.entries.popitem(last=False)
+        if changed and self.path is not None:
+            self.save()
+
+    def save(self, path=None):
+        path = path or self.path
+        if path is None:
+            raise ValueError('no path given for the layout cache')
+        merged = collections.OrderedDict()
+        if os.path.exists(path):
+            try:
+                merged.update(self._read(path))
+            except (OSError, ValueError) as e:
+                logger.warning('cannot read layout cache: %s (%s)', path, e)
+        merged.update(self.entries)
+        tmp = f'{path}.{os.getpid()}.tmp'
+        with open(tmp, 'w', encoding='utf-8') as f:
+            json.dump(merged, f, indent=1)
+        os.replace(tmp, path)
+
+
+@functools.lru_cache(maxsize=None)
+def get_layout_cache(path=None):
+    """
+        path に対応する LayoutCache を返す。同じプロセス内では同じオブジェクトを使い回す。
+    """
+    return LayoutCache(path)
+
+
+def _thumbnail_fingerprint(im_gray, size):
+    """
+        ほぼ同一の画像の判定に用いる指紋 (縦横比, 縮小画像) を返す。
+    """
+    h, w = im_gray.shape[:2]
+    thumbnail = cv2.resize(im_gray, size, interpolation=cv2.INTER_AREA).astype(np.int16)
+    return w / h, thumbnail
+
+
+NearDuplicateMatch = collections.namedtuple('NearDuplicateMatch', 'result distance')
+
+
+class NearDuplicateIndex:
+    """
+        ほぼ同一のスクリーンショットの判定結果を使い回すための索引。
+
+        同じドロップ画面が再エンコードや縮小をされたり、ステータスバーだけが
+        異なる状態で何度も送られてくることがある。ScreenAnalysis の near_duplicates に
+        渡すと、スクロールバー判定用と QP 判定用の切り出し画像の縮小版
+        (_thumbnail_fingerprint) を指紋として、指紋の画素値の差の最大値が
+        threshold 以下の画像を以前に判定していればその結果を返す。
+
+        指紋はキー (判定の種類と引数) ごとに新しいものから maxsize 件まで覚える。
+        ページ情報は縦横比が max_aspect_difference 以内なら大きさの異なる画像でも
+        使い回すが、QP 領域は座標を返すので画像の大きさが同じ場合に限る。
+
+        プロセスプールに渡すと、各ワーカーでは get_near_duplicate_index による
+        同じ設定のプロセスごとの索引になる。
+    """
+    max_aspect_difference = 0.02
+
+    def __init__(self, threshold=DEFAULT_NEAR_DUPLICATE_THRESHOLD, maxsize=256):
+        self.threshold = threshold
+        self.maxsize = maxsize
+        self.entries = {}
+        self.hits = 0
+        self.misses = 0
+        self._lock = threading.Lock()
+
+    def __reduce__(self):
+        return get_near_duplicate_index, (self.threshold, self.maxsize)
+
+    def lookup(self, key, fingerprint):
+        """
+            指紋が近い画像の結果を NearDuplicateMatch で返す。なければ None を返す。
+        """
+        aspect, thumbnail = fingerprint
+        with self._lock:
+            candidates = list(self.entries.get(key, ()))
+        for other_aspect, other_thumbnail, result in reversed(candidates):
+            if abs(aspect - other_aspect) > aspect * self.max_aspect_difference:
+                continue
+            distance = int(np.abs(thumbnail - other_thumbnail).max())
+            if distance <= self.threshold:
+                with self._lock:
+                    self.hits += 1
+                _count('near_duplicate.hit')
+                return NearDuplicateMatch(result, distance)
+        with self._lock:
+            self.misses += 1
+        _count('near_duplicate.miss')
+        return None
+
+    def add(self, key, fingerprint, result):
+        with self._lock:
+            entries = self.entries.get(key)
+            if entries is None:
+                entries = self.entries[key] = collections.deque(maxlen=self.maxsize)
+            entries.append((*fingerprint, result))
+
+
+@functools.lru_cache(maxsize=None)
+def get_near_duplicate_index(threshold=DEFAULT_NEAR_DUPLICATE_THRESHOLD, maxsize=256):
+    """
+        threshold と maxsize に対応する NearDuplicateIndex を返す。同じプロセス内では同じオブジェクトを使い回す。
+    """
+    return NearDuplicateIndex(threshold, maxsize)
+
+
+def _verify_cached_gamescreen_type(im_cropped, layout):
+    """
+        キャッシュしたボタン位置の周辺だけを照合して、レイアウトが変わっていないか確かめる。
+        確かめられた場合は画面レイアウトの種類を、そうでなければ None を返す。
+    """
+    if layout.get('rematch') or layout.get('button_location') is None:
+        return None
+    cached_score = layout['button_score']
+    if cached_score < LayoutCache.min_score:
+        return None
+
+    button = _get_next_button_template(im_cropped.shape[0])
+    b_h, b_w = button.shape[:2]
+    x, y = layout['button_location']
+    pad = max(4, b_h // 4)
+    top = max(0, y - pad)
+    left = max(0, x - pad)
+    located = _locate_next_button(im_cropped[top:y + b_h + pad, left:x + b_w + pad], button)
+    if located is None:
+        return None
+    score, coord = located
+    if score < max(LayoutCache.min_score, cached_score - 0.05):
+        logger.debug('cached layout rejected: score %s < %s', score, cached_score)
+        return None
+    return _gamescreen_type_from_button(im_cropped.shape[0], top + coord[1], b_h)
+
+
+def _imwrite_params(filename, quality):
+    """
+        書き出す画像の形式に応じて、quality を cv2.imwrite のパラメータに変換する。
+        PNG では圧縮レベル (0-9)、JPEG と WebP では品質 (0-100) として扱う。
+    """
+    if quality is None:
+        return []
+    ext = os.path.splitext(filename)[1].lower()
+    if ext == '.png':
+        return [cv2.IMWRITE_PNG_COMPRESSION, quality]
+    if ext in ('.jpg', '.jpeg'):
+        return [cv2.IMWRITE_JPEG_QUALITY, quality]
+    if ext == '.webp':
+        return [cv2.IMWRITE_WEBP_QUALITY, quality]
+    return []
+
+
+class DebugImageWriter:
+    """
+        デバッグ画像のエンコードと書き出しをバックグラウンドのスレッドで行う。
+
+        write() は画像のコピーをキューに積んで直ちに戻る。キューが maxsize 件で
+        埋まっている場合は空きができるまで待つ。quality については _imwrite_params を参照。
+        close() (またはインタプリタの終了時) にキューに残った画像をすべて書き出す。
+        書き出しに失敗した場合は警告をログに出力するだけで、例外は送出しない。
+    """
+    def __init__(self, maxsize=16, quality=None):
+        import queue
+        self.quality = quality
+        self.queue = queue.Queue(maxsize)
+        self.closed = False
+        self.thread = threading.Thread(target=self._run, name='debug-image-writer', daemon=True)
+        self.thread.start()
+        atexit.register(self.close)
+
+    def write(self, filename, im):
+        if self.closed:
+            raise ValueError('write to closed DebugImageWriter')
+        # 呼び出し側は書き出し後も同じ画像に描画を続けるのでコピーを渡す
+        self.queue.put((filename, im.copy()))
+
+    def _run(self):
+        while True:
+            item = self.queue.get()
+            try:
+                if item is None:
+                    return
+                filename, im = item
+                if not cv2.imwrite(filename, im, _imwrite_params(filename, self.quality)):
+                    logger.warning('failed to write debug image: %s', filename)
+            except Exception as e:
+                logger.warning('failed to write debug image: %s (%s)', item[0], e)
+            finally:
+                self.queue.task_done()
+
+    def flush(self):
+        """
+            キューに積まれた画像がすべて書き出されるまで待つ。
+        """
+        self.queue.join()
+
+    def close(self):
+        if self.closed:
+            return
+        self.closed = True
+        self.queue.put(None)
+        self.thread.join()
+        atexit.unregister(self.close)
+
+    def __enter__(self):
+        return self
+
+    def __exit__(self, *exc_info):
+        self.close()
+        return False
+
+
+_debug_image_writer = None
+
+
+def set_debug_image_writer(writer):
+    """
+        デバッグ画像の書き出しに使う DebugImageWriter を登録し、
+        それまで登録されていたものを返す。
+        None (既定) の場合はその場で cv2.imwrite する。
+    """
+    global _debug_image_writer
+    previous = _debug_image_writer
+    _debug_image_writer = writer
+    return previous
+
+
+def _write_debug_image(filename, im):
+    logger.debug('writing debug image: %s', filename)
+    writer = _debug_image_writer
+    if writer is None:
+        cv2.imwrite(filename, im)
+    else:
+        writer.write(filename, im)
+
+
 def _imwrite_debug(filename, im, suffix):
     base, ext = os.path.splitext(filename)
     name = f"{base}_{suffix}{ext}"
-    cv2.imwrite(name, im)
+    _write_debug_image(name, im)
 
 
-def _try_to_detect_scrollbar(im_gray, im_for_debug=None, debug_image_name="", **kwargs):
+class DebugTrace:
     """
-        スクロールバーおよびスクロール可能領域の検出
+        デバッグ画像を描くための検出過程の記録。
+
+        検出処理は画像に直接描画せず、輪郭や矩形を shapes に記録するだけにする。
+        描画は render() で元画像を切り出したコピーに対して行うので、
+        呼び出し側の画像は変更されない。輪郭は findContours の結果を参照するだけなので、
+        記録のコストは小さい。
+
+        crop_box は描画対象の切り出し範囲 (top, bottom, left, right)、
+        factor は座標の縮小率 (shapes の座標は 1/factor に縮小した画像上のもの)。
+        rejected は 棄却理由 -> 棄却された輪郭のリスト。
+        snapshots は (ファイル名の接尾辞, その時点の図形の数) のリストで、
+        途中経過の画像を書き出すのに用いる。
+    """
+    def __init__(self, crop_box, factor=1):
+        self.crop_box = crop_box
+        self.factor = factor
+        self.shapes = []
+        self.rejected = collections.defaultdict(list)
+        self.snapshots = []
+
+    def add_contours(self, contours, color, thickness):
+        self.shapes.append(('contours', contours, color, thickness))
+
+    def add_rectangle(self, topleft, bottomright, color, thickness):
+        self.shapes.append(('rectangle', (topleft, bottomright), color, thickness))
+
+    def snapshot(self, suffix):
+        self.snapshots.append((suffix, len(self.shapes)))
+
+    @staticmethod
+    def _draw(im, shape):
+        kind, geometry, color, thickness = shape
+        if kind == 'contours':
+            cv2.drawContours(im, geometry, -1, color, thickness)
+        else:
+            cv2.rectangle(im, *geometry, color, thickness)
+
+    def render(self, im):
+        """
+            im から crop_box の範囲を切り出したコピーに記録した図形を描画し、
+            (接尾辞, 画像) を yield する。途中経過の画像を先に、すべての図形を
+            描画した画像を接尾辞 None で最後に返す。
+            yield された画像は次の yield で上書きされるので、必要ならコピーすること。
+        """
+        top, bottom, left, right = self.crop_box
+        canvas = im[top:bottom, left:right]
+        if canvas.ndim == 2:
+            canvas = cv2.cvtColor(canvas, cv2.COLOR_GRAY2BGR)
+        elif self.factor == 1:
+            canvas = canvas.copy()
+        if self.factor > 1:
+            canvas = _downsample(canvas, self.factor)
+
+        drawn = 0
+        for suffix, nshapes in self.snapshots + [(None, len(self.shapes))]:
+            for shape in self.shapes[drawn:nshapes]:
+                self._draw(canvas, shape)
+            drawn = nshapes
+            yield suffix, canvas
+
+    def write(self, im, debug_image_name):
+        for suffix, canvas in self.render(im):
+            if suffix is None:
+                _write_debug_image(debug_image_name, canvas)
+            else:
+                _imwrite_debug(debug_image_name, canvas, suffix)
+
 
-        debug 画像を出力したい場合は im_orig_for_debug に二値化
-        される前の元画像 (crop されたもの) を渡すこと。
+def is_detection_failure(result, error):
     """
-    # 二値化の閾値を高めにするとスクロールバー本体の領域を検出できる。
-    # 低めにするとスクロールバー可能領域を検出できる。
-    threshold_for_actual = 65
+        検出に失敗したとみなせる場合に True を返す。
+        debug_predicate に渡すことで、失敗したときだけデバッグ画像を出力できる。
 
-    actual_scrollbar_contours, not_scrollbar_contours = _detect_scrollbar_region(im_gray, threshold_for_actual)
-    if im_for_debug is not None and debug_image_name:
-        cv2.drawContours(im_for_debug, not_scrollbar_contours, -1, (0, 255, 64), 2)
-        _imwrite_debug(debug_image_name, im_for_debug, "not_scrollbar")
+        スクロールバーが検出できなかった場合 (NOSCROLL_PAGE_INFO)、
+        QP 領域が検出できなかった場合 (None) および例外が送出された場合が該当する。
+    """
+    return error is not None or result is None or result == NOSCROLL_PAGE_INFO
+
+
+def _try_to_detect_scrollbar(im_gray, trace=None, factor=1, **kwargs):
+    """
+        スクロールバーおよびスクロール可能領域の検出
+
+        debug 画像を出力したい場合は trace に DebugTrace を渡すこと。
+        検出の過程が記録される。
+        factor (2 以上の整数) を指定した場合は二値化した画像を 1/factor に縮小してから
+        輪郭を検出する。返す輪郭の座標も縮小後のものになる。
+    """
+    rejected = trace.rejected if trace is not None else None
+    actual_scrollbar_contours, not_scrollbar_contours = _detect_scrollbar_region(
+        im_gray, SCROLLBAR_BINARY_THRESHOLD, factor, rejected,
+    )
+    if trace is not None:
+        trace.add_contours(not_scrollbar_contours, (0, 255, 64), 2)
+        trace.snapshot("not_scrollbar")
 
     if len(actual_scrollbar_contours) == 0:
         return None
 
-    if im_for_debug is not None:
-        cv2.drawContours(im_for_debug, actual_scrollbar_contours, -1, (0, 255, 0), 3)
-        _imwrite_debug(debug_image_name, im_for_debug, "scrollbar")
+    if trace is not None:
+        trace.add_contours(actual_scrollbar_contours, (0, 255, 0), 3)
+        trace.snapshot("scrollbar")
 
     if len(actual_scrollbar_contours) > 1:
         n = len(actual_scrollbar_contours)
@@ -505,151 +1172,2083 @@ def _compute_scrollbar_cap_height(im_height):
     return int(cap_height)
 
 
-def guess_pageinfo(im, debug_draw_image=False, debug_image_name=None, **kwargs):
+class ScreenAnalysis:
     """
-        ページ情報を推定する。
-        返却値は (現ページ数, 全体ページ数, 全体行数)
-        スクロールバーがない場合は全体行数の推定は不可能。その場合は
-        NOSCROLL_PAGE_INFO すなわち (1, 1, 0) を返す
+        1枚のスクリーンショットに対する解析処理をまとめたもの。
+
+        グレースケール画像、左右の黒余白、スクロールバー判定用と QP 判定用の
+        切り出し領域、画面レイアウトの種類は必要になった時点で計算し、以降は
+        使い回す。ページ判定と QP 判定の両方を行う場合に同じ処理を繰り返さずに済む。
+        グレースケール画像や左右の余白を計算済みの場合は引数で渡せる。
+        layout_cache に LayoutCache を渡すと、同じ端末のレイアウト情報を使い回す。
+
+        canonical_height を指定すると、"次へ" ボタンの照合と輪郭検出を行う前に
+        画像をその高さに近づくよう整数分の1に縮小する (拡大はしない)。
+        高解像度の画像で処理するピクセル数を減らすためのもの。判定に用いる値は
+        すべて画像サイズとの比率なので、結果は基本的に変わらない。
+        QP 領域の座標は元の画像の座標に戻して返す。
+
+        デバッグ画像は検出過程を DebugTrace に記録しておき、書き出すときに
+        元画像のコピーに描画する。記録は traces ('page' または 'qp' -> DebugTrace) に残る。
+        debug_predicate(結果, 例外) を渡すと、それが真を返したときだけ書き出す
+        (失敗時のみ書き出すには is_detection_failure を渡す)。
+
+        near_duplicates に NearDuplicateIndex を渡すと、ほぼ同一の画像を以前に
+        判定していればその結果を返す。デバッグ画像が必要になりうる場合は毎回判定する。
     """
-    im_h, im_w = im.shape[:2]
-    logger.debug('image size: (width, height) = (%s, %s)', im_w, im_h)
+    def __init__(self, im, im_gray=None, side_margins=None, layout_cache=None, canonical_height=None,
+                 near_duplicates=None):
+        self.im = im
+        self.layout_cache = layout_cache
+        self.near_duplicates = near_duplicates
+        self.canonical_height = canonical_height
+        self.traces = {}
+        # guess_pageinfo で検出したスクロールバーの外接矩形 (x, y, w, h)。座標は scrollbar_factor で縮小後のもの
+        self.scrollbar_rect = None
+        if im_gray is None and im.ndim == 2:
+            im_gray = im
+        if im_gray is not None:
+            self.gray = im_gray
+        if side_margins is not None:
+            self.side_margins = tuple(side_margins)
 
-    im_gray = cv2.cvtColor(im, cv2.COLOR_BGR2GRAY)
-    left_margin, right_margin = detect_side_black_margin(im_gray)
-    logger.debug('side margin: (left, right) = (%s, %s)', left_margin, right_margin)
-
-    # 左右に黒領域がある場合、まずこれを除去する。
-    left = left_margin
-    right = im_w - right_margin
-    net_width = right - left
-    logger.debug('net_width = %s', net_width)
-
-    # 縦横比率が規定値を超える場合は上下カットが必要と判断する。
-    if im_h / net_width > 0.57:
-        cut_size = int(math.ceil(int(im_h - net_width * 0.56) / 2))
-        top = cut_size
-        bottom = im_h - cut_size
-    else:
-        cut_size = 0
-        top = 0
-        bottom = im_h
-
-    logger.debug('top, bottom = (%s, %s), cut_size = %s', top, bottom, cut_size)
-    # 縦4分割して4領域に分け、一番右の領域だけ使う。
-    # スクロールバーの領域を調べたいならそれで十分。
-    cropped = im[top:bottom, int(net_width*3/4):net_width]
-    cr_h, cr_w = cropped.shape[:2]
-    logger.debug('cropped image size (for scrollbar): (width, height) = (%s, %s)', cr_w, cr_h)
-    cropped_gray = cv2.cvtColor(cropped, cv2.COLOR_BGR2GRAY)
-
-    next_button = cv2.imread(str(pageinfo_basedir / "data" / "pageinfo" / "next.png"))
-    next_button_gray = cv2.cvtColor(next_button, cv2.COLOR_BGR2GRAY)
-    gamescreen_type = get_gamescreen_type(cropped_gray, next_button_gray)
-
-    if debug_draw_image:
-        im_orig_for_debug = cropped
-    else:
-        im_orig_for_debug = None
+    @classmethod
+    def from_bytes(cls, data, flags=_IMREAD_COLOR, **kwargs):
+        """
+            エンコード済み画像のバイト列から ScreenAnalysis を作る。
+            data と flags については decode_image を参照。
+        """
+        return cls(decode_image(data, flags), **kwargs)
+
+    @functools.cached_property
+    def gray(self):
+        with _span('gray'):
+            return cv2.cvtColor(self.im, cv2.COLOR_BGR2GRAY)
+
+    @functools.cached_property
+    def side_margins(self):
+        gray = self.gray
+        with _span('margin'):
+            left_margin, right_margin = detect_side_black_margin(gray)
+        logger.debug('side margin: (left, right) = (%s, %s)', left_margin, right_margin)
+        return left_margin, right_margin
+
+    @functools.cached_property
+    def layout_key(self):
+        im_h, im_w = self.im.shape[:2]
+        key = LayoutCache.make_key(im_h, im_w, self.side_margins)
+        # ボタンの位置は縮小後の座標で記録されるので、canonical_height ごとに分けて覚える
+        if self.canonical_height is not None:
+            key += f'/{self.canonical_height}'
+        return key
+
+    @functools.cached_property
+    def cached_layout(self):
+        if self.layout_cache is None:
+            return None
+        return self.layout_cache.get(self.layout_key)
+
+    @functools.cached_property
+    def scrollbar_crop_box(self):
+        """
+            スクロールバー判定用の切り出し領域 (top, bottom, left, right)
+        """
+        if self.cached_layout is not None:
+            return tuple(self.cached_layout['scrollbar_crop_box'])
+        return self._compute_scrollbar_crop_box()
+
+    def _compute_scrollbar_crop_box(self):
+        im_h, im_w = self.im.shape[:2]
+        logger.debug('image size: (width, height) = (%s, %s)', im_w, im_h)
+        left_margin, right_margin = self.side_margins
+
+        # 左右に黒領域がある場合、まずこれを除去する。
+        left = left_margin
+        right = im_w - right_margin
+        net_width = right - left
+        logger.debug('net_width = %s', net_width)
+
+        # 縦横比率が規定値を超える場合は上下カットが必要と判断する。
+        if im_h / net_width > 0.57:
+            cut_size = int(math.ceil(int(im_h - net_width * 0.56) / 2))
+            top = cut_size
+            bottom = im_h - cut_size
+        else:
+            cut_size = 0
+            top = 0
+            bottom = im_h
+
+        logger.debug('top, bottom = (%s, %s), cut_size = %s', top, bottom, cut_size)
+        # 縦4分割して4領域に分け、一番右の領域だけ使う。
+        # スクロールバーの領域を調べたいならそれで十分。
+        return top, bottom, int(net_width*3/4), net_width
+
+    @functools.cached_property
+    def scrollbar_crop_gray(self):
+        # グレースケール化はピクセル単位の変換なので、変換済みの全体画像を切り出せば
+        # 切り出してから変換した場合と同じ結果になる。
+        top, bottom, left, right = self.scrollbar_crop_box
+        if 'gray' in self.__dict__:
+            cropped_gray = self.gray[top:bottom, left:right]
+        else:
+            # 左右の余白を引数で渡された場合は全体のグレースケール画像が不要なので、
+            # 切り出してから変換する
+            with _span('gray'):
+                cropped_gray = cv2.cvtColor(self.im[top:bottom, left:right], cv2.COLOR_BGR2GRAY)
+        cr_h, cr_w = cropped_gray.shape[:2]
+        logger.debug('cropped image size (for scrollbar): (width, height) = (%s, %s)', cr_w, cr_h)
+        return cropped_gray
+
+    @functools.cached_property
+    def qp_crop_box(self):
+        """
+            QP 判定用の切り出し領域 (top, bottom, left, right)
+        """
+        # 縦横2分割して4領域に分け、左下の領域だけ使う。
+        # QP の領域を調べたいならそれで十分。
+        im_h, im_w = self.im.shape[:2]
+        # まれにスクリーンショット左端に余白が入ることがある。
+        # おそらく Android の機種や状況に依存？ この状態で左右を等分すると
+        # 中心が左にずれて QP 領域の囲みが見切れてしまい検出に失敗する。
+        # これを考慮し、切る位置をやや右にずらす。
+        return int(im_h/2), im_h, 0, int(im_w/1.93)
+
+    @functools.cached_property
+    def qp_crop_gray(self):
+        top, bottom, left, right = self.qp_crop_box
+        if 'gray' in self.__dict__:
+            cropped_gray = self.gray[top:bottom, left:right]
+        else:
+            # 全体のグレースケール画像が不要なら、切り出してから変換するほうが安い
+            with _span('qp.crop'):
+                cropped_gray = cv2.cvtColor(self.im[top:bottom, left:right], cv2.COLOR_BGR2GRAY)
+        cr_h, cr_w = cropped_gray.shape[:2]
+        logger.debug('cropped image size (for qp): (width, height) = (%s, %s)', cr_w, cr_h)
+        return cropped_gray
+
+    @functools.cached_property
+    def scrollbar_fingerprint(self):
+        cropped_gray = self.scrollbar_crop_gray
+        top = int(cropped_gray.shape[0] * NEAR_DUPLICATE_TOP_SKIP)
+        return _thumbnail_fingerprint(cropped_gray[top:], NEAR_DUPLICATE_SCROLLBAR_SIZE)
+
+    @functools.cached_property
+    def qp_fingerprint(self):
+        return _thumbnail_fingerprint(self.qp_crop_gray, NEAR_DUPLICATE_QP_SIZE)
+
+    def _reduction_factor(self, reference_height):
+        """
+            canonical_height に近づけるための縮小率の逆数 (整数) を返す。
+            縮小後の高さが canonical_height を下回らない範囲で最大の値を選ぶ。
+        """
+        if self.canonical_height is None:
+            return 1
+        return max(1, reference_height // self.canonical_height)
+
+    @functools.cached_property
+    def scrollbar_factor(self):
+        return self._reduction_factor(self.scrollbar_crop_gray.shape[0])
+
+    @functools.cached_property
+    def qp_factor(self):
+        # QP 用の切り出し領域は画像の下半分なので、画像全体の高さを基準にする
+        return self._reduction_factor(self.im.shape[0])
+
+    @functools.cached_property
+    def scrollbar_work_gray(self):
+        """
+            画面レイアウトの判定に用いる、scrollbar_factor に合わせて縮小した切り出し画像
+        """
+        if self.scrollbar_factor == 1:
+            return self.scrollbar_crop_gray
+        with _span('page.downsample'):
+            return _downsample(self.scrollbar_crop_gray, self.scrollbar_factor)
+
+    @functools.cached_property
+    def gamescreen_type(self):
+        im_work = self.scrollbar_work_gray
+        with _span('page.template_match'):
+            return self._get_gamescreen_type(im_work)
+
+    def _get_gamescreen_type(self, im_work):
+        if self.layout_cache is None:
+            return get_gamescreen_type(im_work)
+
+        if self.cached_layout is not None:
+            gamescreen_type = _verify_cached_gamescreen_type(im_work, self.cached_layout)
+            if gamescreen_type is not None:
+                self.layout_cache.hits += 1
+                _count('layout_cache.hit')
+                return gamescreen_type
+
+        self.layout_cache.misses += 1
+        _count('layout_cache.miss')
+        gamescreen_type, location, score = _detect_gamescreen_type(im_work)
+        if location is None or score < LayoutCache.min_score:
+            # 検証に使えるボタン位置がないので、画像ごとに変わる値は覚えない
+            layout = {
+                'scrollbar_crop_box': list(self.scrollbar_crop_box),
+                'gamescreen_type': None,
+                'button_location': None,
+                'button_score': None,
+                'rematch': True,
+            }
+        else:
+            layout = {
+                'scrollbar_crop_box': list(self.scrollbar_crop_box),
+                'gamescreen_type': gamescreen_type,
+                'button_location': list(location),
+                'button_score': score,
+            }
+        self.layout_cache.put(self.layout_key, layout)
+        return gamescreen_type
+
+    def _run_traced(self, name, detect, crop_box, factor, debug_draw_image, debug_image_name, debug_predicate):
+        """
+            デバッグ画像が必要になりうる場合は DebugTrace を作って検出過程を記録し、
+            traces[name] に保存する。debug_draw_image が真の場合、または
+            debug_predicate(結果, 例外) が真を返した場合に、debug_image_name に
+            デバッグ画像を書き出す。
+        """
+        if not debug_draw_image and debug_predicate is None:
+            return detect(None)
+
+        trace = DebugTrace(crop_box, factor)
+        self.traces[name] = trace
+        try:
+            result = detect(trace)
+        except Exception as e:
+            if debug_image_name and (debug_draw_image or debug_predicate(None, e)):
+                trace.write(self.im, debug_image_name)
+            raise
+        if debug_image_name and (debug_draw_image or debug_predicate(result, None)):
+            trace.write(self.im, debug_image_name)
+        return result
+
+    def _run_reusable(self, key, fingerprint, run, debug_draw_image, debug_predicate):
+        """
+            near_duplicates に key で登録された結果のうち、fingerprint() の指紋が近いものが
+            あればそれを返す。なければ run() の結果を登録して返す。
+        """
+        index = self.near_duplicates
+        if index is None:
+            return run()
+        fp = fingerprint()
+        if not debug_draw_image and debug_predicate is None:
+            match = index.lookup(key, fp)
+            if match is not None:
+                logger.debug('near duplicate found: distance %s', match.distance)
+                return match.result
+        result = run()
+        index.add(key, fp, result)
+        return result
+
+    def detect_qp_region(self, mode=QPDetectionMode.JP.value, debug_draw_image=False, debug_image_name=None,
+                         debug_predicate=None):
+        """
+            detect_qp_region と同じ。
+        """
+        def run():
+            return self._run_traced(
+                'qp', functools.partial(self._detect_qp_region, mode), self.qp_crop_box, 1,
+                debug_draw_image, debug_image_name, debug_predicate,
+            )
 
-    try:
-        actual_scrollbar_region = _try_to_detect_scrollbar(cropped_gray, im_orig_for_debug, debug_image_name=debug_image_name, **kwargs)
-    finally:
-        if debug_draw_image:
-            logger.debug('writing debug image: %s', debug_image_name)
-            cv2.imwrite(debug_image_name, cropped)
+        key = ('qp', mode, self.canonical_height, self.im.shape[:2])
+        with _span('qp.total'):
+            return self._run_reusable(key, lambda: self.qp_fingerprint, run, debug_draw_image, debug_predicate)
+
+    def _detect_qp_region(self, mode, trace):
+        im_gray = self.qp_crop_gray
+        binary_threshold = 50
+        factor = self.qp_factor
+        with _span('qp.threshold_contours'):
+            _, th1 = cv2.threshold(im_gray, binary_threshold, 255, cv2.THRESH_BINARY)
+            if factor > 1:
+                # QP 枠の線は細いので、縮小時に消えないよう白の割合が低くても白とみなす
+                th1 = _downsample_binary(th1, factor, 0.25)
+            contours, _ = cv2.findContours(th1, cv2.RETR_EXTERNAL, cv2.CHAIN_APPROX_SIMPLE)
+        _count('qp.contours', len(contours))
+
+        with _span('qp.contour_filter'):
+            if trace is None:
+                filtered_contours = [c for c in contours if filter_contour_qp(c, th1)]
+            else:
+                filtered_contours = []
+                rejected = trace.rejected['not_qp_frame']
+                for c in contours:
+                    (filtered_contours if filter_contour_qp(c, th1) else rejected).append(c)
+                if factor > 1:
+                    rejected[:] = [c * factor for c in rejected]
+        _count('qp.candidates', len(filtered_contours))
+        if factor > 1:
+            # 以降の処理は元の解像度の座標で行う
+            filtered_contours = [c * factor for c in filtered_contours]
+        candidate = None
+
+        for contour in filtered_contours:
+            logger.debug('detected areas: %s', cv2.boundingRect(contour))
+
+        if len(filtered_contours) == 1:
+            qp_region = filtered_contours[0]
+            x, y, w, h = cv2.boundingRect(qp_region)
+
+            wh_rate = w / h
+
+            # 左右の無駄領域を除外するためのマージン。
+            #
+            # The position of the QP values in the NA version of the screenshot is
+            # slightly more to the right than in the JP version. This makes it
+            # difficult to apply the same cut position to both types of screenshots.
+            if mode == QPDetectionMode.NA.value:
+                # The values below are optimized for NA's new game screen layout.
+                # Old layout screenshots can also be applied, but may not cut well.
+                left_margin = 0.45
+                right_margin = 0.02
+            else:
+                # イベントで所持 QP 枠が狭くなる場合、カットする領域を狭める必要がある。
+                if wh_rate < 9:
+                    left_margin = 0.45
+                    right_margin = 0.04
+                else:
+                    # 感覚的な値ではあるが 左 42%, 右 4% を除外。
+                    # 落とし穴として、2019年5月末 ～ 9月の間に所持 QP の出力位置が微妙に変わっている。
+                    # ここではそのどちらのケースでも対応できるよう枠を広めに取っている。
+                    # 現仕様に最適化して切り詰めすぎると困ったことになるため注意。
+                    left_margin = 0.42
+                    right_margin = 0.04
+
+            topleft = (x + int(w*left_margin), y)
+            bottomright = (topleft[0] + w - int(w*left_margin) - int(w*right_margin), y + h)
+
+            if trace is not None:
+                trace.add_rectangle(topleft, bottomright, (0, 0, 255), 3)
+
+            # 呼び出し側に返すのは分割前の座標でないといけない。
+            # よって、事前に切り捨てた左上領域の y 座標をここで補正する。
+            # x 座標は分割の影響を受けていないので補正不要。
+            above_height = self.qp_crop_box[0]
+            corrected_topleft = (topleft[0], topleft[1] + above_height)
+            corrected_bottomright = (bottomright[0], bottomright[1] + above_height)
+            candidate = (corrected_topleft, corrected_bottomright)
+
+        if trace is not None:
+            trace.add_contours(filtered_contours, (0, 255, 0), 3)
+            # 棄却された輪郭は trace.rejected に記録されている。
+            # 輪郭検出の状況を画像で知りたい場合は以下を有効にする。
+            # trace.add_contours(trace.rejected['not_qp_frame'], (0, 255, 255), 3)
+
+        if len(filtered_contours) > 1:
+            n = len(filtered_contours)
+            raise TooManyAreasDetectedError(f'{n} actual qp regions detected')
+
+        return candidate
+
+    def guess_pageinfo(self, debug_draw_image=False, debug_image_name=None, debug_predicate=None, **kwargs):
+        """
+            guess_pageinfo と同じ。
+        """
+        def run():
+            return self._run_traced(
+                'page', functools.partial(self._guess_pageinfo, **kwargs), self.scrollbar_crop_box,
+                self.scrollbar_factor, debug_draw_image, debug_image_name, debug_predicate,
+            )
+
+        key = ('page', self.canonical_height, tuple(sorted(kwargs.items())))
+        with _span('page.total'):
+            return self._run_reusable(key, lambda: self.scrollbar_fingerprint, run, debug_draw_image, debug_predicate)
+
+    def _guess_pageinfo(self, trace, **kwargs):
+        cropped_gray = self.scrollbar_crop_gray
+        gamescreen_type = self.gamescreen_type
+        factor = self.scrollbar_factor
+        # 縮小した場合、スクロールバーの座標も高さも縮小後の値で扱う
+        cr_h = cropped_gray.shape[0] // factor
+
+        actual_scrollbar_region = _try_to_detect_scrollbar(cropped_gray, trace, factor=factor, **kwargs)
 
-    # スクロールバーが検出できない
-    if actual_scrollbar_region is None:
-        return NOSCROLL_PAGE_INFO
+        # スクロールバーが検出できない
+        if actual_scrollbar_region is None:
+            return NOSCROLL_PAGE_INFO
 
-    _, asr_y, _, asr_h = cv2.boundingRect(actual_scrollbar_region)
+        self.scrollbar_rect = cv2.boundingRect(actual_scrollbar_region)
+        _, asr_y, _, asr_h = self.scrollbar_rect
+        return _pageinfo_from_scrollbar(asr_y, asr_h, cr_h, gamescreen_type)
 
+
+def _pageinfo_from_scrollbar(asr_y, asr_h, cr_h, gamescreen_type):
+    """
+        スクロールバーの y 座標と高さ、切り出し画像の高さからページ情報を求める。
+    """
     esr_y, esr_h = _compute_scrollable_area_position_and_height(cr_h, gamescreen_type)
-    cap_height = _compute_scrollbar_cap_height(bottom - top)
+    cap_height = _compute_scrollbar_cap_height(cr_h)
     pages = guess_pages(asr_h, esr_h, cap_height)
     pagenum = guess_pagenum(asr_y, esr_y, asr_h, esr_h, cap_height)
     lines = guess_lines(asr_h, esr_h, cap_height)
     return (pagenum, pages, lines)
 
 
-def look_into_file_for_page(filename, im, args):
-    if args.debug_sc:
-        debug_sc_dir = os.path.join(args.debug_out_dir, 'page')
-        os.makedirs(debug_sc_dir, exist_ok=True)
-        prefix = args.debug_out_file_prefix
-        debug_image = os.path.join(debug_sc_dir, prefix + os.path.basename(filename))
-        logger.debug('debug image path: %s', debug_image)
-    else:
-        debug_image = None
-
-    pagenum, pages, lines = guess_pageinfo(im, args.debug_sc, debug_image)
-    logger.debug('pagenum: %s, pages: %s, lines: %s', pagenum, pages, lines)
-    return (pagenum, pages, lines)
+def guess_pageinfo(im, debug_draw_image=False, debug_image_name=None, layout_cache=None, canonical_height=None,
+                   debug_predicate=None, near_duplicates=None, **kwargs):
+    """
+        ページ情報を推定する。
+        返却値は (現ページ数, 全体ページ数, 全体行数)
+        スクロールバーがない場合は全体行数の推定は不可能。その場合は
+        NOSCROLL_PAGE_INFO すなわち (1, 1, 0) を返す
 
+        im はカラー (BGR) 画像とグレースケール画像のどちらでもよい。
+        色の情報は使わないので、グレースケールで読み込んだ画像を渡せば
+        デコードと変換のコストを省ける。
+        layout_cache に LayoutCache を渡すと、同じ端末で撮影された2枚目以降の
+        画像では画面レイアウトの判定を省略できる。
+        im は変更されない。
+        canonical_height, debug_predicate, near_duplicates については ScreenAnalysis を参照。
+    """
+    analysis = ScreenAnalysis(
+        im, layout_cache=layout_cache, canonical_height=canonical_height, near_duplicates=near_duplicates,
+    )
+    return analysis.guess_pageinfo(debug_draw_image, debug_image_name, debug_predicate, **kwargs)
 
-def look_into_file_for_qp(filename, im, args):
-    if args.debug_sc:
-        debug_sc_dir = os.path.join(args.debug_out_dir, 'qp')
-        os.makedirs(debug_sc_dir, exist_ok=True)
-        prefix = args.debug_out_file_prefix
-        debug_image = os.path.join(debug_sc_dir, prefix + os.path.basename(filename))
-        logger.debug('debug image path: %s', debug_image)
-    else:
-        debug_image = None
-    result = detect_qp_region(im, args.mode, args.debug_sc, debug_image)
-    if result is None:
-        return ('', '') , ('', '')
-    return result
 
+_ScrollbarLock = collections.namedtuple('_ScrollbarLock', 'layout_key factor gamescreen_type x width height')
 
-def look_into_file(filename, args):
-    logger.debug(f'===== {filename}')
 
-    im = cv2.imread(filename)
+class PageSession:
+    """
+        同じクエスト周回のドロップ画面 (1..N ページ) のスクリーンショットを順に判定するためのセッション。
+
+        同じ周回のスクリーンショットは端末も画面レイアウトも同じで、スクロールバーは
+        同じ列にあり長さも変わらない。最初にスクロールバーを検出したページでその列、幅、
+        長さと画面レイアウトを覚えておき、以降のページでは覚えた列の周辺の細い帯だけを
+        二値化してスクロールバーを探す。帯の中に覚えた幅と長さのスクロールバーが1本だけ
+        見つからない場合や、端末 (画像の大きさと左右の余白) が変わった場合は
+        通常の判定を行い、覚え直す。
+
+        帯の中で見つかった輪郭が帯の左右の端に接していなければ、切り出し画像全体で
+        検出した場合と同じ輪郭になり、同じ判定 (_filter_contour_scrollbar) を通す。
+        ただし帯の外は調べないので、帯の外にもスクロールバーらしい輪郭がある画像では
+        guess_pageinfo が TooManyAreasDetectedError を送出する場合でも結果を返す。
+        判定結果は results に (名前, 結果) の組で残り、consistency_issues() で
+        ページ番号の整合性を確かめられる。
+    """
+    # 帯の幅は、覚えたスクロールバーの左右にその幅の strip_padding 倍を加えたもの
+    strip_padding = 1.0
+    # 覚えた長さとの差がこの割合 (最低 2px) 以内なら同じスクロールバーとみなす
+    height_tolerance = 0.02
+
+    def __init__(self, canonical_height=None, layout_cache=None):
+        self.canonical_height = canonical_height
+        self.layout_cache = layout_cache if layout_cache is not None else LayoutCache()
+        self.lock = None
+        self.results = []
+        self.strip_hits = 0
+        self.fallbacks = 0
+
+    def guess_pageinfo(self, im, name=None):
+        """
+            guess_pageinfo と同じ値を返し、(name, 結果) を results に追加する。
+            name を省略した場合は results 内の順番 (0 始まり) を名前とする。
+        """
+        analysis = ScreenAnalysis(im, layout_cache=self.layout_cache, canonical_height=self.canonical_height)
+        result = None
+        if self.lock is not None and analysis.layout_key == self.lock.layout_key:
+            with _span('session.strip'):
+                result = self._guess_from_strip(analysis)
+        if result is not None:
+            self.strip_hits += 1
+            _count('session.strip_hit')
+        else:
+            if self.lock is not None:
+                self.fallbacks += 1
+                _count('session.fallback')
+            result = analysis.guess_pageinfo()
+            if analysis.scrollbar_rect is not None:
+                x, _, w, h = analysis.scrollbar_rect
+                self.lock = _ScrollbarLock(
+                    analysis.layout_key, analysis.scrollbar_factor, analysis.gamescreen_type, x, w, h,
+                )
+        self.results.append((len(self.results) if name is None else name, result))
+        return result
+
+    def _guess_from_strip(self, analysis):
+        """
+            覚えた列の周辺の帯からスクロールバーを探してページ情報を返す。
+            帯の様子が覚えたものと異なる場合は None を返す。
+        """
+        lock = self.lock
+        factor = lock.factor
+        cropped_gray = analysis.scrollbar_crop_gray
+        cr_h, cr_w = cropped_gray.shape[0] // factor, cropped_gray.shape[1] // factor
+        pad = max(2, int(lock.width * self.strip_padding))
+        left = max(0, lock.x - pad)
+        right = min(cr_w, lock.x + lock.width + pad)
+        # 縮小する場合も、全体を縮小した場合と同じ区切りになるよう factor の倍数の位置で切り出す
+        _, strip = cv2.threshold(
+            cropped_gray[:, left * factor:right * factor], SCROLLBAR_BINARY_THRESHOLD, 255, cv2.THRESH_BINARY,
+        )
+        if factor > 1:
+            strip = _downsample_binary(strip, factor, 0.5)
+        # 輪郭の座標は切り出し画像全体 (縮小後) の座標にする
+        contours, _ = cv2.findContours(strip, cv2.RETR_EXTERNAL, cv2.CHAIN_APPROX_SIMPLE, offset=(left, 0))
+
+        candidates = []
+        for contour in contours:
+            x, y, w, h = cv2.boundingRect(contour)
+            if h < w * 3 or abs(w - lock.width) > max(2, lock.width / 4):
+                continue
+            if (x == left and left > 0) or (x + w >= right and right < cr_w):
+                # 帯の外につながっている可能性がある
+                logger.debug('scrollbar in the strip touches the edge: %s', (x, y, w, h))
+                return None
+            # 全体で検出する場合と同じ基準で判定する
+            if _filter_contour_scrollbar(contour, cr_h, cr_w) != SCRB_LIKELY_SCROLLBAR:
+                continue
+            candidates.append((y, h))
+        if len(candidates) != 1:
+            logger.debug('%s scrollbar candidates in the strip', len(candidates))
+            return None
+        y, h = candidates[0]
+        if abs(h - lock.height) > max(2, lock.height * self.height_tolerance):
+            logger.debug('scrollbar height changed: %s -> %s', lock.height, h)
+            return None
+        return _pageinfo_from_scrollbar(y, h, cr_h, lock.gamescreen_type)
+
+    def consistency_issues(self):
+        """
+            results のページ情報の整合性を確かめ、問題の説明 (文字列) のリストを返す。
+
+            - 全ページで全体ページ数と行数が最初のページと同じであること
+            - ページ番号が全体ページ数以下で、重複せず昇順に並んでいること
+            - 1 から全体ページ数までのページが揃っていること
+        """
+        if not self.results:
+            return []
+        issues = []
+        first_name, (_, pages, lines) = self.results[0]
+        seen = {}
+        previous = 0
+        for name, (pagenum, p_pages, p_lines) in self.results:
+            if (p_pages, p_lines) != (pages, lines):
+                issues.append(f'{name}: pages/lines {p_pages}/{p_lines} differ from {pages}/{lines} of {first_name}')
+            if pagenum > p_pages:
+                issues.append(f'{name}: page {pagenum} exceeds the number of pages {p_pages}')
+            if pagenum in seen:
+                issues.append(f'{name}: page {pagenum} is the same as {seen[pagenum]}')
+            elif pagenum < previous:
+                issues.append(f'{name}: page {pagenum} comes after page {previous}')
+            seen.setdefault(pagenum, name)
+            previous = pagenum
+        missing = sorted(set(range(1, pages + 1)) - seen.keys())
+        if missing:
+            issues.append(f'missing pages: {", ".join(map(str, missing))}')
+        return issues
+
+
+def decode_image(data, flags=_IMREAD_COLOR):
+    """
+        メモリ上のエンコード済み画像 (PNG や JPEG のファイルの中身) をデコードする。
+
+        data には bytes, bytearray, memoryview など、バッファプロトコルに対応した
+        オブジェクトを渡す。np.frombuffer でコピーせずに参照したまま cv2.imdecode に渡す。
+        flags は cv2.imdecode のフラグ。ページ判定だけなら cv2.IMREAD_GRAYSCALE で足りる。
+        cv2.IMREAD_REDUCED_GRAYSCALE_2 などの縮小デコードも使えるが、その場合
+        detect_qp_region が返す座標は縮小後の画像の座標になる。
+        デコードできない場合は ImageDecodeError が発生する。
+    """
+    buf = np.frombuffer(data, dtype=np.uint8)
+    if buf.size == 0:
+        raise ImageDecodeError('empty image data')
+    im = cv2.imdecode(buf, flags)
     if im is None:
-        raise FileNotFoundError(f'Cannot read file: {filename}')
+        raise ImageDecodeError(f'cannot decode image data ({buf.size} bytes)')
+    return im
 
-    im_h, im_w = im.shape[:2]
-    logger.debug('image size: (width, height) = (%s, %s)', im_w, im_h)
 
-    return args.func(filename, im, args)
+def guess_pageinfo_from_bytes(data, flags=_IMREAD_GRAYSCALE, **kwargs):
+    """
+        エンコード済み画像のバイト列から guess_pageinfo を行う。
+        data と flags については decode_image を、kwargs については guess_pageinfo を参照。
+    """
+    return guess_pageinfo(decode_image(data, flags), **kwargs)
 
 
-def main(args):
-    csvdata = []
+def detect_qp_region_from_bytes(data, mode=QPDetectionMode.JP.value, flags=_IMREAD_COLOR, **kwargs):
+    """
+        エンコード済み画像のバイト列から detect_qp_region を行う。
+        data と flags については decode_image を、kwargs については detect_qp_region を参照。
+    """
+    return detect_qp_region(decode_image(data, flags), mode, **kwargs)
 
-    for filename in args.filename:
-        if os.path.isdir(filename):
-            for child in os.listdir(filename):
-                path = os.path.join(filename, child)
-                result = look_into_file(path, args)
-                csvdata.append((path, *result))
-        else:
-            result = look_into_file(filename, args)
-            csvdata.append((filename, *result))
 
-    csv_writer = csv.writer(args.output, lineterminator='\n')
-    csv_writer.writerows(csvdata)
+@functools.lru_cache(maxsize=None)
+def detector_fingerprint():
+    """
+        判定処理の版を表す文字列を返す。
 
+        pageinfo.py 自身のソース、"次へ" ボタンのテンプレート画像および OpenCV の版から
+        計算するので、閾値などのヒューリスティックを変更すると必ず変わる
+        (コメントだけの変更でも変わるが、キャッシュが無駄になるだけで害はない)。
+        ResultCache のキーの一部として使う。
+    """
+    import hashlib
+    h = hashlib.sha256()
+    h.update(_read_asset(os.path.basename(__file__)))
+    h.update(_read_asset("data", "pageinfo", "next.png"))
+    h.update(cv2.__version__.encode())
+    return h.hexdigest()[:16]
 
-def parse_args():
-    parser = argparse.ArgumentParser()
-    subparsers = parser.add_subparsers()
 
-    def add_common_arguments(p):
-        p.add_argument('filename', nargs='+')
-        p.add_argument(
-            '-l', '--loglevel',
-            choices=('debug', 'info', 'warning'),
-            default='info',
-            help='set loglevel [default: info]',
+def result_cache_params(kind, mode=None, canonical_height=None, near_duplicate=None):
+    """
+        ResultCache のキーのうち、画像以外の部分 (判定の種類、判定の版、引数) を表す文字列を返す。
+        kind は 'page', 'qp', 'all' など、結果の形式ごとに異なる文字列にする。
+        mode は QP 領域を判定しない場合は無視する。
+        near_duplicate はほぼ同一の画像の結果を使い回す場合のしきい値で、その結果は
+        近似なので、使い回さない場合の結果とは区別する。
+    """
+    params = [kind, detector_fingerprint()]
+    if mode is not None and not kind.endswith('page'):
+        params.append(f'mode={mode}')
+    if canonical_height is not None:
+        params.append(f'canonical_height={canonical_height}')
+    if near_duplicate is not None:
+        params.append(f'near_duplicate={near_duplicate}')
+    return ';'.join(params)
+
+
+# キャッシュする例外。画像の内容と引数だけで決まる例外に限る。
+_CACHEABLE_ERRORS = {
+    cls.__name__: cls for cls in (
+        PageInfoError, TooManyAreasDetectedError, UnsupportedGamescreenTypeError, ImageDecodeError,
+    )
+}
+
+
+def _to_tuple(value):
+    """
+        JSON から読み込んだ値のリストを tuple に戻す。
+    """
+    if isinstance(value, list):
+        return tuple(_to_tuple(v) for v in value)
+    return value
+
+
+class ResultCache:
+    """
+        判定結果のキャッシュ。
+
+        キーは エンコード済み画像のバイト列の SHA-256 と result_cache_params の文字列の組で、
+        値は判定結果または判定時に送出された例外 (_CACHEABLE_ERRORS のみ)。
+        result_cache_params には detector_fingerprint が含まれるので、pageinfo.py の
+        ヒューリスティックを変更すると古い結果は自動的に使われなくなる。
+        値は JSON で保存するので、結果は JSON にできる値 (tuple は復元時に tuple に戻す) に限る。
+
+        プロセス内の LRU (maxsize 件、0 なら使わない) と、path を指定した場合は
+        SQLite のファイルの2段で構成する。SQLite には1件ごとにコミットするので、
+        処理が中断されてもそれまでの結果は残る。複数のプロセスで同じファイルを共有してもよい。
+
+        SQLite にはファイルのパス、サイズ、更新時刻とハッシュの対応も記録でき
+        (get_file/put_file)、CLI の --resume はこれを使ってファイルを読まずに結果を得る。
+    """
+    def __init__(self, path=None, maxsize=1024):
+        self.path = path
+        self.maxsize = maxsize
+        self.entries = collections.OrderedDict()
+        self.hits = 0
+        self.misses = 0
+        self._lock = threading.Lock()
+        self._db = None
+        if path is not None:
+            import sqlite3
+            self._db = sqlite3.connect(path, timeout=30, check_same_thread=False)
+            self._db.execute('PRAGMA journal_mode=WAL')
+            self._db.execute('PRAGMA synchronous=NORMAL')
+            self._db.execute(
+                'CREATE TABLE IF NOT EXISTS results ('
+                ' digest TEXT NOT NULL, params TEXT NOT NULL, value TEXT NOT NULL,'
+                ' PRIMARY KEY (digest, params))'
+            )
+            self._db.execute(
+                'CREATE TABLE IF NOT EXISTS files ('
+                ' path TEXT NOT NULL, params TEXT NOT NULL, size INTEGER NOT NULL, mtime_ns INTEGER NOT NULL,'
+                ' digest TEXT NOT NULL, PRIMARY KEY (path, params))'
+            )
+            self._db.commit()
+
+    @staticmethod
+    def content_hash(data):
+        import hashlib
+        return hashlib.sha256(data).hexdigest()
+
+    @staticmethod
+    def _encode(result, error):
+        if error is None:
+            return json.dumps({'result': result})
+        return json.dumps({'error': [type(error).__name__, str(error)]})
+
+    @staticmethod
+    def _decode(value):
+        """
+            保存した値を (結果, 例外) に戻す。
+        """
+        value = json.loads(value)
+        if 'error' in value:
+            name, message = value['error']
+            return None, _CACHEABLE_ERRORS.get(name, PageInfoError)(message)
+        return _to_tuple(value['result']), None
+
+    def _remember(self, key, value):
+        if self.maxsize <= 0:
+            return
+        self.entries[key] = value
+        self.entries.move_to_end(key)
+        while len(self.entries) > self.maxsize:
+            self.entries.popitem(last=False)
+
+    def get(self, digest, params):
+        """
+            (結果, 例外) を返す。キャッシュされていなければ None を返す。
+        """
+        key = (digest, params)
+        with self._lock:
+            value = self.entries.get(key)
+            if value is not None:
+                self.entries.move_to_end(key)
+            elif self._db is not None:
+                row = self._db.execute(
+                    'SELECT value FROM results WHERE digest = ? AND params = ?', key,
+                ).fetchone()
+                if row is not None:
+                    value = row[0]
+                    self._remember(key, value)
+            if value is None:
+                self.misses += 1
+                _count('result_cache.miss')
+                return None
+            self.hits += 1
+        _count('result_cache.hit')
+        return self._decode(value)
+
+    def put(self, digest, params, result=None, error=None):
+        """
+            結果を保存する。error が _CACHEABLE_ERRORS 以外の例外の場合は何もしない。
+        """
+        if error is not None and type(error) not in _CACHEABLE_ERRORS.values():
+            return
+        key = (digest, params)
+        value = self._encode(result, error)
+        with self._lock:
+            self._remember(key, value)
+            if self._db is not None:
+                self._db.execute('INSERT OR REPLACE INTO results VALUES (?, ?, ?)', (*key, value))
+                self._db.commit()
+
+    def get_or_compute(self, data, params, compute):
+        """
+            data のハッシュと params に対応する結果を返す。キャッシュされていなければ
+            compute() を呼んで結果を保存する。キャッシュされた例外は送出する。
+        """
+        digest = self.content_hash(data)
+        cached = self.get(digest, params)
+        if cached is None:
+            try:
+                result = compute()
+            except Exception as e:
+                self.put(digest, params, error=e)
+                raise
+            self.put(digest, params, result)
+            return result
+        result, error = cached
+        if error is not None:
+            raise error
+        return result
+
+    def get_file(self, path, stat, params):
+        """
+            path に対して put_file で記録したサイズと更新時刻が stat (os.stat_result) と
+            一致していれば、記録したハッシュに対応する (結果, 例外) を返す。
+            そうでなければ None を返す。
+        """
+        if self._db is None:
+            return None
+        with self._lock:
+            row = self._db.execute(
+                'SELECT digest FROM files WHERE path = ? AND params = ? AND size = ? AND mtime_ns = ?',
+                (path, params, stat.st_size, stat.st_mtime_ns),
+            ).fetchone()
+        if row is None:
+            return None
+        return self.get(row[0], params)
+
+    def put_file(self, path, stat, params, digest):
+        if self._db is None:
+            return
+        with self._lock:
+            self._db.execute(
+                'INSERT OR REPLACE INTO files VALUES (?, ?, ?, ?, ?)',
+                (path, params, stat.st_size, stat.st_mtime_ns, digest),
+            )
+            self._db.commit()
+
+    def prune(self):
+        """
+            現在の detector_fingerprint 以外で保存された結果を SQLite から削除し、削除した件数を返す。
+        """
+        if self._db is None:
+            return 0
+        pattern = f'%;{detector_fingerprint()}%'
+        with self._lock:
+            deleted = self._db.execute('DELETE FROM results WHERE params NOT LIKE ?', (pattern,)).rowcount
+            self._db.execute('DELETE FROM files WHERE params NOT LIKE ?', (pattern,))
+            self._db.commit()
+        return deleted
+
+    def close(self):
+        if self._db is not None:
+            self._db.close()
+            self._db = None
+
+
+@functools.lru_cache(maxsize=None)
+def get_result_cache(path=None, maxsize=1024):
+    """
+        path と maxsize に対応する ResultCache を返す。同じプロセス内では同じオブジェクトを使い回す。
+    """
+    return ResultCache(path, maxsize)
+
+
+VideoPage = collections.namedtuple('VideoPage', 'frame time pagenum pages lines')
+VideoPage.__doc__ = """
+    iter_video_pages が返す1ページ分の結果。
+
+    frame はページ情報を判定したフレームの番号 (0 始まり)、time はその再生位置 (秒)。
+"""
+
+
+def iter_video_pages(source, canonical_height=None, diff_threshold=DEFAULT_NEAR_DUPLICATE_THRESHOLD, frame_step=1,
+                     min_stable_frames=3):
+    """
+        ドロップ画面をスクロールしながら録画した動画から、ページごとにページ情報を求めて
+        VideoPage を yield する。同じページ情報は最初の1回だけ返す。
+
+        フレームは cv2.VideoCapture で読み込み、frame_step フレームごとに1枚を調べる
+        (間のフレームはデコードしない)。スクロールバー判定用の切り出し画像の縮小版
+        (NearDuplicateIndex と同じ指紋) を最後に判定したフレームと比べ、画素値の差の
+        最大値が diff_threshold を超えたフレームだけ guess_pageinfo と同じ判定を行う。
+        スクロール中の途中経過を拾わないよう、判定後に調べたフレームが min_stable_frames 枚
+        (判定したフレームを含む) 続けて変化しなかった場合にそのページ情報を返す。
+
+        左右の黒余白はフェードインなどで真っ黒なフレームもあるため判定するフレームごとに求め、
+        画面レイアウトは LayoutCache で使い回す。
+        ページ情報を判定できなかったフレーム (PageInfoError) は無視する。
+        動画を開けない場合は FileNotFoundError が発生する。
+    """
+    if frame_step < 1:
+        raise ValueError(f'frame_step must be >= 1: {frame_step}')
+    capture = cv2.VideoCapture(os.fspath(source))
+    if not capture.isOpened():
+        raise FileNotFoundError(f'Cannot read file: {source}')
+
+    layout_cache = LayoutCache()
+    reference = None
+    page = None
+    stable = 0
+    emitted = set()
+    try:
+        for frame_index in itertools.count():
+            if frame_index % frame_step:
+                if not capture.grab():
+                    break
+                continue
+            ok, frame = capture.read()
+            if not ok:
+                break
+            analysis = ScreenAnalysis(frame, layout_cache=layout_cache, canonical_height=canonical_height)
+            fingerprint = analysis.scrollbar_fingerprint
+            if reference is not None and np.abs(fingerprint[1] - reference[1]).max() <= diff_threshold:
+                stable += 1
+                _count('video.skipped_frames')
+            else:
+                reference = fingerprint
+                stable = 1
+                time_sec = capture.get(cv2.CAP_PROP_POS_MSEC) / 1000
+                try:
+                    page = VideoPage(frame_index, time_sec, *analysis.guess_pageinfo())
+                except PageInfoError as e:
+                    logger.debug('frame %s: %s', frame_index, _format_error(e))
+                    page = None
+                _count('video.analyzed_frames')
+            if page is not None and stable >= min_stable_frames and page[2:] not in emitted:
+                emitted.add(page[2:])
+                yield page
+    finally:
+        capture.release()
+
+
+BatchResult = collections.namedtuple('BatchResult', ['index', 'source', 'value', 'error'])
+BatchResult.__doc__ = """
+    guess_pageinfo_many / detect_qp_region_many の1件分の結果。
+
+    index は入力の順番、source は入力がパスの場合はそのパス (配列やバイト列の場合は None)。
+    成功時は value に検出結果が、失敗時は error に送出された例外が入る。
+"""
+
+
+def _init_worker():
+    """
+        プロセスプールの各ワーカーで最初に1度だけ呼ばれる初期化処理
+    """
+    _load_next_button_template()
+
+
+def _load_item(item, imread_flags):
+    """
+        パス、エンコード済み画像のバイト列または画像 (ndarray) から画像を得る。
+    """
+    if isinstance(item, (bytes, bytearray, memoryview)):
+        return decode_image(item, imread_flags)
+    if not isinstance(item, (str, os.PathLike)):
+        return item
+    source = os.fspath(item)
+    im = cv2.imread(source, imread_flags)
+    if im is None:
+        raise FileNotFoundError(f'Cannot read file: {source}')
+    return im
+
+
+def _call_with_item(func, item, kwargs, imread_flags):
+    return func(_load_item(item, imread_flags), **kwargs)
+
+
+def _run_batch_chunk(func, chunk, kwargs, imread_flags):
+    results = []
+    for index, item in chunk:
+        source = os.fspath(item) if isinstance(item, (str, os.PathLike)) else None
+        try:
+            results.append(BatchResult(index, source, _call_with_item(func, item, kwargs, imread_flags), None))
+        except Exception as e:
+            logger.debug('batch item %s failed: %r', index, e)
+            results.append(BatchResult(index, source, None, e))
+    return results
+
+
+def _iter_chunks(items, chunksize):
+    chunk = []
+    for index, item in enumerate(items):
+        chunk.append((index, item))
+        if len(chunk) >= chunksize:
+            yield chunk
+            chunk = []
+    if chunk:
+        yield chunk
+
+
+def _run_many(func, items, kwargs, max_workers=None, chunksize=1, ordered=True, imread_flags=_IMREAD_COLOR):
+    """
+        func を items の各要素に対しプロセスプールで並列に適用し、
+        BatchResult を順次 yield する。
+
+        ordered が真なら入力順、偽なら処理が終わった順に返す。
+        items にパスが含まれる場合は imread_flags で読み込む。
+        メモリ使用量を抑えるため、同時に投入するチャンク数はワーカー数の
+        2倍までに制限する。
+    """
+    if chunksize < 1:
+        raise ValueError(f'chunksize must be >= 1: {chunksize}')
+    import concurrent.futures
+
+    if max_workers is None:
+        max_workers = os.cpu_count() or 1
+    max_pending = max_workers * 2
+
+    with concurrent.futures.ProcessPoolExecutor(max_workers=max_workers, initializer=_init_worker) as executor:
+        chunks = _iter_chunks(items, chunksize)
+        pending = set()
+        done_results = {}
+        next_index = 0
+        exhausted = False
+
+        try:
+            while pending or not exhausted:
+                while not exhausted and len(pending) < max_pending:
+                    chunk = next(chunks, None)
+                    if chunk is None:
+                        exhausted = True
+                        break
+                    pending.add(executor.submit(_run_batch_chunk, func, chunk, kwargs, imread_flags))
+
+                if not pending:
+                    break
+
+                done, pending = concurrent.futures.wait(pending, return_when=concurrent.futures.FIRST_COMPLETED)
+                for future in done:
+                    for result in future.result():
+                        if ordered:
+                            done_results[result.index] = result
+                        else:
+                            yield result
+
+                while next_index in done_results:
+                    yield done_results.pop(next_index)
+                    next_index += 1
+        finally:
+            for future in pending:
+                future.cancel()
+
+
+def guess_pageinfo_many(items, max_workers=None, chunksize=1, ordered=True, **kwargs):
+    """
+        複数の画像に対して guess_pageinfo をプロセスプールで並列に実行する。
+
+        items にはファイルパス、画像 (ndarray) またはエンコード済み画像のバイト列
+        (bytes または bytearray) を並べたイテラブルを渡す。
+        パスとバイト列の画像はグレースケールでデコードする。
+        戻り値は BatchResult のイテレータ。個々の画像で発生した例外は
+        BatchResult.error に格納され、処理全体は中断しない。
+        kwargs は guess_pageinfo にそのまま渡される。near_duplicates に NearDuplicateIndex を
+        渡すと、ワーカーごとにほぼ同一の画像の結果を使い回す。
+    """
+    return _run_many(guess_pageinfo, items, kwargs, max_workers, chunksize, ordered, cv2.IMREAD_GRAYSCALE)
+
+
+def detect_qp_region_many(items, mode=QPDetectionMode.JP.value, max_workers=None, chunksize=1, ordered=True, **kwargs):
+    """
+        複数の画像に対して detect_qp_region をプロセスプールで並列に実行する。
+
+        引数および戻り値は guess_pageinfo_many と同様。
+    """
+    kwargs['mode'] = mode
+    return _run_many(detect_qp_region, items, kwargs, max_workers, chunksize, ordered)
+
+
+class AsyncAnalyzer:
+    """
+        asyncio のイベントループをブロックせずに guess_pageinfo と detect_qp_region を
+        実行するためのもの。画像の読み込み・デコードも含めて executor で実行する。
+
+        executor を省略すると max_workers スレッドの ThreadPoolExecutor を作り、
+        close() で終了させる。OpenCV の処理の大半は GIL を解放するのでスレッドでも
+        並列に動く。ProcessPoolExecutor を渡す場合、入力は pickle できるもの
+        (パス、bytes、ndarray) に限られる。
+        max_concurrency を指定すると、同時に executor に投入する件数をその数までに制限する。
+        制限はイベントループごとに数えるので、asyncio.run を繰り返して使い回してもよい。
+        待っている側のタスクがキャンセルされた場合、まだ始まっていない処理は取り消す。
+        実行中の処理は止められないので、終わるまで同時実行数の枠を占有する。
+
+        各メソッドの入力にはパス、エンコード済み画像のバイト列、画像 (ndarray) を渡せ、
+        戻り値は同期版の関数と同じ。kwargs はそのまま同期版の関数に渡される。
+        LayoutCache はスレッドセーフではないので、スレッドで実行する場合は渡さないこと。
+    """
+    def __init__(self, executor=None, max_workers=None, max_concurrency=None):
+        import concurrent.futures
+        import weakref
+        self._owns_executor = executor is None
+        if executor is None:
+            executor = concurrent.futures.ThreadPoolExecutor(max_workers=max_workers, thread_name_prefix='pageinfo')
+        self.executor = executor
+        self.max_concurrency = max_concurrency
+        # asyncio.Semaphore は最初に待たせたイベントループに結び付くので、ループごとに作る
+        self._semaphores = weakref.WeakKeyDictionary()
+
+    async def _submit(self, func, item, kwargs, imread_flags):
+        import asyncio
+        loop = asyncio.get_running_loop()
+        semaphore = None
+        if self.max_concurrency is not None:
+            semaphore = self._semaphores.get(loop)
+            if semaphore is None:
+                semaphore = self._semaphores[loop] = asyncio.Semaphore(self.max_concurrency)
+
+        if semaphore is not None:
+            await semaphore.acquire()
+        try:
+            future = self.executor.submit(_call_with_item, func, item, kwargs, imread_flags)
+        except BaseException:
+            if semaphore is not None:
+                semaphore.release()
+            raise
+
+        if semaphore is not None:
+            def release(_, loop=loop, semaphore=semaphore):
+                # キャンセルされても実行中だった処理は最後まで動くので、枠は完了時に返す。
+                # 返す先はセマフォを取得したイベントループ
+                try:
+                    loop.call_soon_threadsafe(semaphore.release)
+                except RuntimeError:
+                    # イベントループが既に閉じられている
+                    pass
+            future.add_done_callback(release)
+
+        # wrap_future で得た Future をキャンセルすると future.cancel() も呼ばれる
+        return await asyncio.wrap_future(future)
+
+    async def guess_pageinfo(self, item, imread_flags=_IMREAD_GRAYSCALE, **kwargs):
+        return await self._submit(guess_pageinfo, item, kwargs, imread_flags)
+
+    async def detect_qp_region(self, item, mode=QPDetectionMode.JP.value, imread_flags=_IMREAD_COLOR, **kwargs):
+        kwargs['mode'] = mode
+        return await self._submit(detect_qp_region, item, kwargs, imread_flags)
+
+    def close(self):
+        if self._owns_executor:
+            self.executor.shutdown(wait=False)
+
+    async def __aenter__(self):
+        return self
+
+    async def __aexit__(self, *exc_info):
+        self.close()
+        return False
+
+
+async def guess_pageinfo_async(item, executor=None, imread_flags=_IMREAD_GRAYSCALE, **kwargs):
+    """
+        guess_pageinfo を executor (省略時はイベントループの既定の executor) で実行する。
+        同時実行数の制限が必要な場合は AsyncAnalyzer を使う。
+    """
+    import asyncio
+    loop = asyncio.get_running_loop()
+    return await loop.run_in_executor(executor, _call_with_item, guess_pageinfo, item, kwargs, imread_flags)
+
+
+async def detect_qp_region_async(item, mode=QPDetectionMode.JP.value, executor=None, imread_flags=_IMREAD_COLOR,
+                                 **kwargs):
+    """
+        detect_qp_region を executor (省略時はイベントループの既定の executor) で実行する。
+        同時実行数の制限が必要な場合は AsyncAnalyzer を使う。
+    """
+    import asyncio
+    kwargs['mode'] = mode
+    loop = asyncio.get_running_loop()
+    return await loop.run_in_executor(executor, _call_with_item, detect_qp_region, item, kwargs, imread_flags)
+
+
+def _debug_enabled(args):
+    return args.debug_sc or args.debug_sc_on_failure
+
+
+def _debug_predicate(args):
+    return is_detection_failure if args.debug_sc_on_failure else None
+
+
+def _debug_image_path(filename, args, kind):
+    if not _debug_enabled(args):
+        return None
+    debug_sc_dir = os.path.join(args.debug_out_dir, kind)
+    os.makedirs(debug_sc_dir, exist_ok=True)
+    prefix = args.debug_out_file_prefix
+    basename = 'stdin.png' if filename == '-' else os.path.basename(filename)
+    if args.debug_format:
+        basename = os.path.splitext(basename)[0] + '.' + args.debug_format
+    debug_image = os.path.join(debug_sc_dir, prefix + basename)
+    logger.debug('debug image path: %s', debug_image)
+    return debug_image
+
+
+def _page_result(analysis, filename, args):
+    debug_image = _debug_image_path(filename, args, 'page')
+    pagenum, pages, lines = analysis.guess_pageinfo(args.debug_sc, debug_image, _debug_predicate(args))
+    logger.debug('pagenum: %s, pages: %s, lines: %s', pagenum, pages, lines)
+    return (pagenum, pages, lines)
+
+
+def _qp_result(analysis, filename, args):
+    debug_image = _debug_image_path(filename, args, 'qp')
+    result = analysis.detect_qp_region(args.mode, args.debug_sc, debug_image, _debug_predicate(args))
+    if result is None:
+        return None, None
+    return result
+
+
+def _new_analysis(im, args):
+    layout_cache = get_layout_cache(args.layout_cache) if args.layout_cache else None
+    near_duplicates = None
+    if args.near_duplicate is not None:
+        near_duplicates = get_near_duplicate_index(args.near_duplicate)
+    return ScreenAnalysis(
+        im, layout_cache=layout_cache, canonical_height=args.canonical_height, near_duplicates=near_duplicates,
+    )
+
+
+def look_into_file_for_page(filename, im, args):
+    return _page_result(_new_analysis(im, args), filename, args)
+
+
+def look_into_file_for_qp(filename, im, args):
+    return _qp_result(_new_analysis(im, args), filename, args)
+
+
+def look_into_file_for_all(filename, im, args):
+    """
+        1回のデコードでページ情報と QP 領域の両方を求める。
+    """
+    analysis = _new_analysis(im, args)
+    return (*_page_result(analysis, filename, args), *_qp_result(analysis, filename, args))
+
+
+def _cli_result_cache(args):
+    if not args.cache and args.cache_size <= 0:
+        return None
+    return get_result_cache(args.cache, args.cache_size)
+
+
+def look_into_file(filename, args):
+    logger.debug(f'===== {filename}')
+
+    cache = _cli_result_cache(args)
+    if cache is not None:
+        return _look_into_file_cached(filename, args, cache)
+    if filename == '-':
+        im = decode_image(sys.stdin.buffer.read(), args.imread_flags)
+    else:
+        im = cv2.imread(filename, args.imread_flags)
+    if im is None:
+        raise FileNotFoundError(f'Cannot read file: {filename}')
+    return look_into_image(filename, im, args)
+
+
+def _look_into_file_cached(filename, args, cache):
+    """
+        ResultCache を使って look_into_file と同じ処理を行う。
+
+        --resume のときはパス、サイズ、更新時刻が前回と同じファイルは読まずに結果を返す。
+        デバッグ画像を出力する場合は、画像を書き出すためにキャッシュを参照せずに判定する。
+    """
+    params = result_cache_params(
+        args.subcommand, getattr(args, 'mode', None), args.canonical_height, args.near_duplicate,
+    )
+    use_cached = not _debug_enabled(args)
+    stat = None
+    if filename == '-':
+        data = sys.stdin.buffer.read()
+    else:
+        stat = os.stat(filename)
+        if args.resume and use_cached:
+            cached = cache.get_file(filename, stat, params)
+            if cached is not None:
+                logger.debug('resumed from the result cache')
+                return _unpack_cached(cached)
+        with open(filename, 'rb') as f:
+            data = f.read()
+
+    digest = cache.content_hash(data)
+    cached = cache.get(digest, params) if use_cached else None
+    if cached is None:
+        try:
+            im = decode_image(data, args.imread_flags)
+        except ImageDecodeError:
+            raise FileNotFoundError(f'Cannot read file: {filename}') from None
+        try:
+            cached = (look_into_image(filename, im, args), None)
+        except Exception as e:
+            cached = (None, e)
+        cache.put(digest, params, *cached)
+    if stat is not None:
+        cache.put_file(filename, stat, params, digest)
+    return _unpack_cached(cached)
+
+
+def _unpack_cached(cached):
+    result, error = cached
+    if error is not None:
+        raise error
+    return result
+
+
+def look_into_bytes(data, args, name='-'):
+    """
+        エンコード済み画像のバイト列に対して look_into_file と同じ処理を行う。
+        name はデバッグ画像のファイル名などに使われる。
+    """
+    logger.debug(f'===== {name}')
+    return look_into_image(name, decode_image(data, args.imread_flags), args)
+
+
+def look_into_image(filename, im, args):
+    im_h, im_w = im.shape[:2]
+    logger.debug('image size: (width, height) = (%s, %s)', im_w, im_h)
+    _count('image.width', im_w)
+    _count('image.height', im_h)
+
+    return args.func(filename, im, args)
+
+
+def _look_into_file_timed(filename, args, profiler=None):
+    """
+        look_into_file を実行し、(結果, 例外, 所要時間[秒], プロファイル) を返す。
+        例外は送出せずに戻り値として返す。
+        プロファイルは args.profile が指定されたときの FileProfile で、それ以外は None。
+        profiler (cProfile.Profile) を渡すと、look_into_file の実行中だけ有効にする。
+    """
+    if args.profile:
+        return _look_into_file_profiled(filename, args, profiler)
+    start = time.perf_counter()
+    try:
+        result = look_into_file(filename, args)
+        error = None
+    except Exception as e:
+        result = None
+        error = e
+    return result, error, time.perf_counter() - start, None
+
+
+FileProfile = collections.namedtuple('FileProfile', 'filename elapsed peak_memory width height contours stages')
+FileProfile.__doc__ = """
+    1ファイル分のプロファイル結果。
+
+    peak_memory はバイト単位、contours は検出処理ごとの輪郭数 ({'page': 123} など)、
+    stages は 処理段階 -> (所要時間[秒], メモリのピーク[バイト]) の dict。
+"""
+
+
+def _look_into_file_profiled(filename, args, profiler=None):
+    """
+        計測シンクと tracemalloc を有効にして look_into_file を実行する。
+    """
+    import tracemalloc
+    if not tracemalloc.is_tracing():
+        tracemalloc.start()
+    tracemalloc.clear_traces()
+    sink = ProfilingSink()
+    previous = set_instrumentation_sink(sink)
+    start = time.perf_counter()
+    try:
+        if profiler is not None:
+            profiler.enable()
+        result = look_into_file(filename, args)
+        error = None
+    except Exception as e:
+        result = None
+        error = e
+    finally:
+        if profiler is not None:
+            profiler.disable()
+        elapsed = time.perf_counter() - start
+        set_instrumentation_sink(previous)
+    _, peak = tracemalloc.get_traced_memory()
+
+    profile = FileProfile(
+        filename=filename,
+        elapsed=elapsed,
+        peak_memory=max(peak, sink.peak),
+        width=sink.counters.get('image.width'),
+        height=sink.counters.get('image.height'),
+        contours={
+            name: sink.counters[f'{name}.contours'] for name in ('page', 'qp') if f'{name}.contours' in sink.counters
+        },
+        stages={name: (stats[1], sink.peaks.get(name)) for name, stats in sink.spans.items()},
+    )
+    return result, error, elapsed, profile
+
+
+def _format_bytes(n):
+    if n is None:
+        return '-'
+    return f'{n / 1024:.1f}'
+
+
+def print_profile_report(profiles, top=10, f=None):
+    """
+        FileProfile のリストから、処理段階ごとの集計と処理の遅いファイルの一覧を出力する。
+    """
+    if f is None:
+        f = sys.stderr
+    if not profiles:
+        return
+    total = sum(p.elapsed for p in profiles)
+    print(f'== profile: {len(profiles)} files, {total:.3f} s', file=f)
+
+    stages = {}
+    for p in profiles:
+        for name, (elapsed, peak) in p.stages.items():
+            stats = stages.setdefault(name, [0, 0.0, 0.0, None])
+            stats[0] += 1
+            stats[1] += elapsed
+            stats[2] = max(stats[2], elapsed)
+            if peak is not None:
+                stats[3] = peak if stats[3] is None else max(stats[3], peak)
+    print(f'{"stage":<24} {"calls":>6} {"total(ms)":>10} {"mean(ms)":>9} {"max(ms)":>9} {"peak(KiB)":>10}', file=f)
+    for name, (calls, elapsed, max_elapsed, peak) in sorted(stages.items(), key=lambda item: -item[1][1]):
+        print(
+            f'{name:<24} {calls:>6} {elapsed * 1000:>10.1f} {elapsed / calls * 1000:>9.2f} '
+            f'{max_elapsed * 1000:>9.2f} {_format_bytes(peak):>10}',
+            file=f,
+        )
+
+    slowest = sorted(profiles, key=lambda p: p.elapsed, reverse=True)[:top]
+    print(f'== slowest {len(slowest)} files', file=f)
+    print(f'{"elapsed(ms)":>11} {"peak(KiB)":>10} {"size":>11} {"contours":>16}  filename', file=f)
+    for p in slowest:
+        size = f'{p.width}x{p.height}' if p.width is not None else '-'
+        contours = ' '.join(f'{name}:{n}' for name, n in p.contours.items()) or '-'
+        print(
+            f'{p.elapsed * 1000:>11.2f} {_format_bytes(p.peak_memory):>10} {size:>11} {contours:>16}  {p.filename}',
+            file=f,
+        )
+
+
+def _format_error(error):
+    return f'{type(error).__name__}: {error}'
+
+
+class CsvResultWriter:
+    """
+        結果を1行ずつ CSV で書き出す。値が None の列 (QP 領域が見つからない場合など) は空にする。
+        失敗した行は結果の列を空にし、末尾の列にエラーメッセージを出力する。
+        error_column が真の場合は成功した行にも空のエラー列を出力し、列の数を揃える。
+    """
+    def __init__(self, f, fields, error_column=False):
+        self.f = f
+        self.fields = fields
+        self.error_column = error_column
+        import csv
+        self.writer = csv.writer(f, lineterminator='\n')
+
+    def write(self, filename, result, error=None, elapsed=None):
+        if error is None:
+            row = (filename, *('' if value is None else value for value in result))
+            if self.error_column:
+                row += ('',)
+        else:
+            row = (filename, *([''] * len(self.fields)), _format_error(error))
+        self.writer.writerow(row)
+        self.f.flush()
+
+
+class JsonLinesResultWriter:
+    """
+        結果を1行1オブジェクトの JSON Lines で書き出す。
+        所要時間とエラーの情報も含める。error 列は常に出力するので error_column は無視する。
+    """
+    def __init__(self, f, fields, error_column=False):
+        self.f = f
+        self.fields = fields
+
+    def write(self, filename, result, error=None, elapsed=None):
+        record = {'filename': filename}
+        if error is None:
+            record.update(zip(self.fields, result))
+        else:
+            record.update((field, None) for field in self.fields)
+        record['error'] = None if error is None else _format_error(error)
+        record['elapsed'] = None if elapsed is None else round(elapsed, 6)
+        self.f.write(json.dumps(record, ensure_ascii=False) + '\n')
+        self.f.flush()
+
+
+RESULT_WRITERS = {
+    'csv': CsvResultWriter,
+    'jsonl': JsonLinesResultWriter,
+}
+
+
+DEFAULT_IMAGE_EXTENSIONS = ('.png', '.jpg', '.jpeg', '.bmp', '.webp', '.tif', '.tiff')
+
+
+def _match_any(patterns, relpath, name):
+    import fnmatch
+    return any(fnmatch.fnmatch(relpath, p) or fnmatch.fnmatch(name, p) for p in patterns)
+
+
+def _scan_image_files(topdir, recursive=False, include=None, exclude=None, extensions=DEFAULT_IMAGE_EXTENSIONS):
+    """
+        ディレクトリ配下の画像ファイルのパスを os.scandir で走査しながら yield する。
+
+        include/exclude は glob パターンのリストで、topdir からの相対パスまたは
+        ファイル名に対して照合する。exclude に一致したディレクトリは降りない。
+        extensions は小文字の拡張子 ('.png' など) のタプル。
+        出力順を安定させるため、ディレクトリごとにエントリを名前順に並べる。
+    """
+    extensions = tuple(e.lower() for e in extensions)
+    stack = [topdir]
+    while stack:
+        current = stack.pop()
+        try:
+            with os.scandir(current) as it:
+                entries = sorted(it, key=lambda e: e.name)
+        except OSError as e:
+            logger.warning('cannot scan directory: %s (%s)', current, e)
+            continue
+
+        subdirs = []
+        for entry in entries:
+            relpath = os.path.relpath(entry.path, topdir)
+            if exclude and _match_any(exclude, relpath, entry.name):
+                continue
+            if entry.is_dir(follow_symlinks=False):
+                if recursive:
+                    subdirs.append(entry.path)
+                continue
+            if not entry.is_file():
+                continue
+            if os.path.splitext(entry.name)[1].lower() not in extensions:
+                continue
+            if include and not _match_any(include, relpath, entry.name):
+                continue
+            yield entry.path
+
+        # 名前順に処理されるよう逆順に積む
+        stack.extend(reversed(subdirs))
+
+
+def _expand_filenames(filenames, recursive=False, include=None, exclude=None, extensions=DEFAULT_IMAGE_EXTENSIONS):
+    """
+        コマンドライン引数のファイル名を展開する。
+        ディレクトリは _scan_image_files で走査し、ファイルはそのまま yield する。
+    """
+    for filename in filenames:
+        if os.path.isdir(filename):
+            yield from _scan_image_files(filename, recursive, include, exclude, extensions)
+        else:
+            yield filename
+
+
+def _file_size_or_zero(filename):
+    try:
+        return os.path.getsize(filename)
+    except OSError:
+        return 0
+
+
+def _new_debug_image_writer(args):
+    if not _debug_enabled(args):
+        return None
+    return DebugImageWriter(args.debug_queue, args.debug_quality)
+
+
+def _init_cli_worker(args):
+    _init_worker()
+    writer = _new_debug_image_writer(args)
+    if writer is not None:
+        set_debug_image_writer(writer)
+        # ワーカープロセスの終了時には atexit が呼ばれないので、
+        # multiprocessing の終了処理でキューに残った画像を書き出す
+        import multiprocessing.util
+        multiprocessing.util.Finalize(writer, writer.close, exitpriority=10)
+
+
+def _look_into_files_parallel(filenames, args, jobs):
+    """
+        look_into_file を複数プロセスで実行し、(ファイル名, 結果) を filenames の順に yield する。
+
+        filenames はイテレータでもよく、列挙を待たずに少しずつ投入する。
+        処理時間はおおむね画像のサイズに比例するため、投入するまとまりの
+        中では大きいファイルから先に投入して、最後に一部のワーカーだけが
+        働いている状態を短くする。
+    """
+    import argparse
+    import concurrent.futures
+
+    # 出力先のファイルオブジェクトはワーカーに渡せないので除外する
+    worker_args = argparse.Namespace(**{k: v for k, v in vars(args).items() if k != 'output'})
+    filenames = iter(filenames)
+    window = jobs * 4
+    pending = collections.deque()
+
+    with concurrent.futures.ProcessPoolExecutor(
+        max_workers=jobs, initializer=_init_cli_worker, initargs=(worker_args,),
+    ) as executor:
+        def submit_batch():
+            batch = list(itertools.islice(filenames, window))
+            futures = [None] * len(batch)
+            for i in sorted(range(len(batch)), key=lambda i: _file_size_or_zero(batch[i]), reverse=True):
+                futures[i] = executor.submit(_look_into_file_timed, batch[i], worker_args)
+            pending.extend(zip(batch, futures))
+
+        try:
+            submit_batch()
+            while pending:
+                if len(pending) <= window:
+                    submit_batch()
+                filename, future = pending.popleft()
+                yield filename, future.result()
+        finally:
+            for _, future in pending:
+                future.cancel()
+
+
+def main(args):
+    filenames = _expand_filenames(
+        args.filename,
+        recursive=args.recursive,
+        include=args.include,
+        exclude=args.exclude,
+        extensions=args.extension or DEFAULT_IMAGE_EXTENSIONS,
+    )
+    jobs = args.jobs or os.cpu_count() or 1
+
+    import tracemalloc
+    stop_tracing = False
+    if args.profile and not tracemalloc.is_tracing():
+        tracemalloc.start()
+        stop_tracing = True
+    profiler = None
+    if args.profile_stats:
+        import cProfile
+        profiler = cProfile.Profile()
+
+    debug_image_writer = None
+    if jobs > 1:
+        results = _look_into_files_parallel(filenames, args, jobs)
+    else:
+        debug_image_writer = _new_debug_image_writer(args)
+        results = ((filename, _look_into_file_timed(filename, args, profiler)) for filename in filenames)
+    previous_debug_image_writer = set_debug_image_writer(debug_image_writer)
+
+    writer = RESULT_WRITERS[args.format](args.output, args.result_fields, error_column=args.keep_going)
+    profiles = []
+    try:
+        for filename, (result, error, elapsed, profile) in results:
+            if profile is not None:
+                profiles.append(profile)
+            if error is not None and not args.keep_going:
+                raise error
+            if error is not None:
+                logger.error('%s: %s', filename, _format_error(error))
+            writer.write(filename, result, error, elapsed)
+        cache = _cli_result_cache(args)
+        if cache is not None and jobs == 1:
+            logger.info('result cache: %s hits, %s misses', cache.hits, cache.misses)
+    finally:
+        if args.profile:
+            print_profile_report(profiles, args.profile)
+        if profiler is not None:
+            profiler.dump_stats(args.profile_stats)
+        if stop_tracing:
+            tracemalloc.stop()
+        if debug_image_writer is not None:
+            debug_image_writer.close()
+        set_debug_image_writer(previous_debug_image_writer)
+
+
+def video(args):
+    """
+        video サブコマンド。動画ファイルごとに iter_video_pages の結果を1ページ1行で書き出す。
+    """
+    writer = RESULT_WRITERS[args.format](args.output, VideoPage._fields, error_column=args.keep_going)
+    for filename in args.filename:
+        logger.debug(f'===== {filename}')
+        try:
+            for page in iter_video_pages(
+                filename, args.canonical_height, args.diff_threshold, args.frame_step, args.min_stable_frames,
+            ):
+                writer.write(filename, page._replace(time=round(page.time, 3)))
+        except Exception as e:
+            if not args.keep_going:
+                raise
+            logger.error('%s: %s', filename, _format_error(e))
+            writer.write(filename, None, e)
+
+
+# serve と worker のワーカーで使う ResultCache。--cache も --cache-size も指定されなければ None。
+_serve_result_cache = None
+
+
+def _set_serve_result_cache(cache_path=None, cache_size=0):
+    global _serve_result_cache
+    if cache_path or cache_size > 0:
+        _serve_result_cache = get_result_cache(cache_path, cache_size)
+    else:
+        _serve_result_cache = None
+
+
+def _detect_as_dict(kind, item, mode=QPDetectionMode.JP.value, canonical_height=None):
+    """
+        serve と worker で1件の画像を処理し、JSON にできる dict を返す。
+        kind は 'page', 'qp', 'all' のいずれか。item はパスまたはエンコード済み画像のバイト列。
+        ResultCache が設定されていれば、同じ内容の画像に対しては前回の結果を返す。
+    """
+    cache = _serve_result_cache
+    if cache is None:
+        return _detect_as_dict_uncached(kind, item, mode, canonical_height)
+    if not isinstance(item, (bytes, bytearray, memoryview)):
+        with open(item, 'rb') as f:
+            item = f.read()
+    params = result_cache_params(f'dict-{kind}', mode, canonical_height)
+    return cache.get_or_compute(
+        item, params, functools.partial(_detect_as_dict_uncached, kind, item, mode, canonical_height),
+    )
+
+
+def _detect_as_dict_uncached(kind, item, mode, canonical_height):
+    flags = cv2.IMREAD_GRAYSCALE if kind == 'page' else cv2.IMREAD_COLOR
+    analysis = ScreenAnalysis(_load_item(item, flags), canonical_height=canonical_height)
+    response = {}
+    if kind in ('page', 'all'):
+        response.update(zip(('pagenum', 'pages', 'lines'), analysis.guess_pageinfo()))
+    if kind in ('qp', 'all'):
+        qp = analysis.detect_qp_region(mode)
+        response['topleft'], response['bottomright'] = qp if qp is not None else (None, None)
+    return response
+
+
+def _init_serve_worker(cache_path=None, cache_size=0):
+    import signal
+    # Ctrl-C はサーバ側で受けて executor を終了させるので、ワーカーでは無視する
+    signal.signal(signal.SIGINT, signal.SIG_IGN)
+    _init_worker()
+    _set_serve_result_cache(cache_path, cache_size)
+
+
+def _warm_up_worker():
+    return os.getpid()
+
+
+class _PageInfoHTTPServerMixin:
+    """
+        画像を受け取ってページ情報と QP 領域を JSON で返す HTTP サーバ。
+        http.server を import せずに済むよう、実際のクラス PageInfoHTTPServer は
+        _http_server_class() で初めて使うときに作る。
+
+        POST /page, /qp, /all に画像ファイルの中身をそのまま送ると、それぞれ
+        {"pagenum", "pages", "lines"}, {"topleft", "bottomright"}, その両方を返す。
+        /qp と /all はクエリ文字列 mode=jp|na を受け付ける。
+        GET /stats はリクエスト数や処理時間などの統計を返す。
+
+        画像の処理は executor で行う。受け付け済みで処理が終わっていないリクエストが
+        max_queue 件に達している場合は 503 を返す (None なら制限しない)。
+        backlog は listen(2) の backlog。
+    """
+    daemon_threads = True
+    endpoints = ('page', 'qp', 'all')
+
+    def __init__(self, address, executor, max_queue=None, backlog=64, canonical_height=None,
+                 max_body_size=32 * 1024 * 1024):
+        # server_activate で listen に渡される
+        self.request_queue_size = backlog
+        self.executor = executor
+        self.max_queue = max_queue
+        self.canonical_height = canonical_height
+        self.max_body_size = max_body_size
+        self.started = time.monotonic()
+        self.lock = threading.Lock()
+        self.in_flight = 0
+        self.stats = AggregatingSink()
+        super().__init__(address, self.handler_class)
+
+    def try_acquire(self):
+        with self.lock:
+            if self.max_queue is not None and self.in_flight >= self.max_queue:
+                return False
+            self.in_flight += 1
+            return True
+
+    def release(self):
+        with self.lock:
+            self.in_flight -= 1
+
+    def record(self, endpoint, status, elapsed=None):
+        with self.lock:
+            self.stats.count('requests')
+            self.stats.count(f'status.{status}')
+            if elapsed is not None:
+                self.stats.span(endpoint, elapsed)
+
+    def stats_snapshot(self):
+        with self.lock:
+            latency = {
+                name: {
+                    'count': count,
+                    'mean_ms': round(total / count * 1000, 3),
+                    'max_ms': round(max_elapsed * 1000, 3),
+                }
+                for name, (count, total, max_elapsed) in self.stats.spans.items()
+            }
+            return {
+                'uptime': round(time.monotonic() - self.started, 3),
+                'in_flight': self.in_flight,
+                'max_queue': self.max_queue,
+                'backlog': self.request_queue_size,
+                'counters': dict(self.stats.counters),
+                'latency': latency,
+            }
+
+
+class _PageInfoRequestHandlerMixin:
+    protocol_version = 'HTTP/1.1'
+    server_version = 'pageinfo'
+
+    def log_message(self, format, *args):
+        logger.debug('%s - %s', self.address_string(), format % args)
+
+    def _send_json(self, status, body, headers=()):
+        data = json.dumps(body, ensure_ascii=False).encode('utf-8')
+        self.send_response(status)
+        self.send_header('Content-Type', 'application/json; charset=utf-8')
+        self.send_header('Content-Length', str(len(data)))
+        for name, value in headers:
+            self.send_header(name, value)
+        self.end_headers()
+        self.wfile.write(data)
+
+    def _send_error_json(self, endpoint, status, message, headers=()):
+        self.server.record(endpoint, status)
+        self._send_json(status, {'error': message}, headers)
+
+    def do_GET(self):
+        import urllib.parse
+        path = urllib.parse.urlsplit(self.path).path
+        if path == '/stats':
+            self._send_json(200, self.server.stats_snapshot())
+        else:
+            self._send_error_json(path, 404, f'not found: {path}')
+
+    def do_POST(self):
+        import urllib.parse
+        url = urllib.parse.urlsplit(self.path)
+        endpoint = url.path.strip('/')
+        length = self.headers.get('Content-Length')
+        if length is None:
+            self.close_connection = True
+            self._send_error_json(endpoint, 411, 'Content-Length is required')
+            return
+        try:
+            length = int(length)
+            if length < 0:
+                raise ValueError
+        except ValueError:
+            self.close_connection = True
+            self._send_error_json(endpoint, 400, f'invalid Content-Length: {length}')
+            return
+        if length > self.server.max_body_size:
+            self.close_connection = True
+            self._send_error_json(endpoint, 413, f'request body is too large: {length} bytes')
+            return
+        data = self.rfile.read(length)
+
+        if endpoint not in self.server.endpoints:
+            self._send_error_json(endpoint, 404, f'not found: {url.path}')
+            return
+        query = urllib.parse.parse_qs(url.query)
+        mode = query.get('mode', [QPDetectionMode.JP.value])[0]
+        if mode not in QPDetectionMode.values():
+            self._send_error_json(endpoint, 400, f'unknown mode: {mode}')
+            return
+
+        if not self.server.try_acquire():
+            self._send_error_json(endpoint, 503, 'too many requests in progress', [('Retry-After', '1')])
+            return
+        start = time.perf_counter()
+        try:
+            future = self.server.executor.submit(_detect_as_dict, endpoint, data, mode, self.server.canonical_height)
+            result = future.result()
+        except ImageDecodeError as e:
+            self._send_error_json(endpoint, 400, _format_error(e))
+        except PageInfoError as e:
+            self._send_error_json(endpoint, 422, _format_error(e))
+        except Exception as e:
+            logger.exception('failed to process a request')
+            self._send_error_json(endpoint, 500, _format_error(e))
+        else:
+            self.server.record(endpoint, 200, time.perf_counter() - start)
+            self._send_json(200, result)
+        finally:
+            self.server.release()
+
+
+@functools.lru_cache(maxsize=None)
+def _http_server_class():
+    import http.server
+
+    handler_class = type(
+        '_PageInfoRequestHandler', (_PageInfoRequestHandlerMixin, http.server.BaseHTTPRequestHandler), {},
+    )
+    return type(
+        'PageInfoHTTPServer',
+        (_PageInfoHTTPServerMixin, http.server.ThreadingHTTPServer),
+        {'handler_class': handler_class, '__doc__': _PageInfoHTTPServerMixin.__doc__, '__module__': __name__},
+    )
+
+
+def serve(args):
+    """
+        serve サブコマンド。ワーカープロセスを起動してテンプレートを読み込ませてから
+        HTTP サーバを開始する。
+    """
+    import concurrent.futures
+
+    jobs = args.jobs or os.cpu_count() or 1
+    max_queue = args.max_queue if args.max_queue is not None else jobs * 4
+    executor = concurrent.futures.ProcessPoolExecutor(
+        max_workers=jobs, initializer=_init_serve_worker, initargs=(args.cache, args.cache_size),
+    )
+    try:
+        # ワーカーは最初の submit で起動されるので、ここで全ワーカーを起動しておく
+        pids = {f.result() for f in [executor.submit(_warm_up_worker) for _ in range(jobs)]}
+        logger.info('started %s worker processes', len(pids))
+        server = _http_server_class()(
+            (args.host, args.port), executor, max_queue, args.backlog, args.canonical_height,
+        )
+        with server:
+            host, port = server.server_address[:2]
+            logger.info('serving on http://%s:%s/ (max queue %s, backlog %s)', host, port, max_queue, args.backlog)
+            try:
+                server.serve_forever()
+            except KeyboardInterrupt:
+                pass
+    finally:
+        executor.shutdown()
+
+
+WORKER_DETECTORS = ('page', 'qp', 'all')
+
+
+def _worker_job(request, default_mode, default_canonical_height):
+    """
+        worker の1件分のリクエストを処理し、レスポンスの dict を返す。例外は送出しない。
+    """
+    start = time.perf_counter()
+    response = {'id': request.get('id')}
+    try:
+        detector = request.get('detector', 'page')
+        if detector not in WORKER_DETECTORS:
+            raise ValueError(f'unknown detector: {detector}')
+        if 'image' in request:
+            import base64
+            item = base64.b64decode(request['image'], validate=True)
+        elif 'path' in request:
+            item = request['path']
+        else:
+            raise ValueError('either "path" or "image" is required')
+        mode = request.get('mode', default_mode)
+        if mode not in QPDetectionMode.values():
+            raise ValueError(f'unknown mode: {mode}')
+        canonical_height = request.get('canonical_height', default_canonical_height)
+        response.update(_detect_as_dict(detector, item, mode, canonical_height))
+        response['error'] = None
+    except Exception as e:
+        response['error'] = _format_error(e)
+    response['elapsed'] = round(time.perf_counter() - start, 6)
+    return response
+
+
+def _write_worker_responses(futures, stdout, broken):
+    import concurrent.futures.process
+
+    while True:
+        item = futures.get()
+        if item is None:
+            return
+        request_id, future = item
+        try:
+            response = future.result()
+        except Exception as e:
+            # ワーカープロセスが異常終了した場合など。レスポンスを返さずに止まらないよう、エラーとして返す
+            if isinstance(e, concurrent.futures.process.BrokenProcessPool):
+                broken.set()
+            response = {'id': request_id, 'error': _format_error(e), 'elapsed': 0.0}
+        stdout.write(json.dumps(response, ensure_ascii=False) + '\n')
+        stdout.flush()
+
+
+def worker(args, stdin=None, stdout=None):
+    """
+        worker サブコマンド。標準入力から1行1リクエストの JSON を読み、
+        1行1レスポンスの JSON を標準出力に書き出す。
+
+        リクエストは {"id": 任意, "detector": "page"|"qp"|"all", "path": パス} の形式で、
+        path の代わりに "image" に base64 でエンコードした画像を渡してもよい。
+        "mode" と "canonical_height" も指定できる。
+        レスポンスは id と検出結果のほか、"error" (成功時は null) と "elapsed" (秒) を持つ。
+
+        前のリクエストの処理を待たずに次のリクエストを読み込んで処理を始めるが、
+        レスポンスはリクエストの順に返す。標準入力が閉じられると、処理中の
+        リクエストのレスポンスを書き出してから終了する。
+
+        ワーカープロセスが異常終了した場合は、処理中のリクエストにエラーを返し、
+        以降のリクエストを読まずに 1 を返す。正常に終了した場合は 0 を返す。
+    """
+    import concurrent.futures
+    import concurrent.futures.process
+    import queue
+
+    stdin = stdin or sys.stdin
+    stdout = stdout or sys.stdout
+    jobs = args.jobs or os.cpu_count() or 1
+    if jobs > 1:
+        executor = concurrent.futures.ProcessPoolExecutor(
+            max_workers=jobs, initializer=_init_serve_worker, initargs=(args.cache, args.cache_size),
+        )
+    else:
+        # 1件ずつ処理する場合も、処理中に次のリクエストを読み込めるよう別スレッドで処理する
+        executor = concurrent.futures.ThreadPoolExecutor(max_workers=1, initializer=_init_worker)
+        _set_serve_result_cache(args.cache, args.cache_size)
+    # 書き出し待ちのレスポンスが増えすぎないよう、先読みする件数を制限する
+    futures = queue.Queue(jobs * 4)
+    broken = threading.Event()
+    writer = threading.Thread(
+        target=_write_worker_responses, args=(futures, stdout, broken), name='worker-writer',
+    )
+    writer.start()
+    try:
+        for line in iter(stdin.readline, ''):
+            if not line.strip():
+                continue
+            request_id = None
+            future = concurrent.futures.Future()
+            try:
+                request = json.loads(line)
+                if not isinstance(request, dict):
+                    raise ValueError('request must be a JSON object')
+            except ValueError as e:
+                future.set_result({'id': None, 'error': _format_error(e), 'elapsed': 0.0})
+            else:
+                request_id = request.get('id')
+                try:
+                    future = executor.submit(_worker_job, request, args.mode, args.canonical_height)
+                except concurrent.futures.process.BrokenProcessPool as e:
+                    broken.set()
+                    future.set_exception(e)
+            futures.put((request_id, future))
+            if broken.is_set():
+                logger.error('a worker process terminated abruptly, stop reading requests')
+                break
+    finally:
+        futures.put(None)
+        writer.join()
+        executor.shutdown()
+        _set_serve_result_cache()
+    return 1 if broken.is_set() else 0
+
+
+def parse_args(argv=None):
+    import argparse
+
+    parser = argparse.ArgumentParser()
+    subparsers = parser.add_subparsers(dest='subcommand')
+
+    def add_cache_arguments(p):
+        p.add_argument(
+            '--cache',
+            metavar='FILE',
+            help='SQLite file to load and store results keyed by the content hash of images',
+        )
+        p.add_argument(
+            '--cache-size',
+            type=int,
+            default=0,
+            metavar='N',
+            help='number of results kept in memory per process [default: 0 (off)]',
+        )
+
+    def add_common_arguments(p):
+        p.add_argument('filename', nargs='+', help='image file or directory, "-" to read an image from STDIN')
+        p.add_argument(
+            '-l', '--loglevel',
+            choices=('debug', 'info', 'warning'),
+            default='info',
+            help='set loglevel [default: info]',
         )
         p.add_argument(
             '-ds', '--debug-sc',
             action='store_true',
             help='enable writing sc image for debug',
         )
+        p.add_argument(
+            '-df', '--debug-sc-on-failure',
+            action='store_true',
+            help='write sc image for debug only when no scrollbar or QP region is found or an error occurs',
+        )
         p.add_argument(
             '-do', '--debug-out-dir',
             default='debugimages',
@@ -660,32 +3259,305 @@ def parse_args():
             default='',
             help='filename prefix for debug image [default: "" (no prefix)]'
         )
+        p.add_argument(
+            '--debug-format',
+            choices=('png', 'jpg', 'webp'),
+            help='image format for debug images [default: same as the input file]',
+        )
+        p.add_argument(
+            '--debug-quality',
+            type=int,
+            metavar='N',
+            help='PNG compression level (0-9) or JPEG/WebP quality (0-100) for debug images '
+                 '[default: OpenCV default]',
+        )
+        p.add_argument(
+            '--debug-queue',
+            type=int,
+            default=16,
+            metavar='N',
+            help='number of debug images queued for the background writer [default: 16]',
+        )
         p.add_argument(
             '-o', '--output',
             type=argparse.FileType('w'),
             default=sys.stdout,
             help='output file [default: STDOUT]',
         )
+        p.add_argument(
+            '-j', '--jobs',
+            type=int,
+            default=1,
+            help='number of worker processes, 0 means the number of CPUs [default: 1]',
+        )
+        p.add_argument(
+            '-f', '--format',
+            choices=tuple(RESULT_WRITERS),
+            default='csv',
+            help='output format [default: csv]',
+        )
+        p.add_argument(
+            '-k', '--keep-going',
+            action='store_true',
+            help='record failures as output rows instead of aborting; '
+                 'CSV rows then get a trailing error column, empty on success',
+        )
+        p.add_argument(
+            '--layout-cache',
+            metavar='FILE',
+            help='JSON file to load and store per-device layouts',
+        )
+        p.add_argument(
+            '--canonical-height',
+            type=int,
+            nargs='?',
+            const=DEFAULT_CANONICAL_HEIGHT,
+            metavar='PIXELS',
+            help='downsample working images to this height before contour analysis '
+                 f'[default: off, {DEFAULT_CANONICAL_HEIGHT} if given without a value]',
+        )
+        p.add_argument(
+            '-r', '--recursive',
+            action='store_true',
+            help='scan directories recursively',
+        )
+        p.add_argument(
+            '--include',
+            action='append',
+            metavar='PATTERN',
+            help='only process files whose relative path or name matches this glob pattern (can be repeated)',
+        )
+        p.add_argument(
+            '--exclude',
+            action='append',
+            metavar='PATTERN',
+            help='skip files and directories matching this glob pattern (can be repeated)',
+        )
+        p.add_argument(
+            '--extension',
+            action='append',
+            metavar='EXT',
+            help='image file extension to process in directories (can be repeated) '
+                 f'[default: {" ".join(DEFAULT_IMAGE_EXTENSIONS)}]',
+        )
+        p.add_argument(
+            '--profile',
+            type=int,
+            nargs='?',
+            const=10,
+            default=0,
+            metavar='N',
+            help='record time and peak memory per file and stage, '
+                 'and print a report with the N slowest files to STDERR [default: off, 10 if given without a value]',
+        )
+        p.add_argument(
+            '--profile-stats',
+            metavar='FILE',
+            help='also run cProfile and dump pstats to FILE (implies --profile, requires --jobs 1)',
+        )
+        add_cache_arguments(p)
+        p.add_argument(
+            '--near-duplicate',
+            type=int,
+            nargs='?',
+            const=DEFAULT_NEAR_DUPLICATE_THRESHOLD,
+            metavar='THRESHOLD',
+            help='reuse the result of a previous image in the run whose scrollbar (or QP) area looks the same, '
+                 'comparing tiny thumbnails by the maximum pixel difference '
+                 f'[default: off, {DEFAULT_NEAR_DUPLICATE_THRESHOLD} if given without a value]',
+        )
+        p.add_argument(
+            '--resume',
+            action='store_true',
+            help='take results of files unchanged since the last run from --cache without reading them',
+        )
 
     page_parser = subparsers.add_parser('page')
     add_common_arguments(page_parser)
-    page_parser.set_defaults(func=look_into_file_for_page)
+    page_parser.set_defaults(
+        func=look_into_file_for_page,
+        result_fields=('pagenum', 'pages', 'lines'),
+        # ページ判定に色の情報は不要
+        imread_flags=_IMREAD_GRAYSCALE,
+    )
+
+    def add_qp_arguments(p):
+        p.add_argument(
+            '-m',
+            '--mode',
+            choices=QPDetectionMode.values(),
+            default=QPDetectionMode.JP.value,
+        )
 
     qp_parser = subparsers.add_parser('qp')
     add_common_arguments(qp_parser)
-    qp_parser.add_argument(
-        '-m',
-        '--mode',
-        choices=QPDetectionMode.values(),
-        default=QPDetectionMode.JP.value,
+    add_qp_arguments(qp_parser)
+    qp_parser.set_defaults(
+        func=look_into_file_for_qp,
+        result_fields=('topleft', 'bottomright'),
+        imread_flags=_IMREAD_COLOR,
     )
-    qp_parser.set_defaults(func=look_into_file_for_qp)
 
-    return parser.parse_args()
+    all_parser = subparsers.add_parser('all')
+    add_common_arguments(all_parser)
+    add_qp_arguments(all_parser)
+    all_parser.set_defaults(
+        func=look_into_file_for_all,
+        result_fields=('pagenum', 'pages', 'lines', 'topleft', 'bottomright'),
+        imread_flags=_IMREAD_COLOR,
+    )
+
+    video_parser = subparsers.add_parser('video')
+    video_parser.add_argument('filename', nargs='+', help='video file')
+    video_parser.add_argument(
+        '-l', '--loglevel',
+        choices=('debug', 'info', 'warning'),
+        default='info',
+        help='set loglevel [default: info]',
+    )
+    video_parser.add_argument(
+        '-o', '--output',
+        type=argparse.FileType('w'),
+        default=sys.stdout,
+        help='output file [default: STDOUT]',
+    )
+    video_parser.add_argument(
+        '-f', '--format',
+        choices=tuple(RESULT_WRITERS),
+        default='csv',
+        help='output format [default: csv]',
+    )
+    video_parser.add_argument(
+        '-k', '--keep-going',
+        action='store_true',
+        help='record failures as output rows instead of aborting; '
+             'CSV rows then get a trailing error column, empty on success',
+    )
+    video_parser.add_argument(
+        '--frame-step',
+        type=int,
+        default=1,
+        metavar='N',
+        help='examine every N-th frame [default: 1]',
+    )
+    video_parser.add_argument(
+        '--diff-threshold',
+        type=int,
+        default=DEFAULT_NEAR_DUPLICATE_THRESHOLD,
+        metavar='THRESHOLD',
+        help='run the detection again when the scrollbar thumbnail changes more than this '
+             f'[default: {DEFAULT_NEAR_DUPLICATE_THRESHOLD}]',
+    )
+    video_parser.add_argument(
+        '--min-stable-frames',
+        type=int,
+        default=3,
+        metavar='N',
+        help='emit a page after N examined frames without changes [default: 3]',
+    )
+    video_parser.add_argument(
+        '--canonical-height',
+        type=int,
+        nargs='?',
+        const=DEFAULT_CANONICAL_HEIGHT,
+        metavar='PIXELS',
+        help='same as the option of the other subcommands',
+    )
+
+    serve_parser = subparsers.add_parser('serve')
+    serve_parser.add_argument(
+        '-l', '--loglevel',
+        choices=('debug', 'info', 'warning'),
+        default='info',
+        help='set loglevel [default: info]',
+    )
+    serve_parser.add_argument('--host', default='127.0.0.1', help='address to listen on [default: 127.0.0.1]')
+    serve_parser.add_argument('--port', type=int, default=8080, help='port to listen on [default: 8080]')
+    serve_parser.add_argument(
+        '-j', '--jobs',
+        type=int,
+        default=0,
+        help='number of worker processes, 0 means the number of CPUs [default: 0]',
+    )
+    serve_parser.add_argument(
+        '--max-queue',
+        type=int,
+        metavar='N',
+        help='reject requests with 503 while N requests are in progress [default: 4 x jobs]',
+    )
+    serve_parser.add_argument(
+        '--backlog',
+        type=int,
+        default=64,
+        help='listen backlog of the server socket [default: 64]',
+    )
+    serve_parser.add_argument(
+        '--canonical-height',
+        type=int,
+        nargs='?',
+        const=DEFAULT_CANONICAL_HEIGHT,
+        metavar='PIXELS',
+        help='same as the option of the other subcommands',
+    )
+    add_cache_arguments(serve_parser)
+
+    worker_parser = subparsers.add_parser('worker')
+    worker_parser.add_argument(
+        '-l', '--loglevel',
+        choices=('debug', 'info', 'warning'),
+        default='info',
+        help='set loglevel [default: info]',
+    )
+    worker_parser.add_argument(
+        '-j', '--jobs',
+        type=int,
+        default=1,
+        help='number of worker processes, 0 means the number of CPUs [default: 1]',
+    )
+    add_qp_arguments(worker_parser)
+    worker_parser.add_argument(
+        '--canonical-height',
+        type=int,
+        nargs='?',
+        const=DEFAULT_CANONICAL_HEIGHT,
+        metavar='PIXELS',
+        help='same as the option of the other subcommands',
+    )
+    add_cache_arguments(worker_parser)
+
+    args = parser.parse_args(argv)
+    if args.subcommand == 'video':
+        if args.frame_step < 1:
+            parser.error('--frame-step must be at least 1')
+        if args.min_stable_frames < 1:
+            parser.error('--min-stable-frames must be at least 1')
+        return args
+    if args.cache_size < 0:
+        parser.error('--cache-size must not be negative')
+    if args.subcommand in ('serve', 'worker'):
+        return args
+    if args.resume and not args.cache:
+        parser.error('--resume requires --cache')
+    if '-' in args.filename and args.jobs != 1:
+        parser.error('reading from STDIN requires --jobs 1')
+    if args.debug_queue < 1:
+        parser.error('--debug-queue must be at least 1')
+    if args.profile_stats:
+        if args.jobs != 1:
+            parser.error('--profile-stats requires --jobs 1')
+        args.profile = args.profile or 10
+    return args
 
 
 if __name__ == '__main__':
     args = parse_args()
     logging.basicConfig(level=logging.INFO, format='[%(levelname)s] %(message)s')
     logger.setLevel(args.loglevel.upper())
-    main(args)
+    if args.subcommand == 'serve':
+        serve(args)
+    elif args.subcommand == 'worker':
+        sys.exit(worker(args))
+    elif args.subcommand == 'video':
+        video(args)
+    else:
+        main(args)
@@ -1,10 +1,24 @@
+import asyncio
+import base64
+import concurrent.futures
+import io
+import json
 import os
 import re
+import subprocess
+import sys
+import tempfile
+import threading
+import time
 import unittest
+import urllib.error
+import urllib.request
 from logging import getLogger
 from pathlib import Path
+from unittest import mock
 
 import cv2
+import numpy as np
 import pytesseract
 
 import pageinfo
@@ -36,6 +50,13 @@ class PageinfoTest(unittest.TestCase):
                     actual = pageinfo.guess_pageinfo(im)
                     self.assertEqual(actual, expected[relpath])
 
+                    im_gray = cv2.imread(impath, cv2.IMREAD_GRAYSCALE)
+                    actual = pageinfo.guess_pageinfo(im_gray)
+                    self.assertEqual(actual, expected[relpath])
+
+                    actual = pageinfo.guess_pageinfo(im_gray, canonical_height=pageinfo.DEFAULT_CANONICAL_HEIGHT)
+                    self.assertEqual(actual, expected[relpath], 'canonical height mode')
+
                 except Exception as e:
                     self.fail(f'{impath}: {e}')
 
@@ -54,17 +75,18 @@ class PageinfoTest(unittest.TestCase):
             with self.subTest(image=impath):
                 im = cv2.imread(impath)
                 try:
-                    coordinates = pageinfo.detect_qp_region(im)
-                    _expected = expected[relpath]
-                    if _expected is None:
-                        self.assertIsNone(coordinates)
-                        continue
-
-                    topleft, bottomright = coordinates
-                    qp_region = im[topleft[1]:bottomright[1], topleft[0]:bottomright[0]]
-                    scan_text = self._extract_text_from_image(qp_region)
-                    actual = self._get_qp_from_text(scan_text)
-                    self.assertEqual(actual, _expected)
+                    for canonical_height in (None, pageinfo.DEFAULT_CANONICAL_HEIGHT):
+                        coordinates = pageinfo.detect_qp_region(im, canonical_height=canonical_height)
+                        _expected = expected[relpath]
+                        if _expected is None:
+                            self.assertIsNone(coordinates)
+                            continue
+
+                        topleft, bottomright = coordinates
+                        qp_region = im[topleft[1]:bottomright[1], topleft[0]:bottomright[0]]
+                        scan_text = self._extract_text_from_image(qp_region)
+                        actual = self._get_qp_from_text(scan_text)
+                        self.assertEqual(actual, _expected, f'canonical_height={canonical_height}')
 
                 except Exception as e:
                     self.fail(f'{impath}: {e}')
@@ -643,3 +665,1001 @@ class PageinfoTest(unittest.TestCase):
             '003.png': 1970155395,
         }
         self._test_detect_qp_region(images_dir, qp_expected)
+
+
+class DetectSideBlackMarginTest(unittest.TestCase):
+    def test_no_margin(self):
+        im = np.full((100, 200), 128, dtype=np.uint8)
+        self.assertEqual(pageinfo.detect_side_black_margin(im), (0, 0))
+
+    def test_both_margins(self):
+        im = np.full((100, 200), 128, dtype=np.uint8)
+        im[:, :30] = 0
+        im[:, 150:] = 5
+        self.assertEqual(pageinfo.detect_side_black_margin(im), (30, 50))
+
+    def test_noise_tolerance(self):
+        im = np.full((100, 200), 128, dtype=np.uint8)
+        im[:, :40] = 0
+        # 9 % までのノイズは黒列とみなす
+        im[:9, 10] = 255
+        # 9 % を超えると黒列とみなさない
+        im[:10, 20] = 255
+        self.assertEqual(pageinfo.detect_side_black_margin(im), (20, 0))
+
+    def test_wide_margin(self):
+        # ブロック境界をまたぐ幅の余白
+        im = np.full((50, 1000), 128, dtype=np.uint8)
+        im[:, :333] = 0
+        im[:, 1000 - 97:] = 0
+        self.assertEqual(pageinfo.detect_side_black_margin(im), (333, 97))
+
+    def test_completely_black(self):
+        im = np.zeros((100, 200), dtype=np.uint8)
+        self.assertEqual(pageinfo.detect_side_black_margin(im), (0, 0))
+
+
+class NextButtonTemplateTest(unittest.TestCase):
+    def test_reference_height(self):
+        base = pageinfo._load_next_button_template()
+        self.assertEqual(base.ndim, 2)
+        self.assertIs(pageinfo._get_next_button_template(pageinfo.NEXT_BUTTON_REFERENCE_HEIGHT), base)
+
+    def test_scaled(self):
+        base = pageinfo._load_next_button_template()
+        scaled = pageinfo._get_next_button_template(pageinfo.NEXT_BUTTON_REFERENCE_HEIGHT * 2)
+        self.assertEqual(scaled.shape, (base.shape[0] * 2, base.shape[1] * 2))
+        self.assertIs(pageinfo._get_next_button_template(pageinfo.NEXT_BUTTON_REFERENCE_HEIGHT * 2), scaled)
+        self.assertFalse(scaled.flags.writeable)
+
+    def test_bottom_band_search(self):
+        im = cv2.imread(os.path.join(get_images_absdir('000'), '004.png'), cv2.IMREAD_GRAYSCALE)
+        cropped = pageinfo.ScreenAnalysis(im).scrollbar_crop_gray
+        button = pageinfo._get_next_button_template(cropped.shape[0])
+        _, expected = pageinfo._locate_next_button(cropped, button)
+        with mock.patch.object(pageinfo, '_locate_next_button', wraps=pageinfo._locate_next_button) as m:
+            gamescreen_type, location, _ = pageinfo._detect_gamescreen_type(cropped)
+        self.assertEqual(m.call_count, 1)
+        self.assertEqual(location, expected)
+        self.assertEqual(gamescreen_type, pageinfo.GS_TYPE_1)
+
+    def test_full_search_fallback(self):
+        cropped = np.full((750, 320), 128, dtype=np.uint8)
+        with mock.patch.object(pageinfo, '_locate_next_button', wraps=pageinfo._locate_next_button) as m:
+            pageinfo._detect_gamescreen_type(cropped)
+        self.assertEqual(m.call_count, 2)
+
+    def test_no_file_io_per_call(self):
+        im = cv2.imread(os.path.join(get_images_absdir('000'), '004.png'))
+        pageinfo.guess_pageinfo(im)
+        with mock.patch.object(pageinfo.cv2, 'imread', side_effect=AssertionError('imread called')):
+            self.assertEqual(pageinfo.guess_pageinfo(im), (1, 2, 4))
+
+
+class BatchTest(unittest.TestCase):
+    def test_guess_pageinfo_many(self):
+        images_dir = get_images_absdir('000')
+        items = [
+            os.path.join(images_dir, '004.png'),
+            os.path.join(images_dir, 'missing.png'),
+            cv2.imread(os.path.join(images_dir, '007.png')),
+            Path(images_dir) / '002.png',
+        ]
+        results = list(pageinfo.guess_pageinfo_many(items, max_workers=2))
+        self.assertEqual([r.index for r in results], [0, 1, 2, 3])
+        self.assertEqual(results[0].value, (1, 2, 4))
+        self.assertIsInstance(results[1].error, FileNotFoundError)
+        self.assertIsNone(results[1].value)
+        self.assertIsNone(results[2].source)
+        self.assertEqual(results[2].value, (2, 2, 6))
+        self.assertEqual(results[3].source, os.path.join(images_dir, '002.png'))
+        self.assertEqual(results[3].value, (1, 1, 3))
+
+    def test_detect_qp_region_many_unordered(self):
+        images_dir = get_images_absdir('000')
+        items = [os.path.join(images_dir, f'00{i}.png') for i in range(8)]
+        results = list(pageinfo.detect_qp_region_many(items, max_workers=2, chunksize=3, ordered=False))
+        self.assertEqual(sorted(r.index for r in results), list(range(8)))
+        for r in results:
+            self.assertIsNone(r.error)
+            self.assertEqual(r.value, pageinfo.detect_qp_region(cv2.imread(r.source)))
+
+
+class CliTest(unittest.TestCase):
+    def _run_main(self, argv):
+        args = pageinfo.parse_args(argv)
+        args.output = io.StringIO()
+        pageinfo.main(args)
+        return args.output.getvalue()
+
+    def test_jobs_keeps_row_order(self):
+        images_dir = get_images_absdir('000')
+        for subcommand in ('page', 'qp'):
+            with self.subTest(subcommand=subcommand):
+                expected = self._run_main([subcommand, images_dir])
+                actual = self._run_main([subcommand, '--jobs', '2', images_dir])
+                self.assertEqual(actual, expected)
+                self.assertEqual(len(actual.splitlines()), 8)
+
+    def test_all(self):
+        images_dir = get_images_absdir('000')
+        page_rows = self._run_main(['page', images_dir]).splitlines()
+        qp_rows = self._run_main(['qp', images_dir]).splitlines()
+        all_rows = self._run_main(['all', images_dir]).splitlines()
+        self.assertEqual(len(all_rows), len(page_rows))
+        for page_row, qp_row, all_row in zip(page_rows, qp_rows, all_rows):
+            filename, qp_columns = qp_row.split(',', 1)
+            self.assertEqual(all_row, f'{page_row},{qp_columns}')
+
+    def test_keep_going(self):
+        images_dir = get_images_absdir('000')
+        missing = os.path.join(images_dir, 'missing.png')
+        argv = ['page', '--keep-going', os.path.join(images_dir, '004.png'), missing]
+        lines = self._run_main(argv).splitlines()
+        # 成功した行にも空のエラー列を出力し、列の数を揃える
+        self.assertEqual(lines[0], os.path.join(images_dir, '004.png') + ',1,2,4,')
+        self.assertTrue(lines[1].startswith(missing + ',,,,FileNotFoundError'))
+
+        with self.assertRaises(FileNotFoundError):
+            self._run_main(['page', missing])
+
+    def test_jsonl(self):
+        images_dir = get_images_absdir('000')
+        missing = os.path.join(images_dir, 'missing.png')
+        argv = ['page', '--format', 'jsonl', '-k', os.path.join(images_dir, '004.png'), missing]
+        records = [json.loads(line) for line in self._run_main(argv).splitlines()]
+        self.assertEqual(
+            {k: records[0][k] for k in ('pagenum', 'pages', 'lines', 'error')},
+            {'pagenum': 1, 'pages': 2, 'lines': 4, 'error': None},
+        )
+        self.assertGreaterEqual(records[0]['elapsed'], 0)
+        self.assertIsNone(records[1]['pagenum'])
+        self.assertTrue(records[1]['error'].startswith('FileNotFoundError'))
+
+    def test_qp_not_found(self):
+        path = os.path.join(get_images_absdir('009'), '001.jpg')
+        self.assertEqual(self._run_main(['qp', path]), path + ',,\n')
+        record = json.loads(self._run_main(['qp', '-f', 'jsonl', path]))
+        self.assertEqual((record['topleft'], record['bottomright']), (None, None))
+
+    def test_profile(self):
+        images_dir = get_images_absdir('000')
+        expected = self._run_main(['page', images_dir])
+        with tempfile.TemporaryDirectory() as tmpdir:
+            stats_path = os.path.join(tmpdir, 'page.pstats')
+            with mock.patch('sys.stderr', new_callable=io.StringIO) as stderr:
+                actual = self._run_main(['page', '--profile', '2', '--profile-stats', stats_path, images_dir])
+            self.assertTrue(os.path.getsize(stats_path) > 0)
+        self.assertEqual(actual, expected)
+        report = stderr.getvalue()
+        self.assertIn('== profile: 8 files', report)
+        self.assertIn('page.template_match', report)
+        slowest = report.split('== slowest 2 files\n')[1].splitlines()[1:]
+        self.assertEqual(len(slowest), 2)
+        self.assertRegex(slowest[0], r' 1280x960 +page:\d+ ')
+
+        with mock.patch('sys.stderr', new_callable=io.StringIO), self.assertRaises(SystemExit):
+            pageinfo.parse_args(['page', '--profile-stats', 'x.pstats', '-j', '2', images_dir])
+
+
+class ScanImageFilesTest(unittest.TestCase):
+    def setUp(self):
+        self.tmpdir = tempfile.TemporaryDirectory()
+        self.addCleanup(self.tmpdir.cleanup)
+        for relpath in ('b.png', 'a.JPG', 'notes.txt', 'sub/c.png', 'sub/deeper/d.jpg', 'skip/e.png'):
+            path = os.path.join(self.tmpdir.name, relpath)
+            os.makedirs(os.path.dirname(path), exist_ok=True)
+            Path(path).touch()
+
+    def _scan(self, **kwargs):
+        top = self.tmpdir.name
+        return [os.path.relpath(p, top) for p in pageinfo._scan_image_files(top, **kwargs)]
+
+    def test_top_level_only(self):
+        self.assertEqual(self._scan(), ['a.JPG', 'b.png'])
+
+    def test_recursive(self):
+        self.assertEqual(
+            self._scan(recursive=True),
+            ['a.JPG', 'b.png', os.path.join('skip', 'e.png'), os.path.join('sub', 'c.png'),
+             os.path.join('sub', 'deeper', 'd.jpg')],
+        )
+
+    def test_include_exclude(self):
+        self.assertEqual(
+            self._scan(recursive=True, include=['*.png'], exclude=['skip']),
+            ['b.png', os.path.join('sub', 'c.png')],
+        )
+
+    def test_extensions(self):
+        self.assertEqual(self._scan(recursive=True, extensions=('.jpg',)), ['a.JPG', os.path.join('sub', 'deeper', 'd.jpg')])
+
+
+class GrayscaleInputTest(unittest.TestCase):
+    def test_guess_pageinfo_skips_color_conversion(self):
+        impath = os.path.join(get_images_absdir('000'), '004.png')
+        im_gray = cv2.imread(impath, cv2.IMREAD_GRAYSCALE)
+        with mock.patch.object(pageinfo.cv2, 'cvtColor', side_effect=AssertionError('cvtColor called')):
+            self.assertEqual(pageinfo.guess_pageinfo(im_gray), (1, 2, 4))
+
+    def test_detect_qp_region(self):
+        images_dir = get_images_absdir('000')
+        for name in ('000.png', '004.png'):
+            impath = os.path.join(images_dir, name)
+            with self.subTest(image=impath):
+                expected = pageinfo.detect_qp_region(cv2.imread(impath))
+                actual = pageinfo.detect_qp_region(cv2.imread(impath, cv2.IMREAD_GRAYSCALE))
+                self.assertEqual(actual, expected)
+
+
+class ScreenAnalysisTest(unittest.TestCase):
+    def setUp(self):
+        self.im = cv2.imread(os.path.join(get_images_absdir('020'), '000.png'))
+
+    def test_same_results_as_functions(self):
+        analysis = pageinfo.ScreenAnalysis(self.im)
+        self.assertEqual(analysis.guess_pageinfo(), pageinfo.guess_pageinfo(self.im))
+        self.assertEqual(analysis.detect_qp_region(), pageinfo.detect_qp_region(self.im))
+
+    def test_cached(self):
+        analysis = pageinfo.ScreenAnalysis(self.im)
+        self.assertEqual(analysis.side_margins, (0, 24))
+        with mock.patch.object(pageinfo, 'detect_side_black_margin', side_effect=AssertionError('recomputed')), \
+                mock.patch.object(pageinfo.cv2, 'cvtColor', side_effect=AssertionError('recomputed')):
+            analysis.guess_pageinfo()
+            analysis.detect_qp_region()
+
+    def test_precomputed(self):
+        expected = pageinfo.guess_pageinfo(self.im)
+        im_gray = cv2.cvtColor(self.im, cv2.COLOR_BGR2GRAY)
+        with mock.patch.object(pageinfo, 'detect_side_black_margin', side_effect=AssertionError('recomputed')):
+            analysis = pageinfo.ScreenAnalysis(self.im, im_gray=im_gray, side_margins=(0, 24))
+            self.assertEqual(analysis.guess_pageinfo(), expected)
+        self.assertIs(analysis.gray, im_gray)
+
+
+class LayoutCacheTest(unittest.TestCase):
+    def test_hit(self):
+        images_dir = get_images_absdir('012/62')
+        cache = pageinfo.LayoutCache()
+        for name in ('000.jpg', '001.jpg', '002.jpg'):
+            im = cv2.imread(os.path.join(images_dir, name), cv2.IMREAD_GRAYSCALE)
+            self.assertEqual(pageinfo.guess_pageinfo(im, layout_cache=cache), pageinfo.guess_pageinfo(im))
+        self.assertEqual((cache.hits, cache.misses), (2, 1))
+
+    def test_rejects_stale_layout(self):
+        im = cv2.imread(os.path.join(get_images_absdir('020'), '000.png'), cv2.IMREAD_GRAYSCALE)
+        cache = pageinfo.LayoutCache()
+        analysis = pageinfo.ScreenAnalysis(im, layout_cache=cache)
+        expected = analysis.gamescreen_type
+        layout = cache.get(analysis.layout_key)
+        layout['button_location'] = [0, 0]
+        layout['button_score'] = 1.0
+        layout['gamescreen_type'] = None
+
+        analysis = pageinfo.ScreenAnalysis(im, layout_cache=cache)
+        self.assertEqual(analysis.gamescreen_type, expected)
+        self.assertEqual((cache.hits, cache.misses), (0, 2))
+
+    def test_persist(self):
+        im = cv2.imread(os.path.join(get_images_absdir('000'), '004.png'), cv2.IMREAD_GRAYSCALE)
+        with tempfile.TemporaryDirectory() as tmpdir:
+            path = os.path.join(tmpdir, 'layout.json')
+            pageinfo.guess_pageinfo(im, layout_cache=pageinfo.LayoutCache(path))
+            self.assertTrue(os.path.exists(path))
+
+            cache = pageinfo.LayoutCache(path)
+            self.assertEqual(pageinfo.guess_pageinfo(im, layout_cache=cache), (1, 2, 4))
+            self.assertEqual((cache.hits, cache.misses), (1, 0))
+
+    def test_save_without_path(self):
+        with self.assertRaisesRegex(ValueError, 'no path given'):
+            pageinfo.LayoutCache().save()
+
+    def test_rematch_layout_is_saved_once(self):
+        # ボタンが見つからない端末では、同じレイアウトを画像ごとに書き戻さないこと
+        detect = pageinfo._detect_gamescreen_type
+        images_dir = get_images_absdir('012/62')
+        with tempfile.TemporaryDirectory() as tmpdir:
+            cache = pageinfo.LayoutCache(os.path.join(tmpdir, 'layout.json'))
+            with mock.patch.object(pageinfo, '_detect_gamescreen_type', side_effect=lambda *args: (detect(*args)[0], None, None)), \
+                    mock.patch.object(cache, 'save', wraps=cache.save) as save:
+                for name in ('000.jpg', '001.jpg', '002.jpg'):
+                    im = cv2.imread(os.path.join(images_dir, name), cv2.IMREAD_GRAYSCALE)
+                    self.assertEqual(pageinfo.guess_pageinfo(im, layout_cache=cache), pageinfo.guess_pageinfo(im))
+            self.assertEqual(save.call_count, 1)
+            self.assertEqual(cache.misses, 3)
+            layout, = pageinfo.LayoutCache(cache.path).entries.values()
+            self.assertTrue(layout['rematch'])
+
+
+class CanonicalHeightTest(unittest.TestCase):
+    def test_reduction_factor(self):
+        im = np.zeros((1644, 3840), dtype=np.uint8)
+        self.assertEqual(pageinfo.ScreenAnalysis(im).qp_factor, 1)
+        self.assertEqual(pageinfo.ScreenAnalysis(im, canonical_height=750).qp_factor, 2)
+        self.assertEqual(pageinfo.ScreenAnalysis(im, canonical_height=2000).qp_factor, 1)
+
+    def test_qp_coordinates_in_original_pixels(self):
+        im = cv2.imread(os.path.join(get_images_absdir('012/62'), '000.jpg'))
+        (x1, y1), (x2, y2) = pageinfo.detect_qp_region(im)
+        (cx1, cy1), (cx2, cy2) = pageinfo.detect_qp_region(im, canonical_height=750)
+        for expected, actual in zip((x1, y1, x2, y2), (cx1, cy1, cx2, cy2)):
+            self.assertAlmostEqual(actual, expected, delta=2)
+
+
+class InstrumentationTest(unittest.TestCase):
+    def setUp(self):
+        self.sink = pageinfo.AggregatingSink()
+        self.previous = pageinfo.set_instrumentation_sink(self.sink)
+        self.addCleanup(pageinfo.set_instrumentation_sink, self.previous)
+        self.im = cv2.imread(os.path.join(get_images_absdir('000'), '000.png'))
+
+    def test_guess_pageinfo(self):
+        result = pageinfo.guess_pageinfo(self.im)
+        for name in ('gray', 'margin', 'page.template_match', 'page.threshold_contours',
+                     'page.contour_filter', 'page.total'):
+            self.assertEqual(self.sink.spans[name][0], 1, name)
+        counters = self.sink.counters
+        rejected = sum(v for k, v in counters.items() if k.startswith('page.rejected.'))
+        self.assertEqual(counters['page.contours'], counters['page.candidates'] + rejected)
+
+        pageinfo.set_instrumentation_sink(None)
+        self.assertEqual(pageinfo.guess_pageinfo(self.im), result)
+
+    def test_detect_qp_region(self):
+        pageinfo.detect_qp_region(self.im)
+        for name in ('qp.crop', 'qp.threshold_contours', 'qp.contour_filter', 'qp.total'):
+            self.assertEqual(self.sink.spans[name][0], 1, name)
+        self.assertGreaterEqual(self.sink.counters['qp.contours'], self.sink.counters['qp.candidates'])
+
+    def test_set_returns_previous(self):
+        other = pageinfo.InstrumentationSink()
+        self.assertIs(pageinfo.set_instrumentation_sink(other), self.sink)
+        self.assertIs(pageinfo.get_instrumentation_sink(), other)
+
+
+class DebugImageWriterTest(unittest.TestCase):
+    def test_write_copies_image(self):
+        im = np.zeros((8, 8), dtype=np.uint8)
+        with tempfile.TemporaryDirectory() as tmpdir:
+            path = os.path.join(tmpdir, 'a.png')
+            with pageinfo.DebugImageWriter(maxsize=1, quality=9) as writer:
+                writer.write(path, im)
+                im[:] = 255
+            self.assertFalse(cv2.imread(path, cv2.IMREAD_GRAYSCALE).any())
+        with self.assertRaises(ValueError):
+            writer.write(path, im)
+
+    def test_imwrite_params(self):
+        self.assertEqual(pageinfo._imwrite_params('a.png', None), [])
+        self.assertEqual(pageinfo._imwrite_params('a.PNG', 1), [cv2.IMWRITE_PNG_COMPRESSION, 1])
+        self.assertEqual(pageinfo._imwrite_params('a.jpg', 80), [cv2.IMWRITE_JPEG_QUALITY, 80])
+
+    def test_cli(self):
+        images_dir = get_images_absdir('000')
+        filename = os.path.join(images_dir, '004.png')
+        for jobs in ('1', '2'):
+            with self.subTest(jobs=jobs), tempfile.TemporaryDirectory() as tmpdir:
+                args = pageinfo.parse_args([
+                    'all', '-ds', '-do', tmpdir, '--debug-format', 'jpg', '--debug-quality', '80', '-j', jobs, filename,
+                ])
+                args.output = io.StringIO()
+                pageinfo.main(args)
+                self.assertIsNone(pageinfo._debug_image_writer)
+                self.assertEqual(
+                    sorted(os.listdir(os.path.join(tmpdir, 'page'))),
+                    ['004.jpg', '004_not_scrollbar.jpg', '004_scrollbar.jpg'],
+                )
+                self.assertEqual(os.listdir(os.path.join(tmpdir, 'qp')), ['004.jpg'])
+
+
+class DebugTraceTest(unittest.TestCase):
+    def setUp(self):
+        images_dir = get_images_absdir('000')
+        self.noscroll = cv2.imread(os.path.join(images_dir, '000.png'))
+        self.scroll = cv2.imread(os.path.join(images_dir, '004.png'))
+        tmpdir = tempfile.TemporaryDirectory()
+        self.addCleanup(tmpdir.cleanup)
+        self.tmpdir = tmpdir.name
+
+    def test_does_not_modify_input(self):
+        original = self.scroll.copy()
+        pageinfo.guess_pageinfo(self.scroll, True, os.path.join(self.tmpdir, 'page.png'))
+        pageinfo.detect_qp_region(self.scroll, debug_draw_image=True, debug_image_name=os.path.join(self.tmpdir, 'qp.png'))
+        np.testing.assert_array_equal(self.scroll, original)
+        self.assertEqual(
+            sorted(os.listdir(self.tmpdir)),
+            ['page.png', 'page_not_scrollbar.png', 'page_scrollbar.png', 'qp.png'],
+        )
+
+    def test_on_failure(self):
+        for name, im, expected in (('noscroll', self.noscroll, True), ('scroll', self.scroll, False)):
+            with self.subTest(name=name):
+                debug_image = os.path.join(self.tmpdir, name + '.png')
+                analysis = pageinfo.ScreenAnalysis(im)
+                analysis.guess_pageinfo(debug_image_name=debug_image, debug_predicate=pageinfo.is_detection_failure)
+                self.assertEqual(os.path.exists(debug_image), expected)
+                self.assertIn('too_small', analysis.traces['page'].rejected)
+
+    def test_on_exception(self):
+        calls = []
+
+        def predicate(result, error):
+            calls.append((result, error))
+            return True
+
+        debug_image = os.path.join(self.tmpdir, 'error.png')
+        with mock.patch('pageinfo._filter_contour_scrollbar', return_value=pageinfo.SCRB_LIKELY_SCROLLBAR):
+            with self.assertRaises(pageinfo.TooManyAreasDetectedError):
+                pageinfo.guess_pageinfo(self.scroll, debug_image_name=debug_image, debug_predicate=predicate)
+        self.assertEqual(len(calls), 1)
+        self.assertIsNone(calls[0][0])
+        self.assertIsInstance(calls[0][1], pageinfo.TooManyAreasDetectedError)
+        self.assertTrue(os.path.exists(debug_image))
+
+
+class BytesInputTest(unittest.TestCase):
+    def setUp(self):
+        self.path = os.path.join(get_images_absdir('000'), '004.png')
+        with open(self.path, 'rb') as f:
+            self.data = f.read()
+
+    def test_decode_image(self):
+        expected = cv2.imread(self.path, cv2.IMREAD_GRAYSCALE)
+        for data in (self.data, bytearray(self.data), memoryview(self.data)):
+            with self.subTest(type=type(data).__name__):
+                np.testing.assert_array_equal(pageinfo.decode_image(data, cv2.IMREAD_GRAYSCALE), expected)
+        reduced = pageinfo.decode_image(self.data, cv2.IMREAD_REDUCED_GRAYSCALE_2)
+        self.assertEqual(reduced.shape, (expected.shape[0] // 2, expected.shape[1] // 2))
+
+    def test_decode_error(self):
+        for data in (b'', b'not an image'):
+            with self.subTest(data=data), self.assertRaises(pageinfo.ImageDecodeError):
+                pageinfo.decode_image(data)
+
+    def test_entry_points(self):
+        im = cv2.imread(self.path)
+        self.assertEqual(pageinfo.guess_pageinfo_from_bytes(self.data), (1, 2, 4))
+        self.assertEqual(
+            pageinfo.guess_pageinfo_from_bytes(memoryview(self.data), flags=cv2.IMREAD_REDUCED_GRAYSCALE_2),
+            (1, 2, 4),
+        )
+        self.assertEqual(pageinfo.detect_qp_region_from_bytes(self.data), pageinfo.detect_qp_region(im))
+        self.assertEqual(pageinfo.ScreenAnalysis.from_bytes(self.data).guess_pageinfo(), (1, 2, 4))
+
+    def test_batch_and_cli(self):
+        results = list(pageinfo.guess_pageinfo_many([self.data, b'broken'], max_workers=1))
+        self.assertEqual(results[0].value, (1, 2, 4))
+        self.assertIsInstance(results[1].error, pageinfo.ImageDecodeError)
+
+        args = pageinfo.parse_args(['page', '-'])
+        self.assertEqual(pageinfo.look_into_bytes(self.data, args), (1, 2, 4))
+        with mock.patch('sys.stdin', io.TextIOWrapper(io.BytesIO(self.data))):
+            self.assertEqual(pageinfo.look_into_file('-', args), (1, 2, 4))
+
+
+class AsyncAnalyzerTest(unittest.TestCase):
+    def setUp(self):
+        self.path = os.path.join(get_images_absdir('000'), '004.png')
+        with open(self.path, 'rb') as f:
+            self.data = f.read()
+
+    def test_same_results_as_sync(self):
+        im = cv2.imread(self.path)
+        expected_page = pageinfo.guess_pageinfo(im)
+        expected_qp = pageinfo.detect_qp_region(im)
+
+        async def run():
+            async with pageinfo.AsyncAnalyzer(max_workers=2, max_concurrency=2) as analyzer:
+                pages = await asyncio.gather(*(analyzer.guess_pageinfo(item) for item in (self.path, self.data, im)))
+                qp = await analyzer.detect_qp_region(self.data)
+            page_default = await pageinfo.guess_pageinfo_async(self.data)
+            qp_default = await pageinfo.detect_qp_region_async(im)
+            return pages, qp, page_default, qp_default
+
+        pages, qp, page_default, qp_default = asyncio.run(run())
+        self.assertEqual(pages, [expected_page] * 3)
+        self.assertEqual(qp, expected_qp)
+        self.assertEqual(page_default, expected_page)
+        self.assertEqual(qp_default, expected_qp)
+
+    def test_concurrency_limit_and_cancel(self):
+        lock = threading.Lock()
+        running = [0, 0]  # 現在の実行数, 最大実行数
+        release = threading.Event()
+
+        def fake_guess_pageinfo(im, block=False):
+            with lock:
+                running[0] += 1
+                running[1] = max(running)
+            if block:
+                release.wait(5)
+            time.sleep(0.01)
+            with lock:
+                running[0] -= 1
+            return pageinfo.NOSCROLL_PAGE_INFO
+
+        async def run(analyzer):
+            blocking = asyncio.ensure_future(analyzer.guess_pageinfo(self.data, block=True))
+            queued = asyncio.ensure_future(analyzer.guess_pageinfo(self.data))
+            await asyncio.sleep(0.05)
+            queued.cancel()
+            blocking.cancel()
+            for task in (queued, blocking):
+                with self.assertRaises(asyncio.CancelledError):
+                    await task
+            # 実行中だった処理が終わるまで次の処理は始まらない
+            follower = asyncio.ensure_future(analyzer.guess_pageinfo(self.data))
+            await asyncio.sleep(0.05)
+            self.assertFalse(follower.done())
+            release.set()
+            results = await asyncio.gather(follower, *(analyzer.guess_pageinfo(self.data) for _ in range(4)))
+            return results
+
+        analyzer = pageinfo.AsyncAnalyzer(max_workers=4, max_concurrency=1)
+        self.addCleanup(analyzer.close)
+        with mock.patch('pageinfo.guess_pageinfo', side_effect=fake_guess_pageinfo) as fake:
+            results = asyncio.run(run(analyzer))
+        self.assertEqual(results, [pageinfo.NOSCROLL_PAGE_INFO] * 5)
+        self.assertEqual(running[1], 1)
+        self.assertEqual(fake.call_count, 6)
+
+    def test_reuse_across_event_loops(self):
+        async def run(analyzer):
+            return await asyncio.gather(*(analyzer.guess_pageinfo(self.data) for _ in range(4)))
+
+        analyzer = pageinfo.AsyncAnalyzer(max_workers=2, max_concurrency=1)
+        self.addCleanup(analyzer.close)
+        expected = pageinfo.guess_pageinfo(cv2.imread(self.path))
+        for _ in range(2):
+            self.assertEqual(asyncio.run(run(analyzer)), [expected] * 4)
+
+
+class ServeTest(unittest.TestCase):
+    def _start_server(self, executor, **kwargs):
+        server = pageinfo.PageInfoHTTPServer(('127.0.0.1', 0), executor, **kwargs)
+        thread = threading.Thread(target=server.serve_forever, daemon=True)
+        thread.start()
+        self.addCleanup(thread.join)
+        self.addCleanup(server.server_close)
+        self.addCleanup(server.shutdown)
+        return 'http://127.0.0.1:%s' % server.server_address[1]
+
+    def _request(self, url, data=None):
+        request = urllib.request.Request(url, data=data, method='GET' if data is None else 'POST')
+        try:
+            with urllib.request.urlopen(request, timeout=30) as response:
+                return response.status, json.loads(response.read())
+        except urllib.error.HTTPError as e:
+            with e:
+                return e.code, json.loads(e.read())
+
+    def test_endpoints(self):
+        path = os.path.join(get_images_absdir('000'), '004.png')
+        with open(path, 'rb') as f:
+            data = f.read()
+        (x1, y1), (x2, y2) = pageinfo.detect_qp_region(cv2.imread(path))
+
+        executor = concurrent.futures.ProcessPoolExecutor(max_workers=1, initializer=pageinfo._init_serve_worker)
+        self.addCleanup(executor.shutdown)
+        base_url = self._start_server(executor, max_queue=2, backlog=8)
+
+        self.assertEqual(self._request(base_url + '/page', data), (200, {'pagenum': 1, 'pages': 2, 'lines': 4}))
+        self.assertEqual(
+            self._request(base_url + '/all?mode=jp', data),
+            (200, {'pagenum': 1, 'pages': 2, 'lines': 4, 'topleft': [x1, y1], 'bottomright': [x2, y2]}),
+        )
+        status, body = self._request(base_url + '/qp', b'broken')
+        self.assertEqual(status, 400)
+        self.assertIn('ImageDecodeError', body['error'])
+        self.assertEqual(self._request(base_url + '/unknown', data)[0], 404)
+
+        status, stats = self._request(base_url + '/stats')
+        self.assertEqual(status, 200)
+        self.assertEqual(stats['backlog'], 8)
+        self.assertEqual(stats['counters'], {'requests': 4, 'status.200': 2, 'status.400': 1, 'status.404': 1})
+        self.assertEqual(stats['latency']['page']['count'], 1)
+
+    def test_invalid_content_length(self):
+        import http.client
+
+        executor = concurrent.futures.ThreadPoolExecutor(max_workers=1)
+        self.addCleanup(executor.shutdown)
+        base_url = self._start_server(executor)
+        host, port = base_url[len('http://'):].split(':')
+        for length in ('-1', 'abc'):
+            conn = http.client.HTTPConnection(host, int(port), timeout=5)
+            try:
+                conn.putrequest('POST', '/page')
+                conn.putheader('Content-Length', length)
+                conn.endheaders()
+                response = conn.getresponse()
+                self.assertEqual(response.status, 400)
+                self.assertIn('Content-Length', json.loads(response.read())['error'])
+            finally:
+                conn.close()
+        self.assertEqual(self._request(base_url + '/stats')[1]['counters']['status.400'], 2)
+
+    def test_queue_limit(self):
+        release = threading.Event()
+        started = threading.Event()
+
+        def blocking_job(*args):
+            started.set()
+            release.wait(5)
+            return {}
+
+        executor = concurrent.futures.ThreadPoolExecutor(max_workers=2)
+        self.addCleanup(executor.shutdown)
+        base_url = self._start_server(executor, max_queue=1)
+        with mock.patch('pageinfo._detect_as_dict', side_effect=blocking_job):
+            first = executor.submit(self._request, base_url + '/page', b'x')
+            self.assertTrue(started.wait(5))
+            status, body = self._request(base_url + '/page', b'x')
+            release.set()
+            self.assertEqual(first.result(), (200, {}))
+        self.assertEqual(status, 503)
+        self.assertEqual(self._request(base_url + '/stats')[1]['counters']['status.503'], 1)
+
+
+class WorkerTest(unittest.TestCase):
+    def setUp(self):
+        self.path = os.path.join(get_images_absdir('000'), '004.png')
+        with open(self.path, 'rb') as f:
+            self.image = base64.b64encode(f.read()).decode('ascii')
+
+    def test_batch(self):
+        requests = [
+            {'id': 'a', 'path': self.path},
+            {'id': 'b', 'image': self.image, 'detector': 'all', 'mode': 'na'},
+            {'id': 'c', 'path': self.path, 'detector': 'unknown'},
+        ]
+        stdin = io.StringIO(''.join(json.dumps(r) + '\n' for r in requests) + '\n[1]\n')
+        stdout = io.StringIO()
+        pageinfo.worker(pageinfo.parse_args(['worker']), stdin, stdout)
+        responses = [json.loads(line) for line in stdout.getvalue().splitlines()]
+
+        (x1, y1), (x2, y2) = pageinfo.detect_qp_region(cv2.imread(self.path), mode='na')
+        self.assertEqual([r['id'] for r in responses], ['a', 'b', 'c', None])
+        self.assertEqual({k: responses[0][k] for k in ('pagenum', 'pages', 'lines', 'error')},
+                         {'pagenum': 1, 'pages': 2, 'lines': 4, 'error': None})
+        self.assertEqual((responses[1]['topleft'], responses[1]['bottomright']), ([x1, y1], [x2, y2]))
+        self.assertTrue(responses[2]['error'].startswith('ValueError: unknown detector'))
+        self.assertTrue(responses[3]['error'].startswith('ValueError'))
+
+    def test_broken_process_pool(self):
+        # ワーカープロセスが異常終了しても、止まらずに全リクエストにレスポンスを返すこと
+        def crash(detector, item, *args):
+            os._exit(1)
+
+        requests = [{'id': i, 'path': self.path} for i in range(30)]
+        stdin = io.StringIO(''.join(json.dumps(r) + '\n' for r in requests))
+        stdout = io.StringIO()
+        exit_codes = []
+        args = pageinfo.parse_args(['worker', '-j', '2'])
+        with mock.patch('pageinfo._detect_as_dict', side_effect=crash):
+            thread = threading.Thread(target=lambda: exit_codes.append(pageinfo.worker(args, stdin, stdout)))
+            thread.start()
+            thread.join(30)
+        self.assertFalse(thread.is_alive())
+        self.assertEqual(exit_codes, [1])
+        responses = [json.loads(line) for line in stdout.getvalue().splitlines()]
+        self.assertTrue(responses)
+        self.assertEqual([r['id'] for r in responses], list(range(len(responses))))
+        self.assertTrue(all(r['error'].startswith('BrokenProcessPool') for r in responses))
+
+    def test_interactive(self):
+        # 次のリクエストを送る前に、前のリクエストのレスポンスを受け取れること
+        in_r, in_w = os.pipe()
+        out_r, out_w = os.pipe()
+        with open(in_r) as stdin, open(in_w, 'w') as to_worker, open(out_w, 'w') as stdout, open(out_r) as from_worker:
+            thread = threading.Thread(target=pageinfo.worker, args=(pageinfo.parse_args(['worker']), stdin, stdout))
+            thread.start()
+            for i in range(2):
+                to_worker.write(json.dumps({'id': i, 'path': self.path}) + '\n')
+                to_worker.flush()
+                response = json.loads(from_worker.readline())
+                self.assertEqual((response['id'], response['pages']), (i, 2))
+            to_worker.close()
+            thread.join(10)
+            self.assertFalse(thread.is_alive())
+
+
+class ResultCacheTest(unittest.TestCase):
+    def setUp(self):
+        self.tmpdir = tempfile.TemporaryDirectory()
+        self.addCleanup(self.tmpdir.cleanup)
+        self.db_path = os.path.join(self.tmpdir.name, 'cache.db')
+        self.image_path = os.path.join(get_images_absdir('000'), '004.png')
+        self.params = pageinfo.result_cache_params('page')
+
+    def tearDown(self):
+        for cache in (pageinfo.get_result_cache(self.db_path, 0), pageinfo.get_result_cache(self.db_path, 8)):
+            cache.close()
+        pageinfo.get_result_cache.cache_clear()
+
+    def _run_main(self, argv):
+        args = pageinfo.parse_args(argv)
+        args.output = io.StringIO()
+        pageinfo.main(args)
+        return args.output.getvalue()
+
+    def test_memory_lru(self):
+        cache = pageinfo.ResultCache(maxsize=2)
+        for i in range(3):
+            cache.put(str(i), self.params, (i, 2, 4))
+        self.assertIsNone(cache.get('0', self.params))
+        self.assertEqual(cache.get('2', self.params), ((2, 2, 4), None))
+        self.assertIsNone(cache.get('2', pageinfo.result_cache_params('qp')))
+        self.assertEqual((cache.hits, cache.misses), (1, 2))
+
+    def test_sqlite_and_errors(self):
+        cache = pageinfo.ResultCache(self.db_path, maxsize=0)
+        cache.put('a', self.params, ((1, 2), (3, 4)))
+        cache.put('b', self.params, error=pageinfo.TooManyAreasDetectedError('2 actual qp regions detected'))
+        # 画像の内容で決まらない例外はキャッシュしない
+        cache.put('c', self.params, error=FileNotFoundError('c'))
+        cache.close()
+
+        cache = pageinfo.ResultCache(self.db_path, maxsize=0)
+        self.addCleanup(cache.close)
+        self.assertEqual(cache.get('a', self.params), (((1, 2), (3, 4)), None))
+        self.assertIsNone(cache.get('c', self.params))
+        result, error = cache.get('b', self.params)
+        self.assertIsNone(result)
+        self.assertIsInstance(error, pageinfo.TooManyAreasDetectedError)
+        self.assertEqual(str(error), '2 actual qp regions detected')
+
+    def test_get_or_compute(self):
+        with open(self.image_path, 'rb') as f:
+            data = f.read()
+        cache = pageinfo.ResultCache()
+        compute = mock.Mock(return_value=(1, 2, 4))
+        for _ in range(2):
+            self.assertEqual(cache.get_or_compute(data, self.params, compute), (1, 2, 4))
+        compute.assert_called_once_with()
+
+    def test_fingerprint_invalidates(self):
+        cache = pageinfo.ResultCache()
+        cache.put('a', self.params, (1, 2, 4))
+        with mock.patch('pageinfo.detector_fingerprint', return_value='0' * 16):
+            params = pageinfo.result_cache_params('page')
+        self.assertNotEqual(params, self.params)
+        self.assertIsNone(cache.get('a', params))
+
+    def test_cli(self):
+        images_dir = get_images_absdir('000')
+        expected = self._run_main(['all', images_dir])
+        argv = ['all', '--cache', self.db_path, images_dir]
+        self.assertEqual(self._run_main(argv), expected)
+        # 2回目以降は画像をデコードしない
+        with mock.patch('pageinfo.decode_image', side_effect=AssertionError('decoded')):
+            self.assertEqual(self._run_main(argv), expected)
+            # --resume のときはファイルも読まない
+            with mock.patch('builtins.open', side_effect=AssertionError('opened')):
+                self.assertEqual(self._run_main(argv + ['--resume']), expected)
+        # 判定の引数が異なれば別の結果として扱う
+        self.assertNotEqual(self._run_main(argv + ['--mode', 'na']), expected)
+        # ほぼ同一の画像の結果を使い回した近似の結果は、正確な結果として使わない
+        with mock.patch.object(pageinfo.ResultCache, 'put') as put:
+            self._run_main(argv + ['--near-duplicate'])
+        self.assertTrue(put.called)
+        self.assertTrue(all('near_duplicate=' in call.args[1] for call in put.call_args_list))
+
+    def test_resume_requires_cache(self):
+        with mock.patch('sys.stderr', new_callable=io.StringIO), self.assertRaises(SystemExit):
+            pageinfo.parse_args(['page', '--resume', self.image_path])
+
+    def test_worker(self):
+        request = json.dumps({'id': 1, 'path': self.image_path}) + '\n'
+        stdout = io.StringIO()
+        with mock.patch('pageinfo._detect_as_dict_uncached', wraps=pageinfo._detect_as_dict_uncached) as detect:
+            pageinfo.worker(pageinfo.parse_args(['worker', '--cache-size', '8']), io.StringIO(request * 2), stdout)
+        self.assertEqual(detect.call_count, 1)
+        responses = [json.loads(line) for line in stdout.getvalue().splitlines()]
+        self.assertEqual([(r['pages'], r['lines'], r['error']) for r in responses], [(2, 4, None)] * 2)
+        self.assertIsNone(pageinfo._serve_result_cache)
+
+
+class NearDuplicateTest(unittest.TestCase):
+    def setUp(self):
+        images_dir = get_images_absdir('000')
+        self.im = cv2.imread(os.path.join(images_dir, '004.png'))
+        self.other = cv2.imread(os.path.join(images_dir, '003.png'))
+        _, encoded = cv2.imencode('.jpg', self.im, [cv2.IMWRITE_JPEG_QUALITY, 80])
+        self.reencoded = cv2.imdecode(encoded, cv2.IMREAD_COLOR)
+        self.resized = cv2.resize(self.im, None, fx=0.8, fy=0.8, interpolation=cv2.INTER_AREA)
+        self.index = pageinfo.NearDuplicateIndex()
+
+    def test_page(self):
+        expected = pageinfo.guess_pageinfo(self.im, near_duplicates=self.index)
+        for im in (self.reencoded, self.resized):
+            self.assertEqual(pageinfo.guess_pageinfo(im, near_duplicates=self.index), expected)
+        self.assertEqual(self.index.hits, 2)
+
+        # スクロールバーの位置が異なる画像は使い回さない
+        self.assertNotEqual(pageinfo.guess_pageinfo(self.other), expected)
+        self.assertEqual(pageinfo.guess_pageinfo(self.other, near_duplicates=self.index),
+                         pageinfo.guess_pageinfo(self.other))
+        self.assertEqual(self.index.hits, 2)
+
+    def test_qp(self):
+        expected = pageinfo.detect_qp_region(self.im, near_duplicates=self.index)
+        self.assertEqual(pageinfo.detect_qp_region(self.reencoded, near_duplicates=self.index), expected)
+        self.assertEqual(self.index.hits, 1)
+        # 座標を返すので、大きさの異なる画像では使い回さない
+        self.assertEqual(pageinfo.detect_qp_region(self.resized, near_duplicates=self.index),
+                         pageinfo.detect_qp_region(self.resized))
+        self.assertEqual(self.index.hits, 1)
+        # mode ごとに区別する
+        pageinfo.detect_qp_region(self.im, mode='na', near_duplicates=self.index)
+        self.assertEqual(self.index.hits, 1)
+
+    def test_threshold(self):
+        index = pageinfo.NearDuplicateIndex(threshold=0)
+        pageinfo.guess_pageinfo(self.im, near_duplicates=index)
+        pageinfo.guess_pageinfo(self.resized, near_duplicates=index)
+        self.assertEqual((index.hits, index.misses), (0, 2))
+
+    def test_debug_draw_image_is_not_reused(self):
+        pageinfo.guess_pageinfo(self.im, near_duplicates=self.index)
+        with mock.patch('pageinfo.cv2.imwrite') as imwrite:
+            pageinfo.guess_pageinfo(self.reencoded, True, 'debug.png', near_duplicates=self.index)
+        self.assertEqual(self.index.hits, 0)
+        self.assertTrue(imwrite.called)
+
+    def test_pickle(self):
+        import pickle
+        index = pickle.loads(pickle.dumps(pageinfo.NearDuplicateIndex(threshold=10)))
+        self.assertIs(index, pageinfo.get_near_duplicate_index(10, 256))
+
+    def test_cli(self):
+        images_dir = get_images_absdir('000')
+        args = pageinfo.parse_args(['all', images_dir, '--near-duplicate'])
+        self.assertEqual(args.near_duplicate, pageinfo.DEFAULT_NEAR_DUPLICATE_THRESHOLD)
+        outputs = []
+        for argv in (['all', images_dir], ['all', images_dir, '--near-duplicate']):
+            args = pageinfo.parse_args(argv)
+            args.output = io.StringIO()
+            pageinfo.main(args)
+            outputs.append(args.output.getvalue())
+        self.assertEqual(outputs[1], outputs[0])
+
+
+class VideoTest(unittest.TestCase):
+    def setUp(self):
+        self.tmpdir = tempfile.TemporaryDirectory()
+        self.addCleanup(self.tmpdir.cleanup)
+        images_dir = get_images_absdir('000')
+        page1 = cv2.imread(os.path.join(images_dir, '004.png'))
+        page2 = cv2.imread(os.path.join(images_dir, '005.png'))
+        # 1ページ目 -> スクロール中 -> 2ページ目 -> 1ページ目
+        frames = [page1] * 5
+        frames += [cv2.addWeighted(page1, 1 - t, page2, t, 0) for t in (0.25, 0.5, 0.75)]
+        frames += [page2] * 5 + [page1] * 4
+        self.path = self._write_video('recording.avi', frames)
+
+    def _write_video(self, name, frames):
+        path = os.path.join(self.tmpdir.name, name)
+        h, w = frames[0].shape[:2]
+        writer = cv2.VideoWriter(path, cv2.VideoWriter_fourcc(*'MJPG'), 10, (w, h))
+        if not writer.isOpened():
+            self.skipTest('MJPG video writer is not available')
+        for frame in frames:
+            writer.write(frame)
+        writer.release()
+        return path
+
+    def test_iter_video_pages(self):
+        sink = pageinfo.AggregatingSink()
+        previous = pageinfo.set_instrumentation_sink(sink)
+        try:
+            pages = list(pageinfo.iter_video_pages(self.path))
+        finally:
+            pageinfo.set_instrumentation_sink(previous)
+        self.assertEqual([page.frame for page in pages], [0, 8])
+        self.assertEqual([page[2:] for page in pages], [(1, 2, 4), (2, 2, 4)])
+        self.assertAlmostEqual(pages[1].time, 0.8)
+        # 変化のないフレームは判定しない
+        self.assertEqual(sink.counters['video.analyzed_frames'], 6)
+        self.assertEqual(sink.counters['video.skipped_frames'], 11)
+
+    def test_min_stable_frames(self):
+        self.assertEqual(list(pageinfo.iter_video_pages(self.path, min_stable_frames=6)), [])
+        pages = list(pageinfo.iter_video_pages(self.path, frame_step=2, min_stable_frames=2))
+        self.assertEqual([page[2:] for page in pages], [(1, 2, 4), (2, 2, 4)])
+
+    def test_black_lead_in(self):
+        # 真っ黒なフレームから始まっても、左右に黒余白のある画面を正しく判定すること
+        screen = cv2.imread(os.path.join(get_images_absdir('016'), '000.jpg'))
+        path = self._write_video('fade_in.avi', [np.zeros_like(screen)] + [screen] * 4)
+        pages = list(pageinfo.iter_video_pages(path))
+        self.assertEqual([page[2:] for page in pages], [(1, 2, 4)])
+
+    def test_cli(self):
+        missing = os.path.join(self.tmpdir.name, 'missing.avi')
+        args = pageinfo.parse_args(['video', '-f', 'jsonl', '-k', self.path, missing])
+        args.output = io.StringIO()
+        with self.assertLogs('pageinfo', 'ERROR'):
+            pageinfo.video(args)
+        records = [json.loads(line) for line in args.output.getvalue().splitlines()]
+        self.assertEqual(
+            [(r['frame'], r['pagenum'], r['pages'], r['lines']) for r in records[:2]], [(0, 1, 2, 4), (8, 2, 2, 4)],
+        )
+        self.assertTrue(records[2]['error'].startswith('FileNotFoundError'))
+
+        with mock.patch('sys.stderr', new_callable=io.StringIO), self.assertRaises(SystemExit):
+            pageinfo.parse_args(['video', '--frame-step', '0', self.path])
+
+
+class PageSessionTest(unittest.TestCase):
+    def _load(self, dirname, *names):
+        return [(name, cv2.imread(os.path.join(get_images_absdir(dirname), name))) for name in names]
+
+    def test_strip(self):
+        for canonical_height in (None, pageinfo.DEFAULT_CANONICAL_HEIGHT):
+            with self.subTest(canonical_height=canonical_height):
+                session = pageinfo.PageSession(canonical_height=canonical_height)
+                for name, im in self._load('003', '001.png', '002.png', '003.png'):
+                    expected = pageinfo.guess_pageinfo(im, canonical_height=canonical_height)
+                    self.assertEqual(session.guess_pageinfo(im, name), expected)
+                self.assertEqual([result for _, result in session.results], [(1, 3, 7), (2, 3, 7), (3, 3, 7)])
+                self.assertEqual((session.strip_hits, session.fallbacks), (2, 0))
+                self.assertEqual(session.consistency_issues(), [])
+
+    def test_strip_uses_contour_filter(self):
+        # 帯の中の輪郭も、全体で検出する場合と同じ基準で判定すること
+        session = pageinfo.PageSession()
+        (_, first), (_, second) = self._load('003', '001.png', '002.png')
+        session.guess_pageinfo(first)
+        with mock.patch('pageinfo._filter_contour_scrollbar', return_value=pageinfo.SCRB_TOO_SMALL):
+            self.assertEqual(session.guess_pageinfo(second), pageinfo.guess_pageinfo(second))
+        self.assertEqual((session.strip_hits, session.fallbacks), (0, 1))
+
+    def test_fallback(self):
+        session = pageinfo.PageSession()
+        # 端末が同じでもスクロールバーの長さが変わった場合と、端末が変わった場合は通常の判定を行う
+        images = self._load('001', '000.png', '001.png', '002.png') + self._load('000', '004.png')
+        for name, im in images:
+            self.assertEqual(session.guess_pageinfo(im, name), pageinfo.guess_pageinfo(im))
+        self.assertEqual((session.strip_hits, session.fallbacks), (1, 2))
+        self.assertEqual(session.consistency_issues(), [
+            '001.png: pages/lines 2/4 differ from 1/3 of 000.png',
+            '001.png: page 1 is the same as 000.png',
+            '002.png: pages/lines 2/4 differ from 1/3 of 000.png',
+            '004.png: pages/lines 2/4 differ from 1/3 of 000.png',
+            '004.png: page 1 is the same as 000.png',
+        ])
+
+    def test_consistency_issues(self):
+        session = pageinfo.PageSession()
+        for name, im in self._load('003', '002.png', '001.png', '002.png'):
+            session.guess_pageinfo(im, name)
+        self.assertEqual(session.consistency_issues(), [
+            '001.png: page 1 comes after page 2',
+            '002.png: page 2 is the same as 002.png',
+            'missing pages: 3',
+        ])
+        self.assertEqual(pageinfo.PageSession().consistency_issues(), [])
+
+
+class LazyImportTest(unittest.TestCase):
+    def test_import_does_not_load_heavy_modules(self):
+        modules = ('cv2', 'numpy', 'argparse', 'csv', 'asyncio', 'http.server', 'concurrent.futures')
+        script = f'import sys, pageinfo; print([m for m in {modules!r} if m in sys.modules])'
+        output = subprocess.run(
+            [sys.executable, '-c', script], cwd=os.path.dirname(os.path.dirname(os.path.abspath(__file__))),
+            capture_output=True, text=True, check=True,
+        ).stdout
+        self.assertEqual(output.strip(), '[]')
+
+    def test_imread_flags(self):
+        self.assertEqual(pageinfo._IMREAD_COLOR, cv2.IMREAD_COLOR)
+        self.assertEqual(pageinfo._IMREAD_GRAYSCALE, cv2.IMREAD_GRAYSCALE)
+
+    def test_module_attributes(self):
+        self.assertEqual(pageinfo.pageinfo_basedir, Path(pageinfo.__file__).parent)
+        self.assertTrue(issubclass(pageinfo.PageInfoHTTPServer, pageinfo._PageInfoHTTPServerMixin))
+        with self.assertRaises(AttributeError):
+            pageinfo.no_such_attribute